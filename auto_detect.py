@@ -0,0 +1,337 @@
+"""
+Automatic octagon target detection without any GUI
+
+A bank of octagon-with-crosshair templates is synthesized at several sizes
+and rotations (or derived from a stored exemplar by scaling / rotating it).
+Detection runs on a reduced image: the spectrum of every bank template is
+computed once per image size (pattern_matching.FFTMatcher), so a frame costs
+one forward DFT plus one spectrum product and inverse DFT per template, and the
+normalized cross correlation denominators come from integral images shared by
+all templates. The best candidates are refined with the full resolution
+template of the bank entry that found them.
+
+    bank = TemplateBank.synthesize(image_height=1200)
+    targets = bank.locate(gray)        # [Target(x, y, score, template, center), ...]
+"""
+
+import threading
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+import metrics
+from pattern_matching import FFTMatcher, filter_matches, optimal_dft_shape, refine_match, refine_subpixel
+from target_center import template_center
+
+# 預設的 target 大小範圍（短邊的比例）和數量
+DEFAULT_SIZE_RANGE = (0.04, 0.2)
+DEFAULT_SIZES = 6
+DEFAULT_ANGLES = (0.0,)
+DEFAULT_MIN_SCORE = 0.6
+# 縮小後最小的模板至少這麼大
+MIN_COARSE_SIZE = 16
+
+
+def synthesize_target(size, angle=0.0, background=230, foreground=30, line_width=None):
+    """
+    Gray octagon target with a crosshair, rotated by angle degrees around the center
+
+    the same drawing as synthetic_data.make_octagon_template; only the structure
+    matters for the normalized correlation, not the gray values
+
+    Return:
+    np.array: size x size template, the center is (size // 2, size // 2)
+    """
+    template = np.full((size, size), background, np.uint8)
+    c = size // 2
+    r = size * 0.42
+    theta = np.radians(angle)
+    angles = np.pi / 8 + np.arange(8) * np.pi / 4 + theta
+    points = np.stack([c + r * np.cos(angles), c + r * np.sin(angles)], axis=1)
+    cv2.fillPoly(template, [np.round(points).astype(np.int32)], foreground)
+
+    line_width = line_width or max(1, round(size / 40))
+    for phi in (theta, theta + np.pi / 2):
+        dx, dy = r * np.cos(phi), r * np.sin(phi)
+        cv2.line(template, (round(c - dx), round(c - dy)), (round(c + dx), round(c + dy)),
+                 background, line_width)
+    return template
+
+
+def _transform(template, center, scale, angle, background):
+    """scale and rotate a template around its target center"""
+    size = max(8, int(round(max(template.shape[:2]) * scale)))
+    matrix = cv2.getRotationMatrix2D((float(center[0]), float(center[1])), angle, scale)
+    # 目標中心移到新模板的中心
+    matrix[:, 2] += (size // 2 - center[0], size // 2 - center[1])
+    return cv2.warpAffine(template, matrix, (size, size), flags=cv2.INTER_AREA,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=int(background))
+
+
+@dataclass
+class Target:
+    """one detected target"""
+    x: float                # target center, full resolution
+    y: float
+    score: float
+    template: np.ndarray    # full resolution template that matched best
+    center: tuple           # target center inside the template
+
+
+class TemplateBank:
+    """templates of one target at several sizes / rotations with their FFT matchers per image size"""
+
+    def __init__(self, templates, centers, labels=None):
+        """
+        Param:
+        templates (list): gray templates
+        centers (list): (cx, cy) of the target in every template
+        labels (list): description of every template, e.g. (size, angle)
+        """
+        self.templates = list(templates)
+        self.centers = [tuple(c) for c in centers]
+        self.labels = list(labels) if labels is not None else list(range(len(self.templates)))
+        # synthesize_target 的 bank 可以產生任意大小的模板，用來細調大小
+        self.factory = None
+        self.size_step = 1.2
+        self._extra = {}
+        self._coarse = {}
+        self._matchers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.templates)
+
+    @classmethod
+    def synthesize(cls, sizes=None, angles=DEFAULT_ANGLES, image_height=None):
+        """
+        Bank of synthetic targets
+
+        Param:
+        sizes (list): template sizes in pixels, default DEFAULT_SIZES sizes over
+                      DEFAULT_SIZE_RANGE of image_height
+        angles (tuple): rotations in degrees (the octagon repeats every 45 degrees)
+        image_height (int): short side of the images, only used for the default sizes
+        """
+        if sizes is None:
+            if image_height is None:
+                raise ValueError("sizes or image_height is required")
+            low, high = DEFAULT_SIZE_RANGE
+            sizes = np.geomspace(low * image_height, high * image_height, DEFAULT_SIZES)
+        sizes = sorted({int(s) | 1 for s in sizes})
+        templates, labels = [], []
+        for size in sizes:
+            for angle in angles:
+                templates.append(synthesize_target(size, angle))
+                labels.append((size, angle))
+        bank = cls(templates, [(t.shape[1] // 2, t.shape[0] // 2) for t in templates], labels)
+        bank.factory = synthesize_target
+        if len(sizes) > 1:
+            bank.size_step = (sizes[-1] / sizes[0]) ** (1 / (len(sizes) - 1))
+        return bank
+
+    @classmethod
+    def from_exemplar(cls, template, scales=(0.8, 0.9, 1.0, 1.12, 1.25), angles=DEFAULT_ANGLES,
+                      center=None):
+        """
+        Bank learned from a stored exemplar (e.g. the template library entry of a rig)
+
+        the exemplar is scaled and rotated around its target center, so the real
+        appearance of the targets is kept while the size / rotation may change
+        """
+        center = center or template_center(template)
+        background = int(np.median(np.concatenate([template[0], template[-1],
+                                                   template[:, 0], template[:, -1]])))
+        templates, labels = [], []
+        for scale in scales:
+            for angle in angles:
+                if scale == 1 and angle == 0:
+                    templates.append(template)
+                else:
+                    templates.append(_transform(template, center, scale, angle, background))
+                labels.append((scale, angle))
+        centers = [center if t is template else (t.shape[1] // 2, t.shape[0] // 2) for t in templates]
+        return cls(templates, centers, labels)
+
+    def factor_for(self, min_size=MIN_COARSE_SIZE):
+        """largest power of two reduction that keeps the smallest template at least min_size"""
+        smallest = min(min(t.shape[:2]) for t in self.templates)
+        factor = 1
+        while smallest // (factor * 2) >= min_size:
+            factor *= 2
+        return factor
+
+    def _coarse_templates(self, factor):
+        coarse = self._coarse.get(factor)
+        if coarse is None:
+            coarse = [cv2.resize(t, (max(3, t.shape[1] // factor), max(3, t.shape[0] // factor)),
+                                 interpolation=cv2.INTER_AREA) for t in self.templates]
+            self._coarse[factor] = coarse
+        return coarse
+
+    def matchers(self, shape, factor):
+        """
+        FFTMatcher of every coarse template for a gray image reduced by factor
+
+        created once per (image shape, factor), all with the same DFT size so one
+        frame_terms is shared by the whole bank
+
+        Return:
+        list: FFTMatcher per template, None when the template is larger than the image
+        """
+        key = (tuple(shape), factor)
+        with self._lock:
+            cached = self._matchers.get(key)
+            if cached is None:
+                dft_shape = optimal_dft_shape(shape)
+                cached = self._matchers[key] = [
+                    FFTMatcher(template, shape, dft_shape)
+                    if template.shape[0] <= shape[0] and template.shape[1] <= shape[1] else None
+                    for template in self._coarse_templates(factor)]
+            return cached
+
+    def score_maps(self, small, factor):
+        """
+        Normalized cross correlation of every coarse template with a gray image reduced by factor
+
+        Return:
+        list: one TM_CCOEFF_NORMED score map per template (same layout as cv2.matchTemplate)
+        """
+        matchers = self.matchers(small.shape[:2], factor)
+        usable = [matcher for matcher in matchers if matcher is not None]
+        if not usable:
+            return [None] * len(matchers)
+        terms = usable[0].frame_terms(small)
+        return [matcher.scores_from_terms(terms) if matcher is not None else None
+                for matcher in matchers]
+
+    def locate(self, gray, min_score=DEFAULT_MIN_SCORE, top_k=None, factor=None, subpixel=False):
+        """
+        Find all targets in a gray image
+
+        Param:
+        gray (np.array): full resolution gray image
+        min_score (float): minimum normalized correlation of a target
+        top_k (int): maximum number of targets, None to keep all
+        factor (int): reduction of the detection image, default from the smallest template
+        subpixel (bool): sub-pixel target centers
+
+        Return:
+        list: Target objects sorted by score
+        """
+        factor = factor or self.factor_for()
+        with metrics.stage('pyramid_downscale'):
+            small = gray if factor == 1 else cv2.resize(
+                gray, (gray.shape[1] // factor, gray.shape[0] // factor), interpolation=cv2.INTER_AREA)
+
+        # 每個模板的峰值，換算成 target 中心後一起去除重複
+        candidates = {}
+        coarse = self._coarse_templates(factor)
+        for index, scores in enumerate(self.score_maps(small, factor)):
+            if scores is None:
+                continue
+            h, w = coarse[index].shape[:2]
+            radius = max(1, min(h, w) // 2)
+            local_max = cv2.dilate(scores, np.ones((2 * radius + 1, 2 * radius + 1), np.uint8))
+            ys, xs = np.nonzero((scores >= min_score * 0.8) & (scores >= local_max))
+            cx, cy = self.centers[index]
+            for x, y, score in zip(xs.tolist(), ys.tolist(), scores[ys, xs].tolist()):
+                center = (x + cx / factor, y + cy / factor)
+                if candidates.get(center, (-1,))[0] < score:
+                    candidates[center] = (score, index)
+        metrics.count('match_candidates', len(candidates))
+        if not candidates:
+            return []
+
+        smallest = min(min(t.shape[:2]) for t in coarse)
+        kept = filter_matches([(x, y, s) for (x, y), (s, _) in candidates.items()],
+                              max(1, smallest // 2), top_k and 4 * top_k)
+
+        targets = []
+        with metrics.stage('match_refine'):
+            for x, y, _ in kept:
+                index = candidates[(x, y)][1]
+                template, (cx, cy) = self.templates[index], self.centers[index]
+                left, top = int(round(x * factor - cx)), int(round(y * factor - cy))
+                match = refine_match(gray, template, left, top, 2 * factor)
+                if match is None:
+                    continue
+                if self.factory is not None:
+                    match, template = self._refine_size(gray, match, template, index)
+                    cx, cy = template.shape[1] // 2, template.shape[0] // 2
+                if match[2] < min_score:
+                    continue
+                if subpixel:
+                    match = refine_subpixel(gray, template, [match])[0]
+                targets.append(Target(match[0] + cx, match[1] + cy, match[2], template, (cx, cy)))
+        return _suppress(targets, top_k)
+
+    def _sized(self, size, angle):
+        key = (size, angle)
+        template = self._extra.get(key)
+        if template is None:
+            template = self._extra[key] = self.factory(size, angle)
+        return template
+
+    def _refine_size(self, gray, match, template, index, rounds=3):
+        """
+        Search the target size between the bank sizes (synthesized banks only)
+
+        a template of a slightly different size pulls the center towards the edges of the
+        target, so the size is refined at full resolution around the matched position
+        """
+        _, angle = self.labels[index]
+        size = template.shape[0]
+        step = np.sqrt(self.size_step)
+        for _ in range(rounds):
+            x, y = match[0] + size // 2, match[1] + size // 2
+            for new_size in (int(size / step) | 1, int(size * step) | 1):
+                if new_size == size or new_size < 8:
+                    continue
+                candidate = self._sized(new_size, angle)
+                refined = refine_match(gray, candidate, x - new_size // 2, y - new_size // 2, 2)
+                if refined is not None and refined[2] > match[2]:
+                    match, template, size = refined, candidate, new_size
+            step = np.sqrt(step)
+        return match, template
+
+
+def _suppress(targets, top_k=None):
+    """
+    Keep the best target among overlapping ones
+
+    a smaller template also matches parts of a large target (the quadrants of the
+    crosshair), so a target is suppressed within half the size of a better one
+    """
+    kept = []
+    for target in sorted(targets, key=lambda t: t.score, reverse=True):
+        if all(np.hypot(target.x - k.x, target.y - k.y) >= min(k.template.shape[:2]) / 2 for k in kept):
+            kept.append(target)
+            if top_k is not None and len(kept) >= top_k:
+                break
+    return kept
+
+
+_default_banks = {}
+
+
+def get_default_bank(shape):
+    """process-wide synthesized bank for images of this size, the spectra stay warm across frames"""
+    height = min(shape[:2])
+    bank = _default_banks.get(height)
+    if bank is None:
+        bank = _default_banks[height] = TemplateBank.synthesize(image_height=height)
+    return bank
+
+
+def detect_targets(gray, bank=None, min_score=DEFAULT_MIN_SCORE, top_k=None, subpixel=False):
+    """
+    Target centers of a gray image, with the default bank of the image size if bank is None
+
+    Return:
+    list: [(cx, cy), ...] sorted by score
+    """
+    if bank is None:
+        bank = get_default_bank(gray.shape)
+    return [(t.x, t.y) for t in bank.locate(gray, min_score, top_k, subpixel=subpixel)]
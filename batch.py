@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+批次色彩分析程序 - 無GUI版本
+
+功能：
+- 讀取整個目錄或 glob 的拼接圖片
+- 多個 worker process 平行執行 校正點檢測 → 色彩分析 → 亮度分析
+- 每張圖片輸出一列結果 (CSV)
+
+使用方法：
+    python batch.py assets/frames --template assets/extracted_target.png --workers 8 --output results.csv
+    python batch.py "assets/frames/*.png" --rig RIG_A
+    python batch.py assets/frames --auto          # 不需要模板，自動檢測 target
+"""
+
+import argparse
+import contextlib
+import csv
+import glob
+import io
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool, util
+
+import cv2
+
+import metrics
+from image_processing import load_image, convert_to_gray, sample_corner_lines
+from color_analysis import analyze_color_lines, analyze_color_bands, segment_lines
+from color_delta import calculate_lab_delta_e
+from seam_analysis import seam_delta_profile
+from seams import group_seams, analyze_seams, write_seam_table
+from image_source import open_image_source, locate_targets, read_seam_region
+from target_center import template_center
+from result_cache import ResultCache, array_digest, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from result_store import ResultStore, row_channels
+from spc import SPCMonitor, format_alarm, print_summary
+from brightness_analysis import brightness_analysis
+from main import detect_correction_points
+from template_store import get_template_store, DEFAULT_TEMPLATE_DIR
+from reporting import ReportWriter, REPORT_MODES
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.npy')
+
+RESULT_FIELDS = [
+    'image', 'status', 'corners', 'delta_e', 'delta_e_2000', 'delta_brightness',
+    'seam_delta_max', 'seam_delta_row', 'seams', 'elapsed', 'error',
+]
+
+# worker process 內共用的狀態，由 _init_worker 設定
+_worker_options = {}
+
+_NO_CACHE = ResultCache(None)
+
+
+def collect_images(inputs):
+    """expand directories and glob patterns into a sorted list of image paths"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        paths.extend(p for p in candidates
+                     if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(set(paths))
+
+
+def load_template(template_path=None, rig_id=None, template_dir=DEFAULT_TEMPLATE_DIR):
+    """
+    Read the template from a file or from the template library
+
+    Return:
+    np.array: gray template, None if it cannot be read
+    list: search regions of the rig profile, None to search the whole image
+    """
+    if template_path:
+        return cv2.imread(template_path, cv2.IMREAD_GRAYSCALE), None
+    if rig_id is None:
+        return None, None
+    entry = get_template_store(template_dir).load(rig_id)
+    if entry is None:
+        return None, None
+    return entry.template, entry.metadata.get('search_regions')
+
+
+def _init_worker(template_source, options, report_mode='off', report_dir='assets/reports',
+                 cache_dir=None, cache_size=DEFAULT_MAX_BYTES):
+    """load the template once per worker process"""
+    # 每個 process 只用一個 OpenCV 執行緒，避免 process 之間搶 CPU
+    cv2.setNumThreads(1)
+    template, search_regions = load_template(*template_source)
+    _worker_options.update(options, template=template, search_regions=search_regions)
+    if cache_dir:
+        _worker_options['cache'] = ResultCache(cache_dir, cache_size)
+    if report_mode != 'off':
+        # 報告不能丟棄，佇列滿時等待；process 正常結束時寫完剩下的報告
+        report = ReportWriter(report_mode, report_dir, drop_when_full=False)
+        util.Finalize(report, report.close, exitpriority=10)
+        _worker_options['report'] = report
+
+
+def _run_pipeline(row, image_path, template, match_mode, search_regions, report, seam_block=None,
+                  cache=None, multi_seam=False, crop=None, image=None):
+    """fill one result row, see analyze_image
+
+    with a cache every stage is keyed by the image content and its own inputs, and the
+    image is only decoded when a stage that needs it is not cached
+    """
+    cache = cache or _NO_CACHE
+    if not cache.enabled:
+        digest = None
+    elif image is not None:
+        digest = array_digest(image)
+    else:
+        digest = cache.file_digest(image_path)
+
+    def decoded():
+        nonlocal image
+        if image is None:
+            image = cache.array(cache.key('image', digest), lambda: load_image(image_path))
+        return image
+
+    def detect():
+        if decoded() is None:
+            return None
+        gray_image = convert_to_gray(image)
+        with metrics.stage('detect'):
+            corners = detect_correction_points(gray_image, template,
+                                               allow_manual=False, save_result=False,
+                                               match_mode=match_mode,
+                                               search_regions=search_regions)
+        return [[int(x), int(y)] for x, y in corners]
+
+    template_digest = array_digest(template) if cache.enabled and template is not None else None
+    corners = cache.json(cache.key('corners', digest, template_digest,
+                                   match_mode, search_regions), detect)
+    if corners is None:
+        row['status'] = 'unreadable'
+        return
+    corners = [tuple(c) for c in corners]
+    if multi_seam and len(corners) > 4:
+        _analyze_seams(row, decoded(), corners, image_path, report, seam_block, crop)
+        return
+    if len(corners) != 4:
+        row['status'] = 'no_corners'
+        row['corners'] = len(corners)
+        return
+
+    row['corners'] = ';'.join(f'{x},{y}' for x, y in corners)
+    # 兩條線的長度可能不同，分成四個陣列快取 (rgb 左、右，positions 左、右)
+    cached = cache.arrays(cache.key('corner_lines', digest, corners),
+                          lambda: tuple(a for part in sample_corner_lines(decoded(), corners) for a in part))
+    lines = (cached[:2], cached[2:])
+    _analyze_corners(row, corners, lines, image_path, report, seam_block,
+                     decoded() if seam_block else None, crop=crop)
+
+
+def _run_pipeline_roi(row, image_path, template, search_regions, report, seam_block, roi_factor,
+                      crop=None):
+    """like _run_pipeline, but only a reduced image and the regions around the targets are read"""
+    try:
+        source = open_image_source(image_path)
+        with metrics.stage('detect'):
+            matches = locate_targets(source, template, roi_factor, search_regions=search_regions)
+    except IOError:
+        row['status'] = 'unreadable'
+        return
+    if len(matches) != 4:
+        row['status'] = 'no_corners'
+        row['corners'] = len(matches)
+        return
+
+    cx, cy = template_center(template)
+    corners = [(x + cx, y + cy) for x, y, _ in matches]
+    row['corners'] = ';'.join(f'{x},{y}' for x, y in corners)
+    region, region_corners, (_, y_offset) = read_seam_region(source, corners)
+    lines = sample_corner_lines(region, region_corners)
+    _analyze_corners(row, region_corners, lines, image_path, report, seam_block, region, y_offset, crop)
+
+
+def _analyze_seams(row, image, corners, image_path, report, seam_block, crop=None):
+    """every seam of a multi-camera panorama, the per seam rows are kept in row['seam_rows']"""
+    seams = group_seams(corners)
+    row['corners'] = ';'.join(f'{x},{y}' for x, y in corners)
+    row['seams'] = len(seams)
+    if not seams:
+        row['status'] = 'no_seams'
+        return
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    # 多個 process 已經平行處理，每張圖片的接縫依序分析
+    row['seam_rows'] = [dict(seam_row, image=image_path)
+                        for seam_row in analyze_seams(image, seams, 1, report, f'{name}_', seam_block,
+                                                       crop)]
+
+
+def _analyze_corners(row, corners, lines, image_path, report, seam_block, image=None, y_offset=0,
+                     crop=None):
+    """
+    color, brightness and seam analysis from the line samples of known corners,
+    the image (or region) is only needed by the seam profile
+    """
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    # 自動分割色帶時，色彩、亮度和色帶表共用同一次分割
+    pairs = segment_lines(lines) if crop == 'auto' else None
+    left_rgb, right_rgb, delta_e = analyze_color_lines(None, corners, report, f'{name}_color', lines, crop, pairs)
+    left_gray, right_gray, delta_brightness = brightness_analysis(None, corners, report,
+                                                                  f'{name}_brightness', lines, crop, pairs)
+    row['channels'] = row_channels(left_rgb, right_rgb, left_gray, right_gray)
+    if crop == 'auto':
+        row['bands'] = analyze_color_bands(None, corners, lines, pairs)
+    row['delta_e'] = f'{delta_e:.4f}'
+    row['delta_e_2000'] = f'{calculate_lab_delta_e(left_rgb, right_rgb):.4f}'
+    row['delta_brightness'] = f'{delta_brightness:.4f}'
+
+    if seam_block:
+        profile = seam_delta_profile(image, corners, block=seam_block)
+        worst_row, worst_delta = profile.worst()
+        row['seam_delta_max'] = f'{worst_delta:.4f}'
+        row['seam_delta_row'] = '' if worst_row is None else worst_row + y_offset
+        if report is not None:
+            report.submit_seam(f'{name}_seam', profile)
+
+
+def analyze_image(image_path, template, verbose=False, match_mode='full', search_regions=None,
+                  report=None, metrics_dir=None, track_memory=False, seam_block=None, roi_factor=None,
+                  cache=None, multi_seam=False, crop=None, image=None):
+    """
+    Run detection, color analysis and brightness analysis on one image without any GUI
+
+    Param:
+    image_path (str): path of the stitched image
+    template (np.array): gray template used by pattern matching
+    verbose (bool): keep the progress messages of the analysis functions
+    match_mode (str): 'full' or 'pyramid' template matching, 'auto' synthesized templates (no template)
+    search_regions (list): expected target regions, None to search the whole image
+    report (ReportWriter): render the charts of this image, None to skip them
+    metrics_dir (str): write the stage metrics to <metrics_dir>/<image name>.json, None to skip them
+    track_memory (bool): also record the peak memory of every stage (slower)
+    seam_block (int): rows per block of the dense seam profile, None to skip it
+    roi_factor (int): detect on an image reduced by this factor and read only the target /
+                      seam regions at full resolution (see image_source), None to load the whole image
+    cache (ResultCache): reuse the decoded image, corners and line samples of earlier runs
+    multi_seam (bool): group more than four targets into seams and analyze every seam,
+                       the per seam results are returned under 'seam_rows'
+    crop: 'auto' to segment the color / gray bands of every image, None for the fixed crop fractions
+    image (np.array): already decoded BGR image, image_path is then only its name (roi_factor is ignored)
+
+    Return:
+    dict: one result row (see RESULT_FIELDS), with the stage metrics under 'metrics' if collected
+    """
+    row = {'image': image_path, 'status': 'ok', 'corners': '',
+           'delta_e': '', 'delta_e_2000': '', 'delta_brightness': '',
+           'seam_delta_max': '', 'seam_delta_row': '', 'seams': '', 'elapsed': '', 'error': ''}
+    start = time.perf_counter()
+
+    log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    collector = (metrics.collect(image_path, track_memory) if metrics_dir
+                 else contextlib.nullcontext())
+    with collector as image_metrics:
+        try:
+            with log:
+                if roi_factor and image is None:
+                    _run_pipeline_roi(row, image_path, template, search_regions, report,
+                                      seam_block, roi_factor, crop)
+                else:
+                    _run_pipeline(row, image_path, template, match_mode, search_regions, report,
+                                  seam_block, cache, multi_seam, crop, image)
+        except Exception as e:
+            row['status'] = 'error'
+            row['error'] = str(e)
+        finally:
+            row['elapsed'] = f'{time.perf_counter() - start:.3f}'
+
+    if image_metrics is not None:
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        image_metrics.write_json(os.path.join(metrics_dir, f'{name}.json'))
+        row['metrics'] = image_metrics.to_dict()
+    return row
+
+
+def _worker_analyze(image_path):
+    return analyze_image(image_path, **_worker_options)
+
+
+def run_batch(image_paths, template_source, output_path, workers=None, verbose=False,
+              match_mode='full', report_mode='off', report_dir='assets/reports',
+              metrics_dir=None, track_memory=False, seam_block=None, roi_factor=None,
+              cache_dir=None, cache_size=DEFAULT_MAX_BYTES, multi_seam=False, crop=None,
+              db_path=None, rig_id=None, spc=None):
+    """
+    Analyze all images on a process pool and write one CSV row per image
+
+    Param:
+    template_source (tuple): (template_path, rig_id, template_dir) passed to load_template
+    match_mode (str): 'full' or 'pyramid' template matching, 'auto' synthesized templates (no template)
+    report_mode (str): 'off', 'preview' or 'full' charts of every image
+    report_dir (str): directory of the charts
+    metrics_dir (str): per image stage metrics and the batch summary (summary.json), None to skip them
+    track_memory (bool): also record the peak memory of every stage
+    seam_block (int): rows per block of the dense seam profile, None to skip it
+    roi_factor (int): region of interest loading, see analyze_image
+    cache_dir (str): result cache directory shared by the workers, None to disable it
+    cache_size (int): maximum size of the cache in bytes
+    multi_seam (bool): analyze every seam of multi-camera panoramas, the per seam table is
+                       written next to the output as <output>_seams.csv
+    crop: 'auto' band segmentation or the fixed crop fractions, see analyze_image
+    db_path (str): also append every result to this ResultStore database, None to skip it
+    rig_id (str): rig of the results in the database (timestamp: modification time of the image)
+    spc (SPCMonitor): drift monitor updated with every result in the order of image_paths
+
+    Return:
+    dict: count of rows per status
+    """
+    workers = workers or os.cpu_count() or 1
+    summary = {}
+    # 每張圖片的 metrics 已經寫成 json 檔，這裡只累積 summary
+    image_metrics = metrics.MetricsSummary()
+    seam_rows = []
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    store = ResultStore(db_path) if db_path else None
+    # SPC 需要依照圖片順序更新，先完成的結果等待前面的圖片
+    order = {path: i for i, path in enumerate(image_paths)} if spc is not None else None
+    pending = {}
+    next_index = 0
+    with open(output_path, 'w', newline='', encoding='utf-8') as f, store or contextlib.nullcontext():
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+
+        options = {'verbose': verbose, 'match_mode': match_mode,
+                   'metrics_dir': metrics_dir, 'track_memory': track_memory,
+                   'seam_block': seam_block, 'roi_factor': roi_factor, 'multi_seam': multi_seam,
+                   'crop': crop}
+        initargs = (template_source, options, report_mode, report_dir, cache_dir, cache_size)
+        with Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            # 小 chunk 讓處理時間不同的圖片也能平均分配到各個 worker
+            chunksize = max(1, len(image_paths) // (workers * 8))
+            for i, row in enumerate(pool.imap_unordered(_worker_analyze, image_paths, chunksize), 1):
+                writer.writerow(row)
+                if store is not None:
+                    store.add_row(rig_id or 'default', row, _capture_time(row['image']))
+                if spc is not None:
+                    pending[order[row['image']]] = row
+                    while next_index in pending:
+                        ordered = pending.pop(next_index)
+                        next_index += 1
+                        for alarm in spc.update_row(ordered):
+                            print(f"{ordered['image']}: {format_alarm(alarm)}")
+                if 'metrics' in row:
+                    image_metrics.add(row['metrics'])
+                seam_rows.extend(row.get('seam_rows', []))
+                summary[row['status']] = summary.get(row['status'], 0) + 1
+                if row['status'] != 'ok':
+                    print(f"⚠ {row['image']}: {row['status']} {row['error']}")
+                if i % 100 == 0:
+                    f.flush()
+                    print(f"processed {i}/{len(image_paths)} images")
+
+            # 正常關閉 worker，讓每個 process 寫完剩下的報告
+            pool.close()
+            pool.join()
+
+    if multi_seam:
+        seams_path = os.path.splitext(output_path)[0] + '_seams.csv'
+        seam_rows.sort(key=lambda r: (r['image'], r['seam']))
+        write_seam_table(seam_rows, seams_path, extra_fields=('image',))
+        print(f"✓ {len(seam_rows)} seam results saved to {seams_path}")
+
+    if metrics_dir:
+        summary_path = os.path.join(metrics_dir, 'summary.json')
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(image_metrics.to_dict(), f, indent=2)
+        print(f"✓ stage metrics saved to {metrics_dir}")
+
+    return summary
+
+
+def _capture_time(image_path):
+    try:
+        return os.path.getmtime(image_path)
+    except OSError:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='headless batch stitching color analysis')
+    parser.add_argument('inputs', nargs='+', help='image directories or glob patterns')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--template', help='gray template of the octagon target')
+    source.add_argument('--rig', help='rig ID of a template in the template library')
+    source.add_argument('--auto', action='store_true',
+                        help='detect the targets with synthesized octagon templates (no template needed)')
+    parser.add_argument('--template-dir', default=DEFAULT_TEMPLATE_DIR,
+                        help='template library directory used with --rig')
+    parser.add_argument('--output', default='batch_results.csv', help='output CSV path')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='coarse-to-fine template matching (faster on large images)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--report', choices=list(REPORT_MODES), default='off',
+                        help='charts of every image: off, preview (low resolution) or full')
+    parser.add_argument('--report-dir', default='assets/reports', help='directory of the charts')
+    parser.add_argument('--metrics', metavar='DIR',
+                        help='write per image stage timings and a batch summary to DIR')
+    parser.add_argument('--metrics-memory', action='store_true',
+                        help='also record the peak memory of every stage (slower)')
+    parser.add_argument('--roi', type=int, metavar='FACTOR',
+                        help='detect on a 1/FACTOR image and read only the target and seam regions '
+                             'at full resolution (large panoramas, memory mapped .npy / TIFF)')
+    parser.add_argument('--cache', metavar='DIR', nargs='?', const=DEFAULT_CACHE_DIR,
+                        help=f'reuse decoded images, corners and line samples of earlier runs '
+                             f'(default directory {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_MAX_BYTES / 1024**3, metavar='GB',
+                        help='maximum cache size, least recently used files are removed first')
+    parser.add_argument('--seams', action='store_true',
+                        help='panoramas with more than four targets: analyze every seam and write '
+                             '<output>_seams.csv')
+    parser.add_argument('--seam', type=int, metavar='ROWS',
+                        help='dense delta E profile along the whole seam, ROWS rows per block')
+    parser.add_argument('--db', metavar='PATH',
+                        help='append every result to a SQLite result store (see result_store.py)')
+    parser.add_argument('--auto-bands', action='store_true',
+                        help='segment the color and gray bands of every image instead of the fixed crop fractions')
+    parser.add_argument('--spc', metavar='STATE',
+                        help='monitor the drift of every seam and channel in image order (EWMA / CUSUM '
+                             'alarms), the statistics are loaded from and saved to this JSON file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep the progress messages of every image')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    template_source = (args.template, args.rig, args.template_dir)
+    if args.auto:
+        match_mode = 'auto'
+        if args.roi:
+            print("⚠ --roi needs a template, the whole images are loaded with --auto")
+            args.roi = None
+    else:
+        match_mode = 'pyramid' if args.pyramid else 'full'
+    if not args.auto and load_template(*template_source)[0] is None:
+        print(f"✗ 錯誤: 無法讀取模板 {args.template or args.rig}")
+        return 1
+
+    image_paths = collect_images(args.inputs)
+    if not image_paths:
+        print("✗ 錯誤: 找不到任何圖片")
+        return 1
+
+    print(f"=== 批次分析 {len(image_paths)} 張圖片 ===")
+    spc = SPCMonitor.load(args.spc) if args.spc else None
+    start = time.perf_counter()
+    summary = run_batch(image_paths, template_source, args.output, args.workers, args.verbose,
+                        match_mode, args.report, args.report_dir,
+                        args.metrics, args.metrics_memory, args.seam, args.roi,
+                        args.cache, int(args.cache_size * 1024**3), args.seams,
+                        'auto' if args.auto_bands else None, args.db, args.rig, spc)
+    elapsed = time.perf_counter() - start
+
+    print(f"✓ 完成 {len(image_paths)} 張圖片，耗時 {elapsed:.1f}s "
+          f"({len(image_paths) / elapsed:.1f} images/s)")
+    print(f"✓ 結果: {summary}")
+    if spc is not None:
+        spc.save(args.spc)
+        print_summary(spc)
+        print(f"✓ SPC 狀態已保存到 {args.spc}")
+    print(f"✓ 已保存到 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+效能測試 - 使用合成影像測量每個階段的耗時並檢查結果的正確性
+
+使用方法：
+    python benchmark.py
+    python benchmark.py --sizes 1200x2000,4000x8000 --repeat 5 --json bench.json
+    python benchmark.py --startup-only        # 只檢查模組的啟動時間
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from synthetic_data import make_stitched_image
+from image_processing import load_image, convert_to_gray, sample_line_rgb, sample_lines_rgb
+from pattern_matching import match_template_full, match_template_pyramid
+from target_center import find_center_by_hough_lines
+from color_analysis import analyze_color_lines, COLOR_CROP
+from color_delta import calculate_color_delta, calculate_lab_delta_e, image_delta_e
+from brightness_analysis import brightness_analysis, calculate_brightness_delta
+from seam_analysis import seam_delta_profile
+from utils import order_corners
+
+DEFAULT_SIZES = '1200x2000,2400x4000'
+
+# 只需要數值結果的模組 (worker 會 import 的)：不能載入 HEAVY_MODULES，
+# import 時間也不能比 numpy + cv2 多超過 STARTUP_BUDGET 秒
+CORE_MODULES = (
+    'image_processing', 'pattern_matching', 'target_center', 'auto_detect', 'color_delta',
+    'color_analysis', 'brightness_analysis', 'seam_analysis', 'seams', 'calibration', 'pipeline',
+    'batch', 'stream', 'service',
+)
+HEAVY_MODULES = ('matplotlib',)
+STARTUP_BUDGET = 0.25
+
+_IMPORT_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def time_stage(fn, repeat):
+    """
+    Run fn repeat times with its progress messages silenced
+
+    Return:
+    float: median wall time in seconds
+    object: the result of the last call
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)), result
+
+
+def match_centers(matches, template_center):
+    """octagon centers of the template matches, sorted like the truth corners"""
+    cx, cy = template_center
+    centers = [(x + cx, y + cy) for x, y, _ in matches]
+    return sorted(centers, key=lambda p: (round(p[1], -1), p[0]))
+
+
+def center_error(found, expected):
+    """largest distance between the found and the expected centers (inf if the count differs)"""
+    if len(found) != len(expected):
+        return float('inf')
+    expected = sorted(expected, key=lambda p: (round(p[1], -1), p[0]))
+    return float(max(np.hypot(fx - ex, fy - ey) for (fx, fy), (ex, ey) in zip(found, expected)))
+
+
+def reference_color_delta(image, corners):
+    """delta E of the fixed color crop with every line sampled on its own, like the original per line loop"""
+    left_top, right_top, left_bottom, right_bottom = order_corners(corners)
+    y = left_bottom[1] - left_top[1]
+    parts = []
+    for (top, bottom), (head, tail) in zip(((left_top, left_bottom), (right_top, right_bottom)), COLOR_CROP):
+        rgb, positions = sample_line_rgb(image, top, bottom)
+        rgb = np.where(rgb > 250, 255, rgb)
+        part = slice(int(head * y), int(y - tail * y))
+        parts += [rgb[part], positions[part]]
+    with contextlib.redirect_stdout(io.StringIO()):
+        return float(calculate_color_delta(*parts))
+
+
+def benchmark_size(height, width, repeat, workdir, seed=0):
+    """
+    Time every stage on one synthetic image and compare the results with the truth
+
+    Return:
+    dict: {'size', 'stages': {name: seconds}, 'accuracy': {...}}
+    """
+    image, truth = make_stitched_image(height, width, seed=seed)
+    template = truth['template']
+    path = os.path.join(workdir, f'synthetic_{height}x{width}.png')
+    cv2.imwrite(path, image)
+
+    stages = {}
+    stages['load_image'], loaded = time_stage(lambda: load_image(path), repeat)
+    stages['convert_to_gray'], gray = time_stage(lambda: convert_to_gray(loaded), repeat)
+    stages['match_template_full'], full_matches = time_stage(
+        lambda: match_template_full(gray, template), repeat)
+    stages['match_template_pyramid'], pyramid_matches = time_stage(
+        lambda: match_template_pyramid(gray, template), repeat)
+    stages['find_center_by_hough_lines'], (hough_center, _) = time_stage(
+        lambda: find_center_by_hough_lines(template), repeat)
+
+    corners = truth['corners']
+    (left_top, right_top, left_bottom, right_bottom) = corners
+    stages['sample_line_rgb'], _ = time_stage(
+        lambda: sample_line_rgb(loaded, left_top, left_bottom), repeat)
+    stages['sample_lines_rgb'], (lines, positions) = time_stage(
+        lambda: sample_lines_rgb(loaded, [(left_top, left_bottom), (right_top, right_bottom)]), repeat)
+    stages['calculate_color_delta'], _ = time_stage(
+        lambda: calculate_color_delta(lines[0], positions[0], lines[1], positions[1]), repeat)
+    stages['calculate_lab_delta_e'], _ = time_stage(
+        lambda: calculate_lab_delta_e(lines[0], lines[1]), repeat)
+    seam = width // 2
+    strip = min(64, seam)
+    stages['image_delta_e'], _ = time_stage(
+        lambda: image_delta_e(loaded[:, seam - strip:seam], loaded[:, seam:seam + strip]), repeat)
+    stages['calculate_brightness_delta'], _ = time_stage(
+        lambda: calculate_brightness_delta(lines[0], lines[1]), repeat)
+    stages['analyze_color_lines'], (_, _, delta_e) = time_stage(
+        lambda: analyze_color_lines(loaded, corners), repeat)
+    stages['brightness_analysis'], (_, _, delta_brightness) = time_stage(
+        lambda: brightness_analysis(loaded, corners), repeat)
+    stages['seam_delta_profile'], _ = time_stage(
+        lambda: seam_delta_profile(loaded, corners, block=8), repeat)
+
+    # 上方兩個 target 不在同一列時兩條線的長度不同，每條線仍要各自每個 pixel 採一次樣
+    misaligned = [left_top, (right_top[0], right_top[1] + height // 20), left_bottom, right_bottom]
+    _, (_, _, misaligned_delta_e) = time_stage(lambda: analyze_color_lines(loaded, misaligned), 1)
+
+    template_center = truth['template_center']
+    accuracy = {
+        'full_match_center_error': center_error(match_centers(full_matches, template_center), corners),
+        'pyramid_match_center_error': center_error(match_centers(pyramid_matches, template_center), corners),
+        'hough_center_error': (float(np.hypot(hough_center[0] - template_center[0],
+                                              hough_center[1] - template_center[1]))
+                               if hough_center else float('inf')),
+        'delta_e': float(delta_e),
+        'expected_delta_e': truth['delta_e'],
+        'delta_e_error': abs(float(delta_e) - truth['delta_e']),
+        'delta_brightness': float(delta_brightness),
+        'expected_delta_brightness': truth['delta_brightness'],
+        'delta_brightness_error': abs(float(delta_brightness) - truth['delta_brightness']),
+        'misaligned_delta_e_error': abs(float(misaligned_delta_e) - reference_color_delta(loaded, misaligned)),
+    }
+    return {'size': f'{height}x{width}', 'stages': stages, 'accuracy': accuracy}
+
+
+def measure_import(module, repeat):
+    """
+    Import a module in a fresh interpreter
+
+    Return:
+    float: fastest import time of repeat runs in seconds
+    list: the HEAVY_MODULES loaded by the import
+    """
+    probe = _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', probe], cwd=cwd, capture_output=True,
+                                text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(run['elapsed'] for run in runs), runs[-1]['heavy']
+
+
+def benchmark_startup(repeat, modules=CORE_MODULES):
+    """
+    Import time of every core module on top of the numpy + cv2 baseline
+
+    Return:
+    dict: {'baseline': seconds, 'modules': {name: {'import': seconds, 'overhead': seconds, 'heavy': [...]}}}
+    """
+    baseline, _ = measure_import('numpy, cv2', repeat)
+    result = {'baseline': baseline, 'modules': {}}
+    for module in modules:
+        elapsed, heavy = measure_import(module, repeat)
+        result['modules'][module] = {'import': elapsed, 'overhead': elapsed - baseline, 'heavy': heavy}
+    return result
+
+
+def check_startup(startup, budget=STARTUP_BUDGET):
+    """return the list of startup failures"""
+    failures = []
+    for module, stats in startup['modules'].items():
+        if stats['heavy']:
+            failures.append(f"{module}: imports {', '.join(stats['heavy'])}")
+        if stats['overhead'] > budget:
+            failures.append(f"{module}: import overhead {stats['overhead'] * 1000:.0f}ms > {budget * 1000:.0f}ms")
+    return failures
+
+
+def print_startup(startup):
+    print(f"\n{'startup (numpy + cv2: ' + format(startup['baseline'] * 1000, '.0f') + 'ms)':<30}"
+          f"{'import':>14}{'overhead':>14}  heavy")
+    print('-' * 66)
+    for module, stats in startup['modules'].items():
+        print(f"{module:<30}{stats['import'] * 1000:>12.1f}ms{stats['overhead'] * 1000:>12.1f}ms  "
+              f"{', '.join(stats['heavy']) or '-'}")
+
+
+def check_accuracy(results, center_tolerance=3.0, delta_tolerance=0.5):
+    """return the list of accuracy failures"""
+    failures = []
+    for result in results:
+        acc = result['accuracy']
+        for key in ('full_match_center_error', 'pyramid_match_center_error', 'hough_center_error'):
+            if acc[key] > center_tolerance:
+                failures.append(f"{result['size']}: {key} = {acc[key]:.2f} px")
+        for key in ('delta_e_error', 'delta_brightness_error', 'misaligned_delta_e_error'):
+            if acc[key] > delta_tolerance:
+                failures.append(f"{result['size']}: {key} = {acc[key]:.3f}")
+    return failures
+
+
+def print_report(results):
+    sizes = [r['size'] for r in results]
+    print(f"\n{'stage':<30}" + ''.join(f'{s:>14}' for s in sizes))
+    print('-' * (30 + 14 * len(sizes)))
+    for stage in results[0]['stages']:
+        print(f'{stage:<30}' + ''.join(f"{r['stages'][stage] * 1000:>12.3f}ms" for r in results))
+
+    print(f"\n{'accuracy':<30}" + ''.join(f'{s:>14}' for s in sizes))
+    print('-' * (30 + 14 * len(sizes)))
+    for key in results[0]['accuracy']:
+        print(f'{key:<30}' + ''.join(f"{r['accuracy'][key]:>14.4f}" for r in results))
+
+
+def parse_sizes(text):
+    return [tuple(int(v) for v in size.lower().split('x')) for size in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark every pipeline stage on synthetic images')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='HEIGHTxWIDTH,... of the synthetic images')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage (median is reported)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this json file')
+    parser.add_argument('--startup-only', action='store_true',
+                        help='only check the import time of the core modules')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET, metavar='SECONDS',
+                        help='allowed import time of a core module on top of numpy + cv2')
+    args = parser.parse_args(argv)
+
+    results = []
+    if not args.startup_only:
+        with tempfile.TemporaryDirectory() as workdir:
+            for height, width in parse_sizes(args.sizes):
+                print(f"benchmark {height}x{width} ...")
+                results.append(benchmark_size(height, width, args.repeat, workdir, args.seed))
+        print_report(results)
+
+    print("benchmark startup ...")
+    startup = benchmark_startup(args.repeat)
+    print_startup(startup)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'sizes': results, 'startup': startup} if results else {'startup': startup}, f, indent=2)
+        print(f"\n✓ results saved to {args.json}")
+
+    status = 0
+    failures = check_accuracy(results)
+    if failures:
+        print("\n✗ accuracy check failed:")
+        for failure in failures:
+            print(f"  - {failure}")
+        status = 1
+    elif results:
+        print("\n✓ accuracy check passed")
+
+    failures = check_startup(startup, args.startup_budget)
+    if failures:
+        print("\n✗ startup check failed:")
+        for failure in failures:
+            print(f"  - {failure}")
+        status = 1
+    else:
+        print("✓ startup check passed")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
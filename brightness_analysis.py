@@ -1,44 +1,57 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from image_processing import sample_line_rgb
-from visualization import plot_rgb_analysis
+from image_processing import sample_corner_lines
+from color_delta import masked_channel_means
+from color_analysis import crop_lines
+from utils import order_corners
+import metrics
 
-def brightness_analysis(image, corners):
-    """分析校正點之間的線段RGB值變化，重點關注亮度分析"""
-    if len(corners) != 4:
-        print(f"⚠ 需要4個校正點，當前只有{len(corners)}個")
-        return
-    
-    print("=== 亮度分析 ===")
-    
-    # 根據座標判斷四個點的位置關係
-    # 按y座標排序，前兩個是上方的點，後兩個是下方的點
-    sorted_corners = sorted(corners, key=lambda p: p[1])
-    top_points = sorted(sorted_corners[:2], key=lambda p: p[0])  # 按x座標排序
-    bottom_points = sorted(sorted_corners[2:], key=lambda p: p[0])
-    
-    left_top = top_points[0]      # 左上
-    right_top = top_points[1]     # 右上
-    left_bottom = bottom_points[0]  # 左下
-    right_bottom = bottom_points[1] # 右下
+# (開頭, 結尾) 裁掉的比例，(左線, 右線)
+BRIGHTNESS_CROP = ((0.65, 0.2), (0.75, 0.1))
 
+def brightness_profiles(corners, lines, crop=None, pairs=None):
+    """
+    亮度分析比較的部分：大於 250 的值設為 255 (計算時跳過)，再依 crop 裁切
 
-    left_line_rgb, left_positions = sample_line_rgb(image, left_top, left_bottom)
-    right_line_rgb, right_positions = sample_line_rgb(image, right_top, right_bottom)
-    
+    crop 為 'auto' 時自動分割出灰色色帶，否則是裁掉的比例，預設 BRIGHTNESS_CROP
+
+    Return:
+    tuple: left_rgb, left_positions, right_rgb, right_positions
+    """
+    left_top, right_top, left_bottom, right_bottom = order_corners(corners)
+    (left_line_rgb, right_line_rgb), positions = lines
 
-    left_line_rgb[left_line_rgb > 250] = 255
-    right_line_rgb[right_line_rgb > 250] = 255
+    left_line_rgb = np.where(left_line_rgb > 250, 255, left_line_rgb)
+    right_line_rgb = np.where(right_line_rgb > 250, 255, right_line_rgb)
     
     y = left_bottom[1] - left_top[1]
 
-    left_line_rgb = left_line_rgb[int(0.65*y):int(y - 0.2 * y)]
-    left_positions = left_positions[int(0.65*y):int(y - 0.2 * y)]
+    cropped = crop_lines(((left_line_rgb, right_line_rgb), positions), y, crop or BRIGHTNESS_CROP, 'gray', pairs)
+    if cropped is None:
+        print("⚠ 兩條線上找不到對應的灰色色帶，使用固定裁切比例")
+        cropped = crop_lines(((left_line_rgb, right_line_rgb), positions), y, BRIGHTNESS_CROP, 'gray')
+    return cropped
 
-    right_line_rgb = right_line_rgb[int(0.75*y):int(y - 0.1 * y)]
-    right_positions = right_positions[int(0.75*y):int(y - 0.1 * y)]
+def brightness_analysis(image, corners, report=None, name='brightness', lines=None, crop=None,
+                        pairs=None):
+    """分析校正點之間的線段RGB值變化，重點關注亮度分析
 
-    plot_rgb_analysis(left_line_rgb, left_positions, right_line_rgb, right_positions)
+    有 ReportWriter 時才會繪製圖表，保存為 <name>_rgb_*.png；
+    lines 是已經取得的 sample_corner_lines 採樣結果（此時不會讀取 image）；
+    crop 為 'auto' 時自動分割出灰色色帶，否則是裁掉的比例，預設 BRIGHTNESS_CROP；
+    pairs 是已經取得的 segment_lines 分割結果 (和色彩分析共用)
+    """
+    if len(corners) != 4:
+        print(f"⚠ 需要4個校正點，當前只有{len(corners)}個")
+        return
+    
+    print("=== 亮度分析 ===")
+
+    if lines is None:
+        lines = sample_corner_lines(image, corners)
+    left_line_rgb, left_positions, right_line_rgb, right_positions = brightness_profiles(corners, lines, crop, pairs)
+
+    if report is not None:
+        report.submit(name, left_line_rgb, left_positions, right_line_rgb, right_positions)
 
     delta_e = calculate_brightness_delta(left_line_rgb, right_line_rgb)
     return left_line_rgb, right_line_rgb, delta_e
@@ -52,33 +65,10 @@ def calculate_brightness_delta(left_rgb, right_rgb):
     right_rgb (np.array): right line rgb data
     """
     print("\n=== brightness difference analysis ===")
-    left_rgb_float = left_rgb.astype(np.float64)
-    right_rgb_float = right_rgb.astype(np.float64)
-
-    # 1. Calculate the brightness value (using the standard brightness formula: Y = 0.299*R + 0.587*G + 0.114*B)
-    left_brightness = calculate_luminance(left_rgb_float)
-    right_brightness = calculate_luminance(right_rgb_float)
-
-    left_brightness_mean = 0
-    left_brightness_cnt = 0
-    for i in range(len(left_rgb_float)):
-        if(left_rgb_float[i][0] == 255):
-            continue
-        else:
-            left_brightness_mean += left_rgb_float[i][0]
-            left_brightness_cnt += 1
-    left_brightness_mean /= left_brightness_cnt
+    # the gray band has R == G == B, only the first channel is compared
+    with metrics.stage('brightness_delta'):
+        (left_brightness_mean, _, _), (right_brightness_mean, _, _) = masked_channel_means([left_rgb, right_rgb])
     print(f"left_brightness_mean: {left_brightness_mean}")
-
-    right_brightness_mean = 0
-    right_brightness_cnt = 0
-    for i in range(len(right_rgb_float)):
-        if(right_rgb_float[i][0] == 255):
-            continue
-        else:
-            right_brightness_mean += right_rgb_float[i][0]
-            right_brightness_cnt += 1
-    right_brightness_mean /= right_brightness_cnt   
     print(f"right_brightness_mean: {right_brightness_mean}")
     delta_brightness = right_brightness_mean - left_brightness_mean
     print(f"delta_brightness: {delta_brightness}")
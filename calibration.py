@@ -1,7 +1,12 @@
 import cv2
 import numpy as np
 import os
-from target_center import find_center_by_contours, find_center_by_hough_lines, find_center_by_corners
+import metrics
+from target_center import template_center
+from template_store import get_template_store
+from pattern_matching import match_template_full, match_template_pyramid, refine_subpixel
+from auto_detect import get_default_bank
+from visualization import save_image, draw_matches
 
 def extract_target_manually(image):
     print("=== select target region ===")
@@ -36,10 +41,46 @@ def extract_target_manually(image):
         print(f"⚠ failed to select target region: {e}")
         return None
 
-def find_octagon_pattern_matching(image):
+def load_or_extract_template(image, rig_id, allow_manual=True):
+    """get the template of rig_id from the template library, ask the operator only the first time"""
+    store = get_template_store()
+    entry = store.load(rig_id)
+    if entry is not None:
+        print(f"✓ loaded template of {rig_id}: size({entry.template.shape[1]}x{entry.template.shape[0]})")
+        return entry.template
+
+    if not allow_manual:
+        print(f"⚠ no template stored for {rig_id}")
+        return None
+
+    target = extract_target_manually(image)
+    if target is not None:
+        store.save(rig_id, target, {'source': 'manual'})
+    return target
+
+def find_octagon_pattern_matching(image, target=None, save_result=True, mode='full',
+                                  search_regions=None, center=None, subpixel=False, writer=None,
+                                  matches=None):
+    """find the octagon targets by template matching
+
+    Param:
+    image (np.array): gray image
+    target (np.array): gray template, ask the operator to select one if None
+    save_result (bool): write assets/pattern_matching_result.png
+    mode (str): 'full' full resolution search, 'pyramid' coarse-to-fine search
+    search_regions (list): [(x, y, w, h), ...] expected top left positions of the
+                           targets, e.g. from the previous frame or the rig profile
+    center (tuple): center of the target in the template (e.g. TemplateEntry.center),
+                    computed once per template by template_center if None
+    subpixel (bool): refine every match to sub-pixel precision, the centers are floats then
+    writer (ImageWriter): write the result image in the background instead of now
+    matches (list): receives the (x, y, w, h, score) box of every match, e.g. for
+                    visualization.compose_overlay when the result image is not saved
+    """
     print("=== pattern matching ===")
     
-    target = extract_target_manually(image)
+    if target is None:
+        target = extract_target_manually(image)
     if target is None:
         print("⚠ failed to get target template, cannot perform matching")
         return []
@@ -50,57 +91,31 @@ def find_octagon_pattern_matching(image):
         print("⚠ template size is too large, cannot perform matching")
         return []
 
-    result = cv2.matchTemplate(image, target, cv2.TM_CCOEFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-    
-    
-    if max_val < 0.3:
-        threshold = max_val * 0.8
-        print(f"best matching score is too low, adjust threshold to: {threshold:.3f}")
-    elif max_val < 0.6:
-        threshold = 0.4
-        print(f"use medium threshold: {threshold:.3f}")
+    if mode == 'pyramid':
+        filtered_matches = match_template_pyramid(image, target, search_regions=search_regions)
     else:
-        threshold = 0.6
-        print(f"use standard threshold: {threshold:.3f}")
-    
-    locations = np.where(result >= threshold)
-
-    print(f"found {len(locations[0])} matching positions")
-
-    # for y_pos, x_pos in zip(locations[0], locations[1]):
-    #     cv2.rectangle(image, (x_pos, y_pos), (x_pos + w, y_pos + h), (0, 255, 0), 2)
-
-    # 5. 過濾重複匹配 - 改進版本：在相近的匹配中選擇最佳的
-    all_matches = []
-    min_distance = min(w, h) // 2
-    
-    # 先收集所有匹配
-    for y_pos, x_pos in zip(locations[0], locations[1]):
-        match_score = result[y_pos, x_pos]
-        all_matches.append((x_pos, y_pos, match_score))
-    
-    # 按得分排序（從高到低）
-    all_matches.sort(key=lambda x: x[2], reverse=True)
-    
-    filtered_matches = []
-    
-    for x_pos, y_pos, match_score in all_matches:
-        # 檢查是否與已選中的匹配太接近
-        is_duplicate = False
-        for existing_x, existing_y, _ in filtered_matches:
-            distance = np.sqrt((x_pos - existing_x)**2 + (y_pos - existing_y)**2)
-            if distance < min_distance:
-                is_duplicate = True
-                break
-        
-        # 如果不重複，或者這是該區域得分最高的，就保留
-        if not is_duplicate:
-            filtered_matches.append((x_pos, y_pos, match_score))
+        filtered_matches = match_template_full(image, target, search_regions)
     
     print(f"found {len(filtered_matches)} valid matches")
+    metrics.count('filtered_matches', len(filtered_matches))
+
+    # 每個 match 都是同一個模板，中心點只需要在模板上計算一次
+    if center is None:
+        with metrics.stage('center'):
+            center = template_center(target)
+    print(f"center: {center}")
+    if subpixel:
+        refined_matches = refine_subpixel(image, target, filtered_matches)
+    else:
+        refined_matches = filtered_matches
     
-    result_image = cv2.cvtColor(image.copy(), cv2.COLOR_GRAY2BGR)
+    # 結果圖只在需要保存時才建立 (cvtColor 會產生新的陣列，原始影像不會被修改)
+    result_image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if save_result else None
+    boxes = [(x, y, w, h, score) for x, y, score in filtered_matches]
+    if result_image is not None:
+        draw_matches(result_image, boxes)
+    if matches is not None:
+        matches.extend(boxes)
     all_corners = []
     center_of_octagon = []
     for i, (x, y, score) in enumerate(filtered_matches):
@@ -113,21 +128,17 @@ def find_octagon_pattern_matching(image):
             (x, y + h)        # bottom left
         ]
         all_corners.extend(corners)
-        
-        cv2.rectangle(result_image, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        cv2.putText(result_image, f'Match{i+1}: {score:.2f}', 
-                   (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+
+        rx, ry, _ = refined_matches[i]
+        center_of_octagon.append((rx + center[0], ry + center[1]))
+        if result_image is None:
+            continue
         
         for j, (cx, cy) in enumerate(corners):
             cv2.circle(result_image, (cx, cy), 5, (0, 0, 255), -1)
             cv2.putText(result_image, f'P{j+1}', 
                        (cx + 5, cy - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 0, 0), 1)
 
-        roi = image[y:y+h, x:x+w]
-        center, result = find_center_by_hough_lines(roi)
-        print(f"center: {center}")
-
-        center_of_octagon.append((x+center[0], y+center[1]))
         cv2.circle(result_image, (x+center[0], y+center[1]), 5, (0, 0, 255), -1)
         cv2.putText(result_image, f'O{i+1}', 
                    (x+center[0]+5, y+center[1]-5), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 0, 0), 1)
@@ -136,35 +147,83 @@ def find_octagon_pattern_matching(image):
         print("⚠ found less than 4 corners, cannot perform calibration")
         return []
 
-    cv2.imwrite('assets/pattern_matching_result.png', result_image)
     print(f"✓ pattern matching completed, found {len(all_corners)} corners")
-    print("✓ result saved to assets/pattern_matching_result.png")
+    if save_result:
+        path = save_image(result_image, 'assets/pattern_matching_result.png', writer)
+        print(f"✓ result saved to {path}")
     
     return center_of_octagon
 
-def find_octagon_manual(image):
-    """manual marking 4 correction points"""
-    print("=== manual marking correction points ===")
-    print(f"image size: {image.shape}")
-    
-    # check environment
+def has_display():
+    """whether the GUI functions (selectROI, imshow) can be used"""
     is_ssh = 'SSH_CONNECTION' in os.environ or 'SSH_CLIENT' in os.environ
-    has_display = (
+    return (
         'DISPLAY' in os.environ or 
         'WAYLAND_DISPLAY' in os.environ or 
         os.name == 'nt'
     ) and not is_ssh
+
+def find_octagon_automatic(image, bank=None, save_result=True, subpixel=False, min_score=None,
+                           writer=None, matches=None):
+    """find the octagon targets without any template or GUI
+
+    Param:
+    image (np.array): gray image
+    bank (TemplateBank): templates to search, default the synthesized bank of the image size
+    save_result (bool): write assets/automatic_detection_result.png
+    subpixel (bool): sub-pixel centers
+    min_score (float): minimum normalized correlation, default auto_detect.DEFAULT_MIN_SCORE
+    writer (ImageWriter): write the result image in the background instead of now
+    matches (list): receives the (x, y, w, h, score) box of every target, see
+                    find_octagon_pattern_matching
+    """
+    print("=== automatic detection ===")
+    bank = bank or get_default_bank(image.shape)
+    options = {} if min_score is None else {'min_score': min_score}
+    with metrics.stage('detect_auto'):
+        targets = bank.locate(image, subpixel=subpixel, **options)
+    print(f"found {len(targets)} targets")
+    metrics.count('filtered_matches', len(targets))
+
+    result_image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if save_result else None
+    for i, target in enumerate(targets):
+        print(f"target {i+1}: center({target.x},{target.y}), size {target.template.shape[0]}, "
+              f"score: {target.score:.3f}")
+        if result_image is not None:
+            center = (int(round(target.x)), int(round(target.y)))
+            cv2.circle(result_image, center, target.template.shape[0] // 2, (0, 255, 0), 2)
+            cv2.circle(result_image, center, 5, (0, 0, 255), -1)
+            cv2.putText(result_image, f'O{i+1}: {target.score:.2f}', (center[0] + 5, center[1] - 5),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1)
+
+    if matches is not None:
+        for target in targets:
+            (h, w), (cx, cy) = target.template.shape[:2], target.center
+            matches.append((target.x - cx, target.y - cy, w, h, target.score))
+
+    if len(targets) < 4:
+        print("⚠ found less than 4 targets, cannot perform calibration")
+        return []
+    if save_result:
+        path = save_image(result_image, 'assets/automatic_detection_result.png', writer)
+        print(f"✓ result saved to {path}")
+    return [(target.x, target.y) for target in targets]
+
+def find_octagon_manual(image, writer=None):
+    """manual marking 4 correction points"""
+    print("=== manual marking correction points ===")
+    print(f"image size: {image.shape}")
     
-    if has_display:
-        return find_octagon_manual_gui(image)
+    if has_display():
+        return find_octagon_manual_gui(image, writer)
     else:
         print("⚠ no graphical environment")
         print("tips:")
         print("1. make sure to run in a graphical environment")
-        print("2. or use template matching function")
+        print("2. or use template matching / automatic detection")
         return []
 
-def find_octagon_manual_gui(image):
+def find_octagon_manual_gui(image, writer=None):
     """GUI version of manual marking"""
     print("start GUI, please click to select 4 correction points, press ESC to end")
     
@@ -203,14 +262,14 @@ def find_octagon_manual_gui(image):
             print(f"✓ manual selection completed: {points}")
             
             # 保存結果
-            result_image = cv2.cvtColor(image.copy(), cv2.COLOR_GRAY2BGR)
+            result_image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
             for i, (x, y) in enumerate(points):
                 cv2.circle(result_image, (x, y), 8, (0, 255, 0), -1)
                 cv2.putText(result_image, f'P{i+1}', (x+10, y-10), 
                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
             
-            cv2.imwrite('assets/manual_selection_result.png', result_image)
-            print("✓ result saved to assets/manual_selection_result.png")
+            path = save_image(result_image, 'assets/manual_selection_result.png', writer)
+            print(f"✓ result saved to {path}")
             
         return points
         
@@ -1,44 +1,323 @@
+from dataclasses import dataclass
+
 import numpy as np
-from image_processing import sample_line_rgb
-from visualization import plot_rgb_analysis
-from color_delta import calculate_color_delta
+from numpy.lib.stride_tricks import sliding_window_view
+from image_processing import sample_corner_lines
+from color_delta import calculate_color_delta, rgb_to_lab, delta_e_ciede2000
+from utils import order_corners
+import metrics
+
+# fixed crop of the sampled lines as (cut at the start, cut at the end) fractions of the
+# height between the targets: (left line, right line)
+COLOR_CROP = ((0.1, 0.35), (0.2, 0.25))
+
+# a band is gray when the spread of its mean R, G, B is below this value
+GRAY_TOLERANCE = 12.0
+# smallest step (Euclidean RGB distance) that is a band boundary, whatever the noise
+MIN_STEP = 6.0
+# a boundary must also be this many noise standard deviations above the noise of the step
+STEP_SIGMAS = 6.0
+# aligned bands whose mean colors differ more than this are not paired
+MAX_BAND_DELTA = 60.0
+
+SATURATION_LIMIT = 250
+
+
+@dataclass
+class ColorBand:
+    """one homogeneous band of a sampled profile"""
+    start: int          # first sample of the band (index into the profile)
+    end: int            # one past the last sample
+    rgb: np.ndarray     # mean RGB, saturated samples skipped
+    kind: str           # 'color' or 'gray'
+
+    @property
+    def length(self):
+        return self.end - self.start
+
+
+def _noise_sigma(values):
+    """robust per sample noise (MAD of the first differences), the largest of the channels"""
+    diff = np.diff(values, axis=0)
+    mad = np.median(np.abs(diff - np.median(diff, axis=0)), axis=0)
+    return float(np.max(1.4826 * mad / np.sqrt(2)))
+
+
+def find_change_points(values, window, threshold=None):
+    """
+    Boundaries where the mean of the `window` samples before and after differs most
+
+    Param:
+    values (np.array): profile (N x 3)
+    window (int): samples on each side of a boundary
+    threshold (float): minimum step, default from the estimated noise of the profile
+
+    Return:
+    np.array: sample indices of the boundaries (a band starts at every index)
+    """
+    csum = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+    boundaries = np.arange(window, len(values) - window + 1)
+    before = (csum[boundaries] - csum[boundaries - window]) / window
+    after = (csum[boundaries + window] - csum[boundaries]) / window
+    step = np.linalg.norm(after - before, axis=1)
+
+    if threshold is None:
+        # 兩個 window 平均之差的雜訊，三個 channel 合起來
+        noise = _noise_sigma(values) * np.sqrt(2.0 / window) * np.sqrt(values.shape[1])
+        threshold = max(MIN_STEP, STEP_SIGMAS * noise)
+
+    # 只保留 ±window 範圍內的最大值
+    padded = np.pad(step, window, constant_values=-np.inf)
+    local_max = sliding_window_view(padded, 2 * window + 1).max(axis=1)
+    peaks = np.flatnonzero((step >= threshold) & (step == local_max))
+    # 平頂的峰只留第一個
+    peaks = peaks[np.concatenate([[True], np.diff(peaks) > window])] if len(peaks) else peaks
+    return boundaries[peaks]
+
+
+def detect_color_bars_automatically(profile, window=None, min_length=None, threshold=None,
+                                    gray_tolerance=GRAY_TOLERANCE, saturation=SATURATION_LIMIT,
+                                    keep_ends=False):
+    """
+    Segment a sampled RGB profile into homogeneous color and gray bands
+
+    The boundaries are the peaks of the difference between the moving means before
+    and after every sample (from one cumulative sum), so the whole profile is
+    segmented in one vectorized pass; the samples next to a boundary are dropped
+    as transition.
+
+    Param:
+    profile (np.array): RGB samples along one line (N x 3)
+    window (int): samples on each side of a boundary, default 1% of the profile (at least 4)
+    min_length (int): shortest band kept, default 5% of the profile
+    threshold (float): minimum step between bands, default from the noise of the profile
+    gray_tolerance (float): maximum spread of R, G, B of a gray band
+    saturation (int): samples with a channel above it are skipped
+    keep_ends (bool): keep the bands touching the ends of the line (the targets are there)
+
+    Return:
+    list: ColorBand objects in profile order
+    """
+    profile = np.asarray(profile, dtype=np.float64)
+    with metrics.stage('band_segmentation'):
+        valid = np.flatnonzero(np.all(profile <= saturation, axis=1))
+        values = profile[valid]
+        n = len(values)
+        window = window or max(4, n // 100)
+        min_length = min_length or max(2 * window, n // 20)
+        if n < 2 * window + 1:
+            return []
+
+        cuts = find_change_points(values, window, threshold)
+        edges = np.concatenate([[0], cuts, [n]])
+        starts = edges[:-1] + window
+        ends = edges[1:] - window
+        # 線段兩端沒有過渡區
+        starts[0], ends[-1] = 0, n
+        if not keep_ends:
+            starts, ends = starts[1:-1], ends[1:-1]
+        keep = ends - starts >= min_length
+        starts, ends = starts[keep], ends[keep]
+        if len(starts) == 0:
+            return []
+
+        csum = np.concatenate([np.zeros((1, 3)), np.cumsum(values, axis=0)])
+        means = (csum[ends] - csum[starts]) / (ends - starts)[:, None]
+        gray = np.ptp(means, axis=1) < gray_tolerance
+        metrics.count('color_bands', len(starts))
+
+    return [ColorBand(int(valid[s]), int(valid[e - 1]) + 1, mean, 'gray' if g else 'color')
+            for s, e, mean, g in zip(starts, ends, means, gray)]
+
+
+def align_color_samples(left_bands, right_bands, max_delta=MAX_BAND_DELTA):
+    """
+    Pair the bands of the left and the right line
+
+    Sequence alignment (the band order is kept) where pairing two bands costs the
+    distance of their mean colors and leaving a band unpaired costs max_delta / 2,
+    so only bands of the same kind and closer than max_delta are paired; the bands
+    may start at different rows on both sides.
+
+    Return:
+    list: [(left ColorBand, right ColorBand), ...]
+    """
+    m, n = len(left_bands), len(right_bands)
+    if m == 0 or n == 0:
+        return []
+    gap = max_delta / 2
+    left_rgb = np.array([b.rgb for b in left_bands])
+    right_rgb = np.array([b.rgb for b in right_bands])
+    distance = np.linalg.norm(left_rgb[:, None] - right_rgb[None], axis=-1)
+    same_kind = np.array([[l.kind == r.kind for r in right_bands] for l in left_bands])
+    distance = np.where(same_kind & (distance <= max_delta), distance, np.inf)
+
+    cost = np.zeros((m + 1, n + 1))
+    cost[:, 0] = gap * np.arange(m + 1)
+    cost[0, :] = gap * np.arange(n + 1)
+    for i in range(1, m + 1):
+        for j in range(1, n + 1):
+            cost[i, j] = min(cost[i - 1, j - 1] + distance[i - 1, j - 1],
+                             cost[i - 1, j] + gap, cost[i, j - 1] + gap)
+
+    pairs = []
+    i, j = m, n
+    while i > 0 and j > 0:
+        if cost[i, j] == cost[i - 1, j - 1] + distance[i - 1, j - 1]:
+            pairs.append((left_bands[i - 1], right_bands[j - 1]))
+            i, j = i - 1, j - 1
+        elif cost[i, j] == cost[i - 1, j] + gap:
+            i -= 1
+        else:
+            j -= 1
+    return pairs[::-1]
+
 
-def analyze_color_lines(image, corners):
-    """analyze the RGB value change between the correction points"""
+def band_deltas(pairs):
+    """
+    Differences of every aligned band pair, all pairs at once
+
+    Return:
+    list: [{'kind', 'left', 'right', 'left_rgb', 'right_rgb', 'delta_e', 'delta_e_2000',
+            'delta_brightness'}, ...], left / right are (start, end) sample ranges
+    """
+    if not pairs:
+        return []
+    left_rgb = np.array([l.rgb for l, _ in pairs])
+    right_rgb = np.array([r.rgb for _, r in pairs])
+    delta_e = np.linalg.norm(right_rgb - left_rgb, axis=1)
+    delta_e_2000 = delta_e_ciede2000(rgb_to_lab(left_rgb), rgb_to_lab(right_rgb))
+    # 和 calculate_brightness_delta 一樣使用第一個 channel
+    delta_brightness = right_rgb[:, 0] - left_rgb[:, 0]
+    return [{'kind': l.kind, 'left': (l.start, l.end), 'right': (r.start, r.end),
+             'left_rgb': l.rgb, 'right_rgb': r.rgb, 'delta_e': float(de),
+             'delta_e_2000': float(de2000), 'delta_brightness': float(db)}
+            for (l, r), de, de2000, db in zip(pairs, delta_e, delta_e_2000, delta_brightness)]
+
+
+def segment_lines(lines, **options):
+    """
+    Segment both sampled lines into bands and align them
+
+    the pairs are shared by the color crop, the gray crop and the band table of a frame
+    (saturated samples are skipped, so the clipped and the raw samples give the same bands);
+    options are passed to detect_color_bars_automatically
+
+    Return:
+    list: aligned (left, right) ColorBand pairs, see align_color_samples
+    """
+    (left_line_rgb, right_line_rgb), _ = lines
+    return align_color_samples(detect_color_bars_automatically(left_line_rgb, **options),
+                               detect_color_bars_automatically(right_line_rgb, **options))
+
+
+def analyze_color_bands(image, corners, lines=None, pairs=None, **options):
+    """
+    Segment both lines into bands, align them and compute the difference of every band
+
+    pairs are the segment_lines output if already known, options are passed to
+    detect_color_bars_automatically
+
+    Return:
+    list: see band_deltas
+    """
+    if pairs is None:
+        if lines is None:
+            lines = sample_corner_lines(image, corners)
+        pairs = segment_lines(lines, **options)
+    return band_deltas(pairs)
+
+
+def print_band_table(bands):
+    print(f"{'band':>4} {'kind':>6} {'left':>11} {'right':>11} {'delta_e':>8} {'de2000':>8} {'brightness':>10}")
+    for i, band in enumerate(bands):
+        print(f"{i:>4} {band['kind']:>6} {band['left'][0]:>5}-{band['left'][1]:<5} "
+              f"{band['right'][0]:>5}-{band['right'][1]:<5} {band['delta_e']:>8.3f} "
+              f"{band['delta_e_2000']:>8.3f} {band['delta_brightness']:>10.3f}")
+
+
+def crop_lines(lines, height, crop, kind, pairs=None):
+    """
+    Cut the part of both sampled lines that is compared
+
+    Param:
+    lines (tuple): sample_corner_lines output
+    height (float): height between the top and the bottom targets
+    crop: ((left start, left end), (right start, right end)) fractions cut off, or 'auto'
+          for the longest aligned band of this kind (fixed crop fractions are not needed)
+    kind (str): 'color' or 'gray', the band used by crop='auto'
+    pairs (list): segment_lines output of these lines, segmented here if None
+
+    Return:
+    tuple: left_rgb, left_positions, right_rgb, right_positions
+           (None if crop='auto' and no band of this kind is found on both sides)
+    """
+    (left_line_rgb, right_line_rgb), (left_positions, right_positions) = lines
+    if crop == 'auto':
+        if pairs is None:
+            pairs = segment_lines(lines)
+        pairs = [(l, r) for l, r in pairs if l.kind == kind]
+        if not pairs:
+            return None
+        left, right = max(pairs, key=lambda p: min(p[0].length, p[1].length))
+        return (left_line_rgb[left.start:left.end], left_positions[left.start:left.end],
+                right_line_rgb[right.start:right.end], right_positions[right.start:right.end])
+
+    (left_head, left_tail), (right_head, right_tail) = crop
+    y = height
+    left = slice(int(left_head * y), int(y - left_tail * y))
+    right = slice(int(right_head * y), int(y - right_tail * y))
+    return left_line_rgb[left], left_positions[left], right_line_rgb[right], right_positions[right]
+
+
+def color_profiles(corners, lines, crop=None, pairs=None):
+    """
+    The compared part of both lines of the color analysis
+
+    values above 250 are set to 255 (skipped by the color difference), then the lines
+    are cropped: crop is 'auto' or the fixed fractions, default COLOR_CROP, see crop_lines
+
+    Return:
+    tuple: left_rgb, left_positions, right_rgb, right_positions
+    """
+    left_top, right_top, left_bottom, right_bottom = order_corners(corners)
+    (left_line_rgb, right_line_rgb), positions = lines
+
+    # filter out values greater than 250, and set values greater than 250 to 300 (because the maximum value of RGB is 255)
+    # (new arrays, the shared samples are not modified)
+    left_line_rgb = np.where(left_line_rgb > 250, 255, left_line_rgb)
+    right_line_rgb = np.where(right_line_rgb > 250, 255, right_line_rgb)
+    # fixed crop: for the left line cut off the first 10% and the last 35%,
+    # for the right line cut off the first 20% and the last 25%
+    y = left_bottom[1] - left_top[1]
+    cropped = crop_lines(((left_line_rgb, right_line_rgb), positions), y, crop or COLOR_CROP, 'color', pairs)
+    if cropped is None:
+        print("⚠ no color band found on both lines, using the fixed crop")
+        cropped = crop_lines(((left_line_rgb, right_line_rgb), positions), y, COLOR_CROP, 'color')
+    return cropped
+
+
+def analyze_color_lines(image, corners, report=None, name='color', lines=None, crop=None, pairs=None):
+    """analyze the RGB value change between the correction points
+
+    the charts are only rendered when a ReportWriter is given, they are saved as <name>_rgb_*.png;
+    lines are the samples of sample_corner_lines if they are already known (image is not read then);
+    crop is 'auto' (segment the color band, see detect_color_bars_automatically) or the
+    fractions cut off the lines, default COLOR_CROP; pairs are the segment_lines output
+    of the lines if already known
+    """
     if len(corners) != 4:
         print(f"⚠ need 4 correction points, currently only {len(corners)} points")
         return
-    
-    print("=== color analysis ===")
-    
-
-    sorted_corners = sorted(corners, key=lambda p: p[1])
-    top_points = sorted(sorted_corners[:2], key=lambda p: p[0]) 
-    bottom_points = sorted(sorted_corners[2:], key=lambda p: p[0])
-    
-    left_top = top_points[0]      
-    right_top = top_points[1]     
-    left_bottom = bottom_points[0]  
-    right_bottom = bottom_points[1] 
-    
-    left_line_rgb, left_positions = sample_line_rgb(image, left_top, left_bottom)
-    right_line_rgb, right_positions = sample_line_rgb(image, right_top, right_bottom)
-    
-    
 
-    # filter out values greater than 250, and set values greater than 250 to 300 (because the maximum value of RGB is 255)
-    left_line_rgb[left_line_rgb > 250] = 255
-    right_line_rgb[right_line_rgb > 250] = 255
-    # for the left line: cut off the first 10% and the last 35%
-    y = left_bottom[1] - left_top[1]
+    print("=== color analysis ===")
 
-    left_line_rgb = left_line_rgb[int(0.1*y):int(y - 0.35 * y)]
-    left_positions = left_positions[int(0.1*y):int(y - 0.35 * y)]
-    # for the right line: cut off the first 20% and the last 10%
-    right_line_rgb = right_line_rgb[int(0.2*y):int(y - 0.25 * y)]
-    right_positions = right_positions[int(0.2*y):int(y - 0.25 * y)]
+    if lines is None:
+        lines = sample_corner_lines(image, corners)
+    left_line_rgb, left_positions, right_line_rgb, right_positions = color_profiles(corners, lines, crop, pairs)
 
-    plot_rgb_analysis(left_line_rgb, left_positions, right_line_rgb, right_positions)
+    if report is not None:
+        report.submit(name, left_line_rgb, left_positions, right_line_rgb, right_positions)
 
     delta_e = calculate_color_delta(left_line_rgb, left_positions, right_line_rgb, right_positions)
     return left_line_rgb, right_line_rgb, delta_e
@@ -1,70 +1,246 @@
+import math
 import numpy as np
+import metrics
 
-def calculate_color_delta(left_rgb, left_pos, right_rgb, right_pos):
+# 飽和的 pixel 不列入平均
+SATURATED = 255
+
+def masked_channel_sums(profiles, invalid=SATURATED):
+    """
+    Sum and count the valid samples of every channel of several profiles in one pass
+
+    Param:
+    profiles (list): RGB profiles (N_i x 3), the lengths may differ
+    invalid (float): sample value that is skipped
+
+    Return:
+    np.array: channel sums (n_profiles x 3)
+    np.array: valid sample counts (n_profiles x 3)
+    """
+    max_len = max((len(p) for p in profiles), default=0)
+    # 以 invalid 值補齊長度，補上的部分會和飽和 pixel 一起被遮罩掉
+    stacked = np.full((len(profiles), max_len, 3), invalid, dtype=np.float64)
+    for i, profile in enumerate(profiles):
+        stacked[i, :len(profile)] = profile
+
+    valid = stacked != invalid
+    sums = np.where(valid, stacked, 0.0).sum(axis=1)
+    counts = np.count_nonzero(valid, axis=1)
+    return sums, counts
 
-    left_rgb_float = left_rgb.astype(np.float64)
-    right_rgb_float = right_rgb.astype(np.float64)
-
-    left_r_mean = 0
-    left_r_cnt = 0
-    for i in range(len(left_rgb_float)):
-        if left_rgb_float[i][0] == 255:
-            continue
-        left_r_mean += left_rgb_float[i][0]
-        left_r_cnt += 1
-    left_r_mean /= left_r_cnt
-
- 
-    left_g_mean = 0
-    left_g_cnt = 0
-    for i in range(len(left_rgb_float)):
-        if left_rgb_float[i][1] == 255:
-            continue
-        left_g_mean += left_rgb_float[i][1]
-        left_g_cnt += 1
-    left_g_mean /= left_g_cnt
-
-    left_b_mean = 0
-    left_b_cnt = 0
-    for i in range(len(left_rgb_float)):
-        if left_rgb_float[i][2] == 255:
-            continue
-        left_b_mean += left_rgb_float[i][2]
-        left_b_cnt += 1
-    left_b_mean /= left_b_cnt
-
-
-    right_r_mean = 0
-    right_r_cnt = 0
-    for i in range(len(right_rgb_float)):
-        if right_rgb_float[i][0] == 255:
-            continue
-        right_r_mean += right_rgb_float[i][0]
-        right_r_cnt += 1    
-    right_r_mean /= right_r_cnt
-
-    right_g_mean = 0
-    right_g_cnt = 0
-    for i in range(len(right_rgb_float)):
-        if right_rgb_float[i][1] == 255:
-            continue
-        right_g_mean += right_rgb_float[i][1]
-        right_g_cnt += 1    
-    right_g_mean /= right_g_cnt
-
-    right_b_mean = 0
-    right_b_cnt = 0
-    for i in range(len(right_rgb_float)):
-        if right_rgb_float[i][2] == 255:
-            continue
-        right_b_mean += right_rgb_float[i][2]
-        right_b_cnt += 1    
-    right_b_mean /= right_b_cnt
+def masked_channel_means(profiles, invalid=SATURATED):
+    """channel means of several profiles skipping saturated samples (nan if nothing is valid)"""
+    sums, counts = masked_channel_sums(profiles, invalid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def calculate_color_delta(left_rgb, left_pos, right_rgb, right_pos):
+    """Euclidean distance between the mean RGB of the left and right lines"""
+    with metrics.stage('color_delta'):
+        left_mean, right_mean = masked_channel_means([left_rgb, right_rgb])
 
     # calculate delta_e
-    delta_r = right_r_mean - left_r_mean
-    delta_g = right_g_mean - left_g_mean
-    delta_b = right_b_mean - left_b_mean
-    delta_e = np.sqrt(delta_r**2 + delta_g**2 + delta_b**2)
+    delta = right_mean - left_mean
+    delta_e = np.sqrt(np.sum(delta**2))
     
-    return delta_e
\ No newline at end of file
+    return delta_e
+
+class ColorDeltaAccumulator:
+    """
+    Fold the left/right profiles of many frames into running channel means
+
+    Only the per-channel sums and counts are kept, so the memory does not grow
+    with the number of frames.
+    """
+
+    def __init__(self, invalid=SATURATED):
+        self.invalid = invalid
+        self.sums = np.zeros((2, 3))
+        self.counts = np.zeros((2, 3), dtype=np.int64)
+        self.frames = 0
+
+    def update(self, left_rgb, right_rgb):
+        """add one frame and return the running delta_e"""
+        sums, counts = masked_channel_sums([left_rgb, right_rgb], self.invalid)
+        self.sums += sums
+        self.counts += counts
+        self.frames += 1
+        return self.delta_e
+
+    def merge(self, other):
+        """combine with an accumulator filled by another worker"""
+        self.sums += other.sums
+        self.counts += other.counts
+        self.frames += other.frames
+        return self
+
+    @property
+    def means(self):
+        """running channel means (2 x 3): left line, right line"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts
+
+    @property
+    def delta_e(self):
+        left_mean, right_mean = self.means
+        return np.sqrt(np.sum((right_mean - left_mean)**2))
+
+    @property
+    def delta_brightness(self):
+        """running difference of the first channel, same as calculate_brightness_delta"""
+        left_mean, right_mean = self.means
+        return right_mean[0] - left_mean[0]
+
+# ---------------------------------------------------------------------------
+# CIE Lab color difference
+# ---------------------------------------------------------------------------
+
+def _srgb_to_linear_formula(v):
+    v = np.asarray(v, dtype=np.float64) / 255.0
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+# sRGB 8-bit 值到線性 RGB 的查找表
+SRGB_TO_LINEAR_LUT = _srgb_to_linear_formula(np.arange(256))
+SRGB_TO_LINEAR_LUT.setflags(write=False)
+
+# linear sRGB -> XYZ (D65)
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+_WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+def srgb_to_linear(rgb):
+    """linearize 0-255 sRGB values with the lookup table (interpolated for non-integer values)"""
+    rgb = np.asarray(rgb)
+    if rgb.dtype == np.uint8:
+        return SRGB_TO_LINEAR_LUT[rgb]
+    return np.interp(np.clip(rgb, 0, 255), np.arange(256), SRGB_TO_LINEAR_LUT)
+
+def rgb_to_lab(rgb, dtype=np.float64):
+    """
+    Convert sRGB values (0-255, last axis R, G, B) to CIE Lab (D65)
+
+    Works on any shape (..., 3): single colors, profiles (N x 3) or images (H x W x 3);
+    dtype=np.float32 halves the memory and time on whole images.
+    """
+    linear = srgb_to_linear(rgb).astype(dtype, copy=False)
+    xyz = linear @ (_RGB_TO_XYZ / _WHITE_D65[:, None]).T.astype(dtype)
+    delta = 6.0 / 29.0
+    f = np.where(xyz > delta**3, np.cbrt(xyz), xyz / (3 * delta**2) + 4.0 / 29.0)
+    L = 116.0 * f[..., 1] - 16.0
+    a = 500.0 * (f[..., 0] - f[..., 1])
+    b = 200.0 * (f[..., 1] - f[..., 2])
+    return np.stack([L, a, b], axis=-1)
+
+def _lab_channels(lab):
+    """split Lab values into L, a, b keeping float32 inputs in float32"""
+    lab = np.asarray(lab)
+    if lab.dtype != np.float32:
+        lab = lab.astype(np.float64)
+    return np.moveaxis(lab, -1, 0)
+
+def delta_e_cie76(lab1, lab2):
+    """CIE76 color difference, Euclidean distance in Lab"""
+    L1, a1, b1 = _lab_channels(lab1)
+    L2, a2, b2 = _lab_channels(lab2)
+    return np.sqrt((L1 - L2)**2 + (a1 - a2)**2 + (b1 - b2)**2)
+
+def delta_e_cie94(lab1, lab2, kL=1.0, K1=0.045, K2=0.015):
+    """CIE94 color difference (graphic arts weights by default)"""
+    L1, a1, b1 = _lab_channels(lab1)
+    L2, a2, b2 = _lab_channels(lab2)
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    dL = L1 - L2
+    dC = C1 - C2
+    dH_sq = np.maximum((a1 - a2)**2 + (b1 - b2)**2 - dC**2, 0.0)
+    SC = 1.0 + K1 * C1
+    SH = 1.0 + K2 * C1
+    return np.sqrt((dL / kL)**2 + (dC / SC)**2 + dH_sq / SH**2)
+
+def delta_e_ciede2000(lab1, lab2, kL=1.0, kC=1.0, kH=1.0):
+    """CIEDE2000 color difference (hue angles are handled in radians)"""
+    L1, a1, b1 = _lab_channels(lab1)
+    L2, a2, b2 = _lab_channels(lab2)
+    two_pi = 2.0 * math.pi
+    pow25_7 = 25.0**7
+
+    C_mean7 = ((np.hypot(a1, b1) + np.hypot(a2, b2)) / 2.0)**7
+    G = 0.5 * (1.0 - np.sqrt(C_mean7 / (C_mean7 + pow25_7)))
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.arctan2(b1, a1p) % two_pi
+    h2p = np.arctan2(b2, a2p) % two_pi
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    C_product = C1p * C2p
+    chroma_zero = C_product == 0
+    dhp = h2p - h1p
+    dhp = np.where(chroma_zero, 0.0, dhp - two_pi * np.round(dhp / two_pi))
+    dHp = 2.0 * np.sqrt(C_product) * np.sin(dhp / 2.0)
+
+    Lp_mean = (L1 + L2) / 2.0
+    Cp_mean = (C1p + C2p) / 2.0
+    h_sum = h1p + h2p
+    hp_mean = h_sum / 2.0
+    wrap = np.abs(h1p - h2p) > math.pi
+    hp_mean = np.where(wrap & (h_sum < two_pi), hp_mean + math.pi, hp_mean)
+    hp_mean = np.where(wrap & (h_sum >= two_pi), hp_mean - math.pi, hp_mean)
+    hp_mean = np.where(chroma_zero, h_sum, hp_mean)
+
+    T = (1.0
+         - 0.17 * np.cos(hp_mean - math.radians(30.0))
+         + 0.24 * np.cos(2.0 * hp_mean)
+         + 0.32 * np.cos(3.0 * hp_mean + math.radians(6.0))
+         - 0.20 * np.cos(4.0 * hp_mean - math.radians(63.0)))
+    d_theta = math.radians(30.0) * np.exp(-((hp_mean - math.radians(275.0)) / math.radians(25.0))**2)
+    Cp_mean7 = Cp_mean**7
+    RC = 2.0 * np.sqrt(Cp_mean7 / (Cp_mean7 + pow25_7))
+    L50_sq = (Lp_mean - 50.0)**2
+    SL = 1.0 + 0.015 * L50_sq / np.sqrt(20.0 + L50_sq)
+    SC = 1.0 + 0.045 * Cp_mean
+    SH = 1.0 + 0.015 * Cp_mean * T
+    RT = -np.sin(2.0 * d_theta) * RC
+
+    dL_term = dLp / (kL * SL)
+    dC_term = dCp / (kC * SC)
+    dH_term = dHp / (kH * SH)
+    return np.sqrt(dL_term**2 + dC_term**2 + dH_term**2 + RT * dC_term * dH_term)
+
+DELTA_E_METHODS = {
+    'cie76': delta_e_cie76,
+    'cie94': delta_e_cie94,
+    'ciede2000': delta_e_ciede2000,
+}
+
+def calculate_lab_delta_e(left_rgb, right_rgb, method='ciede2000'):
+    """
+    Perceptual color difference between the mean colors of the left and right lines
+
+    Param:
+    left_rgb, right_rgb (np.array): RGB profiles (N x 3), saturated samples are skipped
+    method (str): 'cie76', 'cie94' or 'ciede2000'
+
+    Return:
+    float: delta E
+    """
+    with metrics.stage('lab_delta'):
+        left_mean, right_mean = masked_channel_means([left_rgb, right_rgb])
+        left_lab, right_lab = rgb_to_lab(np.stack([left_mean, right_mean]))
+        return float(DELTA_E_METHODS[method](left_lab, right_lab))
+
+def image_delta_e(bgr_a, bgr_b, method='ciede2000'):
+    """
+    Per pixel delta E between two BGR images or image regions of the same size
+
+    Return:
+    np.array: delta E map (H x W), float32
+    """
+    lab_a = rgb_to_lab(np.asarray(bgr_a)[..., ::-1], np.float32)
+    lab_b = rgb_to_lab(np.asarray(bgr_b)[..., ::-1], np.float32)
+    return DELTA_E_METHODS[method](lab_a, lab_b)
@@ -1,48 +1,121 @@
 import cv2
 import numpy as np
+import metrics
+from utils import order_corners
 
 def load_image(image_path):
-    """讀取圖片"""
-    image = cv2.imread(image_path)
+    """讀取圖片，.npy 檔案直接讀取陣列 (BGR)"""
+    with metrics.stage('decode'):
+        if image_path.lower().endswith('.npy'):
+            return np.load(image_path)
+        image = cv2.imread(image_path)
     return image
 
 def convert_to_gray(image):
     """將圖片轉換為灰度圖"""
-    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    with metrics.stage('gray'):
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-def sample_line_rgb(image, start_point, end_point):
-    """沿著線段採樣RGB值，依據每個 pixel 來採樣"""
-    x1, y1 = start_point
-    x2, y2 = end_point
-    
-    num_samples = y2 - y1 + 1
-    print('num_samples: ', num_samples)
-
-    # 生成線段上的採樣點
-    positions = []
-    rgb_values = []
-    
-    for i in range(num_samples):
-        # 線性插值計算採樣點座標
-        t = i / (num_samples - 1)  # 參數從0到1
-        x = int(x1 + t * (x2 - x1))
-        y = int(y1 + t * (y2 - y1))
-        
-        # 確保座標在圖片範圍內
-        x = max(0, min(x, image.shape[1] - 1))
-        y = max(0, min(y, image.shape[0] - 1))
-        
-        # 提取RGB值（注意OpenCV使用BGR格式）
-        if len(image.shape) == 3:
-            b, g, r = image[y, x]
-            rgb_values.append([r, g, b])  # 轉換為RGB順序
+def _line_coordinates(segments, num_samples=None):
+    """
+    build the sampling coordinates of all segments at once, concatenated
+
+    Return:
+    np.array: x, y and distance from the segment start of every sample
+    np.array: samples of every segment
+    """
+    seg = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+    starts, ends = seg[:, 0], seg[:, 1]
+    deltas = ends - starts
+
+    if num_samples is None:
+        # 每條線段各自每個 pixel 採一次樣：以該線段較長的軸決定採樣數，近水平的線段也不會欠採樣
+        counts = np.abs(deltas).max(axis=1).astype(np.intp) + 1
+    else:
+        counts = np.full(len(seg), int(num_samples), dtype=np.intp)
+    index = np.repeat(np.arange(len(seg)), counts)
+    k = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)).astype(np.float64)
+    steps = np.maximum(counts - 1, 1)[index]
+
+    # k * delta / steps 在每個 pixel 採樣時是精確的整數，取整結果不受線段位置影響
+    xs = starts[index, 0] + k * deltas[index, 0] / steps
+    ys = starts[index, 1] + k * deltas[index, 1] / steps
+    positions = k / steps * np.hypot(deltas[:, 0], deltas[:, 1])[index]
+    return xs, ys, positions, counts
+
+def _bilinear_points(image, xs, ys):
+    """bilinear sampling of arbitrary points, only the 4 neighbours of each point are read"""
+    h, w = image.shape[:2]
+    xs = np.clip(xs, 0, w - 1)
+    ys = np.clip(ys, 0, h - 1)
+    x0 = np.minimum(xs.astype(np.intp), w - 2) if w > 1 else np.zeros(xs.shape, np.intp)
+    y0 = np.minimum(ys.astype(np.intp), h - 2) if h > 1 else np.zeros(ys.shape, np.intp)
+    x1 = np.minimum(x0 + 1, w - 1)
+    y1 = np.minimum(y0 + 1, h - 1)
+    fx = (xs - x0)[..., None].astype(np.float32)
+    fy = (ys - y0)[..., None].astype(np.float32)
+
+    pixels = image if image.ndim == 3 else image[..., None]
+    top = pixels[y0, x0] * (1 - fx) + pixels[y0, x1] * fx
+    bottom = pixels[y1, x0] * (1 - fx) + pixels[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def sample_lines_rgb(image, segments, num_samples=None, subpixel=False):
+    """
+    Sample the RGB values along many line segments in one call
+
+    Param:
+    image (np.array): BGR or gray image
+    segments (list): [(start_point, end_point), ...]
+    num_samples (int): samples per segment, default one per pixel of each segment
+    subpixel (bool): bilinear sub-pixel sampling, otherwise the nearest pixel is used
+
+    Return:
+    list: RGB values of every segment (num_samples x 3 each), float32 when subpixel
+    list: distance of every sample from the segment start (num_samples each)
+    """
+    with metrics.stage('sampling'):
+        xs, ys, positions, counts = _line_coordinates(segments, num_samples)
+        metrics.count('sampled_pixels', xs.size)
+
+        if subpixel:
+            values = _bilinear_points(image, xs, ys)
         else:
-            # 灰度圖
-            gray_val = image[y, x]
-            rgb_values.append([gray_val, gray_val, gray_val])
-        
-        # 記錄在線段上的位置（距離起點的距離）
-        distance = ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
-        positions.append(distance)
-    
-    return np.array(rgb_values), np.array(positions) 
\ No newline at end of file
+            # 與原本的 int() 取整一致，並限制在圖片範圍內
+            xi = np.clip(xs.astype(np.intp), 0, image.shape[1] - 1)
+            yi = np.clip(ys.astype(np.intp), 0, image.shape[0] - 1)
+            values = image[yi, xi]
+            if values.ndim == 1:
+                values = values[..., None]
+
+    if values.shape[-1] == 1:
+        # 灰度圖
+        rgb = np.repeat(values, 3, axis=-1)
+    else:
+        # OpenCV 使用 BGR 格式，轉換為 RGB 順序
+        rgb = np.ascontiguousarray(values[..., 2::-1])
+    # 每條線段的長度可能不同，分回各自的陣列 (view，不複製)
+    splits = np.cumsum(counts)[:-1]
+    return np.split(rgb, splits), np.split(positions, splits)
+
+def sample_line_rgb(image, start_point, end_point, subpixel=False):
+    """沿著線段採樣RGB值，依據每個 pixel 來採樣"""
+    rgb_values, positions = sample_lines_rgb(image, [(start_point, end_point)], subpixel=subpixel)
+    return rgb_values[0], positions[0]
+
+def sample_corner_lines(image, corners):
+    """
+    Sample the left (left_top - left_bottom) and right (right_top - right_bottom) lines
+    between the four correction points, shared by the color and brightness analysis
+
+    each line keeps one sample per pixel, so the two lines have different lengths
+    when the targets are not aligned; sub-pixel corners (SUBPIXEL_CENTERS) are rounded
+    to the nearest pixel: truncating them would move every line up to one pixel up,
+    and bilinear sampling would mix the excluded saturated rows into their neighbours
+
+    Return:
+    list: RGB values [left (N x 3), right (M x 3)]
+    list: distance of every sample from the top point [left (N), right (M)]
+    """
+    left_top, right_top, left_bottom, right_bottom = np.rint(np.asarray(order_corners(corners), dtype=np.float64))
+    return sample_lines_rgb(image, [(left_top, left_bottom), (right_top, right_bottom)])
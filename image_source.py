@@ -0,0 +1,227 @@
+"""
+Region of interest loading for very large panoramas
+
+The targets are detected on a reduced image and only the windows around them
+and the band between them are read at full resolution, so the peak memory
+follows the ROI instead of the panorama:
+
+    source = open_image_source('panorama.tif')
+    matches = locate_targets(source, template, factor=8)
+    roi, roi_corners, offset = read_seam_region(source, corners)
+
+- .npy files and uncompressed TIFF files (with the optional tifffile package)
+  are memory mapped, reduced images are built strip by strip
+- other formats use the reduced decoders of OpenCV (JPEG decodes directly at
+  1/2, 1/4 or 1/8 size); their full resolution regions still need one full
+  decode, which is done once and cropped
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+import metrics
+from pattern_matching import coarse_candidates, refine_match, select_refined
+
+try:
+    import tifffile
+except ImportError:  # optional, TIFF files are decoded by OpenCV
+    tifffile = None
+
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# 記憶體映射的影像每次縮小的列數
+STRIP_ROWS = 1024
+
+
+def _to_bgr(pixels, rgb=False):
+    if pixels.ndim == 2:
+        return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+    if pixels.shape[2] == 4:
+        return cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGR if rgb else cv2.COLOR_BGRA2BGR)
+    return np.ascontiguousarray(pixels[..., ::-1] if rgb else pixels)
+
+
+def _to_gray(pixels, rgb=False):
+    if pixels.ndim == 2:
+        return pixels
+    code = {(3, False): cv2.COLOR_BGR2GRAY, (3, True): cv2.COLOR_RGB2GRAY,
+            (4, False): cv2.COLOR_BGRA2GRAY, (4, True): cv2.COLOR_RGBA2GRAY}[(pixels.shape[2], rgb)]
+    return cv2.cvtColor(np.ascontiguousarray(pixels), code)
+
+
+class ArrayImageSource:
+    """image backed by a (memory mapped) array, regions are read without loading the rest"""
+
+    def __init__(self, array, rgb=False):
+        """
+        Param:
+        array (np.array): H x W, H x W x 3 or H x W x 4 uint8 pixels
+        rgb (bool): the channels are RGB(A) instead of OpenCV's BGR(A)
+        """
+        self.array = array
+        self.rgb = rgb
+
+    @property
+    def shape(self):
+        return self.array.shape[:2]
+
+    def read_region(self, x0, y0, x1, y1):
+        """full resolution BGR pixels of [y0:y1, x0:x1]"""
+        with metrics.stage('decode_roi'):
+            return _to_bgr(np.asarray(self.array[y0:y1, x0:x1]), self.rgb)
+
+    def reduced_gray(self, factor):
+        """
+        Gray image reduced by an integer factor, built strip by strip (INTER_AREA)
+
+        Return:
+        np.array: reduced gray image, pixel (x, y) covers (x * factor, y * factor) at full resolution
+        """
+        height, width = self.shape
+        out_h, out_w = height // factor, width // factor
+        rows = max(factor, STRIP_ROWS // factor * factor)
+        reduced = np.empty((out_h, out_w), np.uint8)
+        with metrics.stage('decode_reduced'):
+            for y in range(0, out_h * factor, rows):
+                strip = _to_gray(np.asarray(self.array[y:min(y + rows, out_h * factor), :out_w * factor]),
+                                 self.rgb)
+                reduced[y // factor:(y + strip.shape[0]) // factor] = cv2.resize(
+                    strip, (out_w, strip.shape[0] // factor), interpolation=cv2.INTER_AREA)
+        return reduced
+
+
+class DecodedImageSource:
+    """image file decoded by OpenCV, reduced images use the IMREAD_REDUCED_* decoders"""
+
+    def __init__(self, path):
+        self.path = path
+        self._image = None
+        self._shape = None
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = self._full().shape[:2]
+        return self._shape
+
+    def _full(self):
+        # 只解碼一次，之後的區域都從這張圖裁切
+        if self._image is None:
+            with metrics.stage('decode'):
+                self._image = cv2.imread(self.path)
+            if self._image is None:
+                raise IOError(f"cannot read image {self.path}")
+            self._shape = self._image.shape[:2]
+        return self._image
+
+    def read_region(self, x0, y0, x1, y1):
+        """full resolution BGR pixels of [y0:y1, x0:x1]"""
+        return self._full()[y0:y1, x0:x1].copy()
+
+    def reduced_gray(self, factor):
+        """
+        Gray image reduced by 1, 2, 4 or 8
+
+        Return:
+        np.array: reduced gray image, pixel (x, y) covers (x * factor, y * factor) at full resolution
+        """
+        if factor not in REDUCED_FLAGS:
+            raise ValueError(f"reduction factor must be one of {sorted(REDUCED_FLAGS)}, got {factor}")
+        if self._image is not None:
+            gray = cv2.cvtColor(self._image, cv2.COLOR_BGR2GRAY)
+            return cv2.resize(gray, (gray.shape[1] // factor, gray.shape[0] // factor),
+                              interpolation=cv2.INTER_AREA)
+        with metrics.stage('decode_reduced'):
+            reduced = cv2.imread(self.path, REDUCED_FLAGS[factor])
+        if reduced is None:
+            raise IOError(f"cannot read image {self.path}")
+        return reduced
+
+
+def open_image_source(path):
+    """
+    Open an image for ROI reading, memory mapped when the format allows it
+
+    Return:
+    ArrayImageSource or DecodedImageSource
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return ArrayImageSource(np.load(path, mmap_mode='r'))
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        try:
+            return ArrayImageSource(tifffile.memmap(path, mode='r'), rgb=True)
+        except ValueError:
+            # 壓縮或分塊的 TIFF 無法直接映射
+            pass
+    return DecodedImageSource(path)
+
+
+def locate_targets(source, template, factor=4, top_k=32, search_regions=None):
+    """
+    Template matching on a reduced image, refined in small full resolution windows
+
+    Param:
+    source: ArrayImageSource or DecodedImageSource
+    template (np.array): full resolution gray template
+    factor (int): reduction of the detection image
+    top_k (int): maximum number of coarse candidates
+    search_regions (list): [(x, y, w, h), ...] expected top left positions (full resolution)
+
+    Return:
+    list: [(x, y, score), ...] full resolution matches, same format as match_template_full
+    """
+    small_image = source.reduced_gray(factor)
+    small_template = cv2.resize(template, (max(1, template.shape[1] // factor),
+                                           max(1, template.shape[0] // factor)),
+                                interpolation=cv2.INTER_AREA)
+    small_regions = None
+    if search_regions:
+        small_regions = [(x / factor - 1, y / factor - 1, w / factor + 2, h / factor + 2)
+                         for x, y, w, h in search_regions]
+    coarse = coarse_candidates(small_image, small_template, small_regions, top_k)
+    print(f"found {len(coarse)} coarse candidates at 1/{factor} scale")
+
+    height, width = source.shape
+    th, tw = template.shape[:2]
+    radius = 2 * factor
+    refined = []
+    with metrics.stage('match_refine'):
+        for x, y, _ in coarse:
+            x, y = x * factor, y * factor
+            x0, y0 = max(0, x - radius), max(0, y - radius)
+            x1, y1 = min(width, x + radius + tw), min(height, y + radius + th)
+            window = cv2.cvtColor(source.read_region(x0, y0, x1, y1), cv2.COLOR_BGR2GRAY)
+            match = refine_match(window, template, x - x0, y - y0, radius)
+            if match is not None:
+                refined.append((x0 + match[0], y0 + match[1], match[2]))
+    return select_refined(refined, template)
+
+
+def read_seam_region(source, corners, margin=32):
+    """
+    Read the full resolution band that contains the four correction points
+
+    Param:
+    corners (list): the four correction points (full resolution)
+    margin (int): extra pixels around the points (strips of the seam profile, sub-pixel sampling)
+
+    Return:
+    np.array: BGR region
+    list: the correction points in region coordinates
+    tuple: (x, y) offset of the region in the full image
+    """
+    height, width = source.shape
+    xs = [x for x, _ in corners]
+    ys = [y for _, y in corners]
+    x0, y0 = max(0, int(min(xs)) - margin), max(0, int(min(ys)) - margin)
+    x1, y1 = min(width, int(max(xs)) + margin + 1), min(height, int(max(ys)) + margin + 1)
+    region = source.read_region(x0, y0, x1, y1)
+    return region, [(x - x0, y - y0) for x, y in corners], (x0, y0)
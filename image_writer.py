@@ -0,0 +1,121 @@
+"""
+Diagnostic image encoding on a background I/O thread
+
+The analysis only hands finished images to an ImageWriter; encoding and
+writing happen on a worker thread behind a bounded queue, so at most
+max_queue images wait in memory and the analysis is not blocked by PNG
+compression unless the queue is full.
+
+formats:
+- png: lossless, compression level 0-9 (default 3, faster than the OpenCV default on large images)
+- jpg: fast previews, quality 0-100
+- webp: small previews, quality 1-100
+"""
+
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+import metrics
+
+# 格式: (副檔名, cv2.imwrite 參數, 預設值)
+IMAGE_FORMATS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION, 3),
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 90),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 80),
+}
+
+_STOP = object()
+
+
+class ImageWriter:
+    """write the diagnostic images of a run in the background"""
+
+    def __init__(self, fmt='png', level=None, max_queue=4, background=True):
+        """
+        Param:
+        fmt (str): 'png', 'jpg' or 'webp'
+        level (int): PNG compression level or JPEG / WebP quality, default see IMAGE_FORMATS
+        max_queue (int): maximum number of images waiting to be written, submit blocks when full
+        background (bool): False writes every image in submit (e.g. worker processes)
+        """
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError(f"unknown image format: {fmt}, expected one of {list(IMAGE_FORMATS)}")
+        self.fmt = fmt
+        self.extension, flag, default = IMAGE_FORMATS[fmt]
+        self.params = [flag, int(default if level is None else level)]
+        self.written = []
+        self.failed = []
+        self._queue = None
+        self._thread = None
+
+        if background:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._thread = threading.Thread(target=self._run, name='image-writer', daemon=True)
+            self._thread.start()
+
+    def path(self, name):
+        """file name of an image: name without extension + the extension of the format"""
+        return os.path.splitext(name)[0] + self.extension
+
+    def submit(self, name, image, copy=False):
+        """
+        Queue one image, the file is <name>.<format>
+
+        the image is encoded later, it must not be modified afterwards unless copy=True
+
+        Return:
+        str: path of the file
+        """
+        path = self.path(name)
+        if copy:
+            image = np.array(image)
+        if self._queue is None:
+            self._write(path, image)
+        else:
+            with metrics.stage('image_submit'):
+                self._queue.put((path, image))
+        return path
+
+    def _write(self, path, image):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if not cv2.imwrite(path, image, self.params):
+                raise IOError('cv2.imwrite failed')
+            self.written.append(path)
+        except Exception as e:
+            self.failed.append(path)
+            print(f"⚠ failed to write {path}: {e}")
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._write(*job)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """wait until every queued image is written"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        """write the remaining images and stop the worker thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
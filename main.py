@@ -17,17 +17,60 @@
 - visualization: 可視化
 - utils: 工具函式
 - brightness_analysis: 亮度分析
+- pipeline: 分析階段的 stage graph (結果依輸入記憶)
 """
 
-import cv2
 from image_processing import load_image, convert_to_gray
-from calibration import find_octagon_pattern_matching, find_octagon_manual
-from color_analysis import analyze_color_lines
-from visualization import visualize_sampling_lines, print_center_line
-from brightness_analysis import brightness_analysis
+from calibration import (find_octagon_pattern_matching, find_octagon_manual, find_octagon_automatic,
+                         load_or_extract_template, has_display)
+from color_analysis import print_band_table
+from visualization import visualize_sampling_lines, save_overlay
+from pipeline import run_analysis
+from seams import group_seams, analyze_seams, print_seam_table, write_seam_table
+from reporting import ReportWriter
+from result_store import ResultStore
+from spc import SPCMonitor, format_alarm
+from image_writer import ImageWriter
+
+# 報告模式: 'off' 不繪圖, 'preview' 低解析度預覽, 'full' 300 dpi 圖表
+REPORT_MODE = "full"
+
+# 是否保存灰度圖 assets/gray_image.png
+SAVE_GRAY_IMAGE = False
+
+# 診斷影像: 'off' 不保存, 'overlay' 匹配框、採樣線、角點和中心線合成在一張 assets/overlay.png,
+# 'separate' 分別保存 sampling_lines / center_line / pattern_matching_result
+DIAGNOSTICS = "overlay"
+
+# 診斷影像在背景執行緒編碼的格式: 'png' (DIAGNOSTIC_LEVEL 壓縮等級 0-9)、
+# 'jpg' / 'webp' 快速預覽 (DIAGNOSTIC_LEVEL 品質)，None 使用預設值
+DIAGNOSTIC_FORMAT = "png"
+DIAGNOSTIC_LEVEL = None
+
+# 整條接縫色差分析每個 block 的列數
+SEAM_BLOCK = 8
+
+# 校正點使用 sub-pixel 精度 (模板匹配的分數峰值以拋物線擬合)
+SUBPIXEL_CENTERS = True
+
+# 自動分割色帶和灰帶，不使用固定的裁切比例 (每個 rig 都要調整)
+AUTO_BANDS = True
+
+# 多個接縫時 target 欄位的配對方式: 'adjacent' 相鄰兩欄為一個接縫 (共用 target), 'pairs' 每兩欄一個接縫
+SEAM_PAIRING = "adjacent"
+
+# 模板庫中的 rig ID，第一次執行時框選的 target 會保存下來重複使用
+RIG_ID = "default"
+
+# 每次分析的結果保存到結果資料庫 (查詢: python result_store.py --rig RIG_ID)，None 不保存
+RESULT_DB = "assets/results.db"
+
+# 每次分析更新的色差漂移監控狀態 (EWMA / CUSUM，查詢: python spc.py)，None 不監控
+SPC_STATE = "assets/spc_state.json"
 
 def main():
     """主程序入口"""
+    writer = ImageWriter(DIAGNOSTIC_FORMAT, DIAGNOSTIC_LEVEL)
     try:
         print("=== 色彩分析程序 (重構版本) ===")
         print("開始處理...")
@@ -42,16 +85,23 @@ def main():
         gray_image = convert_to_gray(image)
         print(f"✓ 成功讀取圖片，尺寸: {image.shape}")
         
-        # 保存灰度圖
-        cv2.imwrite("assets/gray_image.png", gray_image)
-        print("✓ 已保存灰度圖到 assets/gray_image.png")
+        # 保存灰度圖 (在背景執行緒編碼，預設關閉)
+        if SAVE_GRAY_IMAGE:
+            path = writer.submit("assets/gray_image", gray_image)
+            print(f"✓ 已保存灰度圖到 {path}")
         
         # 2. 校正點檢測
-        main_corners = detect_correction_points(gray_image)
+        # overlay 模式不另外保存匹配結果圖，匹配框畫在 overlay 上
+        matches = []
+        main_corners = detect_correction_points(gray_image, rig_id=RIG_ID, subpixel=SUBPIXEL_CENTERS,
+                                                save_result=DIAGNOSTICS == "separate", writer=writer,
+                                                matches=matches)
         
         # 3. 色彩分析
         if main_corners and len(main_corners) == 4:
-            perform_color_analysis(image, main_corners)
+            perform_color_analysis(image, main_corners, writer=writer, matches=matches)
+        elif main_corners and len(main_corners) > 4:
+            perform_seam_analysis(image, main_corners, writer=writer, matches=matches)
         else:
             print_usage_tips()
             
@@ -59,30 +109,60 @@ def main():
         print(f"✗ 程序執行錯誤: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        writer.close()
+
+def detect_correction_points(gray_image, template=None, allow_manual=True, save_result=True,
+                             rig_id=None, match_mode='full', search_regions=None, subpixel=False,
+                             writer=None, matches=None):
+    """檢測校正點，依序嘗試模板匹配和手動標記
 
-def detect_correction_points(gray_image):
-    """檢測校正點，依序嘗試模板匹配和手動標記"""
+    template 為 None 時先從模板庫讀取 rig_id 的模板，沒有的話才要求手動框選 target；
+    allow_manual=False 或沒有圖形介面時不會開啟任何 GUI，沒有模板時改用自動檢測。
+    match_mode='auto' 一律使用自動檢測 (合成的八角形模板組，不需要模板)；
+    match_mode / search_regions / subpixel 會傳給 find_octagon_pattern_matching；
+    有 writer (ImageWriter) 時結果圖在背景執行緒寫入；matches (list) 會加入找到的匹配框 (x, y, w, h, score)
+    """
     print("\n" + "="*60)
     print("開始檢測校正點...")
     
+    interactive = allow_manual and has_display()
+    if template is None and rig_id is not None and match_mode != 'auto':
+        template = load_or_extract_template(gray_image, rig_id, interactive)
+
+    if match_mode == 'auto' or (template is None and not interactive):
+        # 方法0: 自動檢測 (不需要模板和 GUI)
+        print("\n--- 方法0: 自動檢測 ---")
+        corners = find_octagon_automatic(gray_image, save_result=save_result, subpixel=subpixel,
+                                         writer=writer, matches=matches)
+        if len(corners) >= 4:
+            return corners
+        print("⚠ 自動檢測未找到足夠的 target")
+        if template is None and not interactive:
+            return []
+
     # 方法1: 模板匹配 (手動框選target)
     try:
         print("\n--- 方法1: 模板匹配 ---")
-        corners = find_octagon_pattern_matching(gray_image)
+        corners = find_octagon_pattern_matching(gray_image, template, save_result=save_result,
+                                                mode=match_mode, search_regions=search_regions,
+                                                subpixel=subpixel, writer=writer, matches=matches)
 
         if corners and len(corners) >= 4:
             return corners
         else:
-            print("⚠ 模板匹配未找到足夠的角點，嘗試手動標記...")
+            print("⚠ 模板匹配未找到足夠的角點")
             
     except Exception as e:
         print(f"⚠ 模板匹配失敗: {e}")
-        print("嘗試手動標記...")
+    
+    if not interactive:
+        return []
     
     # 方法2: 手動標記
     try:
         print("\n--- 方法2: 手動標記 ---")
-        corners = find_octagon_manual(gray_image)
+        corners = find_octagon_manual(gray_image, writer)
         
         if len(corners) == 4:
             return corners
@@ -94,60 +174,157 @@ def detect_correction_points(gray_image):
     
     return []
 
-def perform_color_analysis(image, corners):
-    """執行完整的色彩分析流程"""
+def diagnostic_targets(diagnostics=None):
+    """pipeline 中產生診斷影像的階段"""
+    diagnostics = diagnostics or DIAGNOSTICS
+    if diagnostics == "overlay":
+        return ['overlay']
+    if diagnostics == "separate":
+        return ['sampling_lines', 'center_line']
+    return []
+
+def perform_color_analysis(image, corners, report_mode=REPORT_MODE, writer=None, matches=None):
+    """執行完整的色彩分析流程，圖表在背景執行緒繪製
+
+    各個階段由 pipeline 的 stage graph 計算：左右線段只採樣一次，
+    同一個 process 中再次分析時只重新計算輸入有改變的階段；
+    診斷影像 (DIAGNOSTICS) 畫在影像的複本上，有 writer 時在背景執行緒編碼；
+    matches 是 detect_correction_points 找到的匹配框，畫在 overlay 上
+    """
     print("\n" + "="*60)
     print("開始色彩分析...")
     
+    report = ReportWriter(report_mode)
     try:
-        # 可視化採樣線段
-        visualize_sampling_lines(image, corners)
-        print("✓ 採樣線段可視化完成")
+        crop = 'auto' if AUTO_BANDS else None
+        targets = diagnostic_targets() + ['color', 'brightness', 'delta_e_2000', 'channels', 'seam']
+        if AUTO_BANDS:
+            targets.append('bands')
+        results = run_analysis(image, corners, targets, color_crop=crop, brightness_crop=crop,
+                               seam_block=SEAM_BLOCK, report=report, writer=writer, matches=matches)
+        if DIAGNOSTICS != "off":
+            print("✓ 採樣線段可視化完成")
+        if AUTO_BANDS:
+            print_band_table(results['bands'])
 
-        # 印出中線
-        print_center_line(image, corners)
-        
         # RGB分析和色差計算
-        left_rgb, right_rgb, delta_e = analyze_color_lines(image, corners)
+        left_rgb, right_rgb, delta_e = results['color']
         print("="*60)
         print(f"delta_e: {delta_e}")
         print("="*60)
         print("✓ RGB分析和色差計算完成")
         
         # 亮度分析
-        left_rgb, right_rgb, delta_e_brightness = brightness_analysis(image, corners)
+        _, _, delta_e_brightness = results['brightness']
         print("="*60)
         print(f"delta_e_brightness: {delta_e_brightness}")
         print("="*60)
         print("✓ 亮度分析完成")
+
+        # 整條接縫的色差分佈
+        worst_row, worst_delta = results['seam'].worst()
+        print("="*60)
+        print(f"seam max delta_e: {worst_delta:.4f} (row {worst_row})")
+        print("="*60)
+        print("✓ 接縫色差分析完成")
+
+        save_results({'status': 'ok', 'corners': corners, 'delta_e': delta_e,
+                      'delta_e_2000': results['delta_e_2000'],
+                      'delta_brightness': delta_e_brightness,
+                      'seam_delta_max': worst_delta, 'seam_delta_row': worst_row,
+                      'channels': results['channels'], 'bands': results.get('bands')})
         
-        # 顯示生成檔案清單
-        print_generated_files()
+        # 等待圖表和診斷影像寫完再顯示生成檔案清單
+        report.close()
+        if writer is not None:
+            writer.flush()
+        print_generated_files(report, writer)
         
     except Exception as e:
         print(f"✗ 色彩分析失敗: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        report.close()
+
+def perform_seam_analysis(image, corners, report_mode=REPORT_MODE, writer=None, matches=None):
+    """多個接縫的全景圖：target 依網格分組成接縫，每個接縫在執行緒中分析"""
+    print("\n" + "="*60)
+    print(f"開始多接縫分析 ({len(corners)} 個 target)...")
+
+    seams = group_seams(corners, pairing=SEAM_PAIRING)
+    if not seams:
+        print("⚠ 無法將 target 分組成接縫")
+        return
 
-def print_generated_files():
+    if DIAGNOSTICS == "overlay":
+        save_overlay(image, corners, writer, matches=matches)
+    elif DIAGNOSTICS == "separate":
+        visualize_sampling_lines(image, corners, writer)
+    with ReportWriter(report_mode) as report:
+        rows = analyze_seams(image, seams, report=report, seam_block=SEAM_BLOCK,
+                             crop='auto' if AUTO_BANDS else None)
+    print_seam_table(rows)
+    write_seam_table(rows, 'assets/seam_results.csv')
+    print("✓ 接縫結果已保存到 assets/seam_results.csv")
+    save_results({'status': 'ok', 'corners': corners, 'seam_rows': rows})
+    if writer is not None:
+        writer.flush()
+    print_generated_files(report, writer)
+
+def save_results(row, db_path=RESULT_DB):
+    """把分析結果加入結果資料庫 (rig: RIG_ID)"""
+    if not db_path:
+        return
+    try:
+        with ResultStore(db_path) as store:
+            store.add_row(RIG_ID, dict(row, source="assets/image.png"))
+        print(f"✓ 結果已加入 {db_path}")
+    except Exception as e:
+        print(f"⚠ 無法保存結果到 {db_path}: {e}")
+    update_spc(row)
+
+def update_spc(row, state_path=SPC_STATE):
+    """以這次的結果更新每個接縫的漂移監控，顯示警報"""
+    if not state_path:
+        return
+    try:
+        spc = SPCMonitor.load(state_path)
+        alarms = spc.update_row(row)
+        spc.save(state_path)
+    except Exception as e:
+        print(f"⚠ 無法更新 SPC 狀態 {state_path}: {e}")
+        return
+    for alarm in alarms:
+        print(format_alarm(alarm))
+    print(f"✓ SPC 狀態已更新 ({state_path}, {len(alarms)} 個警報)")
+
+def print_generated_files(report=None, writer=None):
     """顯示生成的檔案清單"""
     print("\n" + "="*60)
     print("✓ 程序執行完成！")
     print("\n生成的檔案:")
-    print("📁 基礎檔案:")
-    print("  - assets/gray_image.png - 灰度圖")
-    print("  - assets/sampling_lines.png - 採樣線段圖")
-    
-    print("\n🎨 色彩分析:")
-    print("  - assets/rgb_analysis_separated.png - 分離式RGB分析")
-    print("  - assets/rgb_comparison.png - RGB比較圖")
+    if writer is not None:
+        if writer.written:
+            print("📁 診斷影像:")
+            for path in writer.written:
+                print(f"  - {path}")
+    else:
+        print("📁 基礎檔案:")
+        if SAVE_GRAY_IMAGE:
+            print("  - assets/gray_image.png - 灰度圖")
+        print("  - assets/sampling_lines.png - 採樣線段圖")
     
-    print("\n💡 亮度分析:")
-    print("  - assets/brightness_analysis.png - 亮度分析圖")
+    if report is not None and report.written:
+        print("\n🎨 色彩 / 💡 亮度分析:")
+        for path in report.written:
+            print(f"  - {path}")
     
-    print("\n🎯 校正點檢測:")
-    print("  - assets/pattern_matching_result.png - 模板匹配結果")
-    print("  - assets/extracted_target.png - 提取的target模板")
+    if writer is None:
+        print("\n🎯 校正點檢測:")
+        print("  - assets/pattern_matching_result.png - 模板匹配結果")
+        print("  - assets/extracted_target.png - 提取的target模板")
+        print("  - assets/automatic_detection_result.png - 自動檢測結果 (沒有模板時)")
 
 def print_usage_tips():
     """顯示使用提示"""
@@ -0,0 +1,230 @@
+"""
+Per-stage timing and counters
+
+The analysis functions mark their stages with `stage()` and their counts with
+`count()`. Nothing is recorded unless a collector is active:
+
+    with collect('image.png') as m:
+        ...run the pipeline...
+    m.write_json('metrics/image.json')
+
+Without an active collector `stage()` returns a shared no-op context manager,
+so the instrumentation costs one context variable lookup per call.
+"""
+
+import contextlib
+import contextvars
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_current = contextvars.ContextVar('stitching_metrics', default=None)
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class StageMetrics:
+    """wall / CPU time, peak traced memory and counters of the stages of one image"""
+
+    def __init__(self, name=None, track_memory=False):
+        self.name = name
+        self.track_memory = track_memory
+        self.stages = {}
+        self.counts = {}
+        self._memory_stack = []
+        self._started_tracing = False
+        # 多個執行緒 (例如每個接縫一個) 可能同時更新同一個 collector；
+        # 峰值記憶體只在單一執行緒時有意義
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+        if self.track_memory:
+            self._enter_memory()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            elapsed_wall = time.perf_counter() - wall
+            elapsed_cpu = time.process_time() - cpu
+            with self._lock:
+                record['wall'] += elapsed_wall
+                record['cpu'] += elapsed_cpu
+                record['calls'] += 1
+            if self.track_memory:
+                peak = self._exit_memory()
+                record['peak_memory'] = max(record.get('peak_memory', 0), peak)
+
+    def _enter_memory(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        current, peak = tracemalloc.get_traced_memory()
+        if self._memory_stack:
+            # 子階段會重設 peak，先把目前的 peak 記到上一層
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._memory_stack.append([current, current])
+
+    def _exit_memory(self):
+        start, running_peak = self._memory_stack.pop()
+        peak = max(running_peak, tracemalloc.get_traced_memory()[1])
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        return peak - start
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def to_dict(self):
+        result = {'name': self.name, 'stages': self.stages, 'counts': self.counts}
+        if resource is not None:
+            # Linux 的 ru_maxrss 單位是 KB
+            result['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return result
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def stage(name):
+    """time a stage of the active collector, no-op when nothing is collected"""
+    metrics = _current.get()
+    if metrics is None:
+        return _NULL_STAGE
+    return metrics.stage(name)
+
+
+def count(name, n=1):
+    """add n to a counter of the active collector"""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def enabled():
+    return _current.get() is not None
+
+
+@contextlib.contextmanager
+def collect(name=None, track_memory=False):
+    """activate a StageMetrics collector for the enclosed code"""
+    metrics = StageMetrics(name, track_memory)
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+        metrics.close()
+
+
+class MetricsSummary:
+    """
+    Running summary of the metrics of many images, the per image dicts are not kept
+
+    mean / max / total are exact; p50 / p95 come from a log-spaced histogram of every
+    stage, so they are within HISTOGRAM_RESOLUTION of the exact percentiles and the
+    memory only grows with the range of the values, not with the number of images
+    """
+
+    HISTOGRAM_RESOLUTION = 0.01
+
+    def __init__(self):
+        self.images = 0
+        self.stages = {}
+        self.counts = {}
+        self._log_step = np.log1p(self.HISTOGRAM_RESOLUTION)
+
+    def add(self, result):
+        """
+        Param:
+        result (dict): StageMetrics.to_dict() of one image
+        """
+        self.images += 1
+        for name, record in result['stages'].items():
+            values = self.stages.setdefault(name, {})
+            for key in ('wall', 'cpu', 'peak_memory'):
+                if key in record:
+                    self._add_value(values, key, float(record[key]))
+        for name, value in result['counts'].items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def _add_value(self, values, key, value):
+        state = values.get(key)
+        if state is None:
+            state = values[key] = {'n': 0, 'total': 0.0, 'max': value, 'min': value, 'bins': {}}
+        state['n'] += 1
+        state['total'] += value
+        state['max'] = max(state['max'], value)
+        state['min'] = min(state['min'], value)
+        # 0 以下 (例如沒有配置記憶體) 放在獨立的 bin
+        b = int(np.floor(np.log(value) / self._log_step)) if value > 0 else None
+        state['bins'][b] = state['bins'].get(b, 0) + 1
+
+    def _percentile(self, state, q):
+        # 和 np.percentile 一樣在相鄰的兩個樣本之間線性內插，樣本值取所在 bin 的中心
+        bins = sorted(state['bins'].items(), key=lambda item: -np.inf if item[0] is None else item[0])
+        ends = np.cumsum([n for _, n in bins])
+
+        def value(i):
+            b = bins[int(np.searchsorted(ends, i, side='right'))][0]
+            if b is None:
+                return min(state['max'], 0.0)
+            return min(max(float(np.exp((b + 0.5) * self._log_step)), state['min']), state['max'])
+
+        rank = q / 100.0 * (state['n'] - 1)
+        low = int(np.floor(rank))
+        if low + 1 >= state['n']:
+            return value(low)
+        return value(low) + (rank - low) * (value(low + 1) - value(low))
+
+    def to_dict(self):
+        """
+        Return:
+        dict: per stage mean / p50 / p95 / max / total of the wall and CPU time and
+              peak memory, and the total of every counter
+        """
+        summary = {}
+        for name, values in self.stages.items():
+            summary[name] = {}
+            for key, state in values.items():
+                summary[name][key] = {
+                    'mean': state['total'] / state['n'],
+                    'p50': self._percentile(state, 50),
+                    'p95': self._percentile(state, 95),
+                    'max': state['max'],
+                    'total': state['total'],
+                }
+        return {'images': self.images, 'stages': summary, 'counts': self.counts}
+
+
+def aggregate(results):
+    """
+    Summarize the metrics of many images, see MetricsSummary
+
+    Param:
+    results (iterable): StageMetrics.to_dict() of every image
+
+    Return:
+    dict: per stage mean / p50 / p95 / max / total of the wall and CPU time and
+          peak memory, and the total of every counter
+    """
+    summary = MetricsSummary()
+    for result in results:
+        summary.add(result)
+    return summary.to_dict()
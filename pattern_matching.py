@@ -0,0 +1,455 @@
+import threading
+
+import cv2
+import numpy as np
+import metrics
+
+def adaptive_threshold(max_val):
+    """choose the matching threshold from the best matching score"""
+    if max_val < 0.3:
+        threshold = max_val * 0.8
+        print(f"best matching score is too low, adjust threshold to: {threshold:.3f}")
+    elif max_val < 0.6:
+        threshold = 0.4
+        print(f"use medium threshold: {threshold:.3f}")
+    else:
+        threshold = 0.6
+        print(f"use standard threshold: {threshold:.3f}")
+    return threshold
+
+def filter_matches(candidates, min_distance, top_k=None):
+    """
+    Keep the best match among candidates that are closer than min_distance
+
+    Greedy non-maximum suppression: the accepted matches are bucketed in a grid
+    of min_distance cells, so every candidate is only compared with the matches
+    in the 3x3 neighbouring cells instead of all accepted matches.
+
+    Param:
+    candidates (list): [(x, y, score), ...]
+    min_distance (float): minimum distance between two kept matches
+    top_k (int): stop after top_k matches, None to keep all
+
+    Return:
+    list: [(x, y, score), ...] sorted by score (high to low)
+    """
+    # 按得分排序（從高到低）
+    all_matches = sorted(candidates, key=lambda x: x[2], reverse=True)
+    if min_distance <= 0:
+        return all_matches[:top_k]
+
+    cell = float(min_distance)
+    min_distance_sq = min_distance * min_distance
+    grid = {}
+    filtered_matches = []
+
+    for x_pos, y_pos, match_score in all_matches:
+        cx, cy = int(x_pos // cell), int(y_pos // cell)
+
+        # 檢查是否與已選中的匹配太接近（只需要檢查相鄰的格子）
+        is_duplicate = False
+        for gx in (cx - 1, cx, cx + 1):
+            for gy in (cy - 1, cy, cy + 1):
+                for existing_x, existing_y in grid.get((gx, gy), ()):
+                    if (x_pos - existing_x)**2 + (y_pos - existing_y)**2 < min_distance_sq:
+                        is_duplicate = True
+                        break
+                if is_duplicate:
+                    break
+            if is_duplicate:
+                break
+
+        if not is_duplicate:
+            filtered_matches.append((x_pos, y_pos, match_score))
+            grid.setdefault((cx, cy), []).append((x_pos, y_pos))
+            if top_k is not None and len(filtered_matches) >= top_k:
+                break
+
+    return filtered_matches
+
+def find_peaks(result, threshold, min_distance, top_k=None, offset=(0, 0)):
+    """
+    Local maxima of a score map above threshold
+
+    Only the positions that are the maximum of their neighbourhood (dilate) are
+    collected, which are few even when most of the map is above a low
+    threshold, then filter_matches removes the remaining duplicates.
+
+    Param:
+    result (np.array): score map of cv2.matchTemplate
+    threshold (float): minimum score
+    min_distance (float): minimum distance between two peaks
+    top_k (int): maximum number of peaks, None to keep all
+    offset (tuple): added to the peak positions (crop of a search region)
+
+    Return:
+    list: [(x, y, score), ...] sorted by score (high to low)
+    """
+    radius = max(1, int(min_distance) // 2)
+    kernel = np.ones((2 * radius + 1, 2 * radius + 1), np.uint8)
+    local_max = cv2.dilate(result, kernel)
+
+    ys, xs = np.nonzero((result >= threshold) & (result >= local_max))
+    scores = result[ys, xs]
+    print(f"found {len(scores)} local maxima above threshold")
+    metrics.count('match_candidates', len(scores))
+
+    candidates = zip((xs + offset[0]).tolist(), (ys + offset[1]).tolist(), scores.tolist())
+    return filter_matches(candidates, min_distance, top_k)
+
+def _clip_region(region, image_shape, template_shape):
+    """
+    Convert a search region into the image crop that contains every template
+    position whose top left corner lies inside the region
+    """
+    x, y, w, h = region
+    th, tw = template_shape[:2]
+    x0, y0 = max(0, int(x)), max(0, int(y))
+    x1 = min(image_shape[1], int(x + w) + tw)
+    y1 = min(image_shape[0], int(y + h) + th)
+    if x1 - x0 < tw or y1 - y0 < th:
+        return None
+    return x0, y0, x1, y1
+
+def _match_regions(image, template, search_regions):
+    """matchTemplate on the whole image or only inside the search regions"""
+    if not search_regions:
+        return [((0, 0), cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED))]
+
+    results = []
+    for region in search_regions:
+        crop = _clip_region(region, image.shape, template.shape)
+        if crop is None:
+            continue
+        x0, y0, x1, y1 = crop
+        results.append(((x0, y0), cv2.matchTemplate(image[y0:y1, x0:x1], template,
+                                                    cv2.TM_CCOEFF_NORMED)))
+    return results
+
+def match_template_full(image, template, search_regions=None, top_k=None):
+    """
+    Full resolution template matching
+
+    Param:
+    image (np.array): gray image
+    template (np.array): gray template
+    search_regions (list): [(x, y, w, h), ...] expected top left positions of the
+                           targets, None to search the whole image
+    top_k (int): maximum number of matches, None to keep all
+
+    Return:
+    list: [(x, y, score), ...] matches after the adaptive threshold and duplicate filtering
+    """
+    h, w = template.shape[:2]
+    min_distance = min(w, h) // 2
+    with metrics.stage('match'):
+        results = _match_regions(image, template, search_regions)
+    if not results:
+        return []
+
+    max_val = max(float(result.max()) for _, result in results)
+    threshold = adaptive_threshold(max_val)
+
+    candidates = []
+    with metrics.stage('match_peaks'):
+        for offset, result in results:
+            candidates.extend(block_peaks(result, threshold, min_distance, top_k, offset))
+
+    return filter_matches(candidates, min_distance, top_k)
+
+def _box_sums(integral, h, w):
+    """sums of every h x w window of an integral image, (H - h + 1) x (W - w + 1)"""
+    sums = integral[h:, w:] - integral[:-h, w:]
+    sums -= integral[h:, :-w]
+    sums += integral[:-h, :-w]
+    return sums
+
+class FFTMatcher:
+    """
+    TM_CCOEFF_NORMED of one template with frames of one size, via real DFTs
+
+    cv2.matchTemplate recomputes the template statistics and spectrum on every call;
+    here the padded zero mean template spectrum and its norm are computed once, so a
+    frame costs one forward DFT, one spectrum product and one inverse DFT, and the
+    local variances come from sliding window sums (integral images).
+    The score maps have the same layout as cv2.matchTemplate.
+
+    For a single template this is not faster than cv2.matchTemplate (which also
+    correlates with DFTs); it pays off when many templates share one frame_terms,
+    see auto_detect.TemplateBank.
+
+        matcher = FFTMatcher(template, frame.shape)
+        scores = matcher.scores(frame)
+    """
+
+    def __init__(self, template, frame_shape, dft_shape=None):
+        """
+        Param:
+        template (np.array): gray template
+        frame_shape (tuple): shape of the frames, every frame must have this size
+        dft_shape (tuple): DFT size, default the optimal DFT size of the frame (matchers
+                           with the same dft_shape and template size can share frame_terms)
+        """
+        self.template = template
+        self.frame_shape = tuple(frame_shape[:2])
+        self.h, self.w = template.shape[:2]
+        if self.h > self.frame_shape[0] or self.w > self.frame_shape[1]:
+            raise ValueError(f"template {template.shape[:2]} is larger than the frames {self.frame_shape}")
+        self.dft_shape = tuple(dft_shape or optimal_dft_shape(self.frame_shape))
+
+        with metrics.stage('template_spectra'):
+            zero_mean = template.astype(np.float32) - np.float32(template.mean())
+            self.norm = float(np.sqrt(np.sum(zero_mean.astype(np.float64) ** 2)))
+            padded = np.zeros(self.dft_shape, np.float32)
+            padded[:self.h, :self.w] = zero_mean
+            self.spectrum = cv2.dft(padded)
+        self._local = threading.local()
+
+    @property
+    def score_shape(self):
+        return self.frame_shape[0] - self.h + 1, self.frame_shape[1] - self.w + 1
+
+    def frame_terms(self, frame):
+        """
+        Spectrum and integral images of a frame
+
+        they do not depend on the template, all matchers with the same frame_shape and
+        dft_shape can share them (e.g. the templates of a TemplateBank). The frame mean is
+        removed before the DFT (it does not change the correlation with a zero mean
+        template) to keep the float32 transform accurate on large frames
+
+        Return:
+        tuple: (spectrum, sums, squares)
+        """
+        if frame.shape[:2] != self.frame_shape:
+            raise ValueError(f"frame {frame.shape[:2]} does not match the matcher size {self.frame_shape}")
+        height, width = self.frame_shape
+        # padding 的部分一直是 0，只需要覆寫影像的區域 (每個執行緒一個 buffer)
+        padded = getattr(self._local, 'buffer', None)
+        if padded is None or padded.shape != self.dft_shape:
+            padded = self._local.buffer = np.zeros(self.dft_shape, np.float32)
+        with metrics.stage('match_fft'):
+            np.subtract(frame, np.float32(frame.mean()), out=padded[:height, :width],
+                        dtype=np.float32, casting='unsafe')
+            spectrum = cv2.dft(padded)
+            # sqrBoxFilter 在 uint8 大模板時以 int32 累加會溢位，使用 64 位元積分圖
+            if frame.dtype == np.uint8:
+                sums, squares = cv2.integral2(frame, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+            else:
+                sums = cv2.integral(frame, sdepth=cv2.CV_64F)
+                squares = cv2.integral(frame.astype(np.float64) ** 2, sdepth=cv2.CV_64F)
+        return spectrum, sums, squares
+
+    def scores_from_terms(self, terms):
+        """score map of the frame of frame_terms, None for a flat template"""
+        if self.norm == 0:
+            return None
+        spectrum, sums, squares = terms
+        h, w = self.h, self.w
+        rows, cols = self.score_shape
+        with metrics.stage('match_fft'):
+            product = cv2.mulSpectrums(spectrum, self.spectrum, 0, conjB=True)
+            correlation = cv2.idft(product, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)[:rows, :cols]
+
+            s1 = _box_sums(sums, h, w)
+            variance = _box_sums(squares, h, w)
+            s1 *= s1
+            s1 *= 1.0 / (h * w)
+            variance -= s1
+            np.maximum(variance, 0.0, out=variance)
+            denominator = np.sqrt(variance, out=variance).astype(np.float32)
+            denominator *= np.float32(self.norm)
+            # 平坦的視窗分數為 0
+            flat = denominator <= 1e-6 * self.norm
+            denominator[flat] = 1.0
+            scores = cv2.divide(correlation, denominator)
+            scores[flat] = 0.0
+        return scores
+
+    def scores(self, frame):
+        """TM_CCOEFF_NORMED score map of one frame"""
+        return self.scores_from_terms(self.frame_terms(frame))
+
+def block_peaks(result, threshold, min_distance, top_k=None, offset=(0, 0)):
+    """
+    Local maxima of a score map above threshold, from the maxima of cells
+
+    The map is split into cells of min_distance / 2; a cell is a candidate when its
+    maximum is above threshold and the maximum of its 3x3 neighbouring cells, and only
+    the candidate cells are searched for the peak position. Same result format as
+    find_peaks, but the full size dilate of find_peaks is replaced by one reduction
+    of the map, which matters on large frames.
+    """
+    cell = max(1, int(min_distance) // 2)
+    rows, cols = result.shape
+    grid_rows, grid_cols = -(-rows // cell), -(-cols // cell)
+    padded = np.full((grid_rows * cell, grid_cols * cell), -np.inf, np.float32)
+    padded[:rows, :cols] = result
+    cell_max = padded.reshape(grid_rows, cell, grid_cols, cell).max(axis=(1, 3))
+
+    neighbours = cv2.dilate(cell_max, np.ones((3, 3), np.uint8))
+    candidates = []
+    for gy, gx in zip(*np.nonzero((cell_max >= threshold) & (cell_max >= neighbours))):
+        block = result[gy * cell:(gy + 1) * cell, gx * cell:(gx + 1) * cell]
+        dy, dx = np.unravel_index(int(np.argmax(block)), block.shape)
+        candidates.append((int(gx * cell + dx) + offset[0], int(gy * cell + dy) + offset[1],
+                           float(block[dy, dx])))
+    print(f"found {len(candidates)} local maxima above threshold")
+    metrics.count('match_candidates', len(candidates))
+    return filter_matches(candidates, min_distance, top_k)
+
+def optimal_dft_shape(shape):
+    return cv2.getOptimalDFTSize(shape[0]), cv2.getOptimalDFTSize(shape[1])
+
+def _pyramid_levels(template, levels):
+    """do not downscale the template below a usable size"""
+    while levels > 0 and min(template.shape[:2]) >> levels < 12:
+        levels -= 1
+    return levels
+
+def _downscale(image, levels):
+    for _ in range(levels):
+        image = cv2.pyrDown(image)
+    return image
+
+def refine_match(image, template, x, y, radius):
+    """
+    Search the best full resolution position in a small window around (x, y)
+
+    Return:
+    tuple: (x, y, score), or None if the window is outside the image
+    """
+    h, w = template.shape[:2]
+    x0, y0 = max(0, x - radius), max(0, y - radius)
+    x1 = min(image.shape[1], x + radius + w)
+    y1 = min(image.shape[0], y + radius + h)
+    if x1 - x0 < w or y1 - y0 < h:
+        return None
+
+    result = cv2.matchTemplate(image[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (dx, dy) = cv2.minMaxLoc(result)
+    return x0 + dx, y0 + dy, float(score)
+
+def match_template_pyramid(image, template, levels=2, top_k=32, search_regions=None):
+    """
+    Coarse-to-fine template matching
+
+    The image and the template are downscaled by 2**levels, the best top_k
+    coarse candidates are kept and each one is refined at full resolution in
+    a small window, so the full resolution score map is never computed.
+
+    Param:
+    image (np.array): gray image
+    template (np.array): gray template
+    levels (int): number of pyrDown steps of the coarse level
+    top_k (int): maximum number of coarse candidates to refine
+    search_regions (list): [(x, y, w, h), ...] expected top left positions of the targets (full resolution)
+
+    Return:
+    list: [(x, y, score), ...] full resolution matches, same format as match_template_full
+    """
+    levels = _pyramid_levels(template, levels)
+    if levels == 0:
+        return match_template_full(image, template, search_regions, top_k)
+
+    scale = 1 << levels
+    with metrics.stage('pyramid_downscale'):
+        small_image = _downscale(image, levels)
+        small_template = _downscale(template, levels)
+
+    small_regions = None
+    if search_regions:
+        small_regions = [(x / scale - 1, y / scale - 1, rw / scale + 2, rh / scale + 2)
+                         for x, y, rw, rh in search_regions]
+    coarse = coarse_candidates(small_image, small_template, small_regions, top_k)
+    print(f"found {len(coarse)} coarse candidates at 1/{scale} scale")
+
+    refined = []
+    with metrics.stage('match_refine'):
+        for x, y, _ in coarse:
+            match = refine_match(image, template, x * scale, y * scale, 2 * scale)
+            if match is not None:
+                refined.append(match)
+    return select_refined(refined, template)
+
+def coarse_candidates(small_image, small_template, small_regions=None, top_k=32):
+    """
+    Candidate positions on a downscaled image, refine them with refine_match and select_refined
+
+    Return:
+    list: [(x, y, score), ...] at the downscaled resolution
+    """
+    with metrics.stage('match'):
+        results = _match_regions(small_image, small_template, small_regions)
+    if not results:
+        return []
+
+    # 粗略層只用來挑候選，門檻放寬，真正的門檻在全解析度的分數上決定
+    coarse_max = max(float(result.max()) for _, result in results)
+    small_h, small_w = small_template.shape[:2]
+    small_distance = max(1, min(small_w, small_h) // 2)
+    candidates = []
+    for offset, result in results:
+        candidates.extend(find_peaks(result, coarse_max * 0.5, small_distance, top_k, offset))
+    return filter_matches(candidates, small_distance, top_k)
+
+def select_refined(refined, template):
+    """adaptive threshold and duplicate filtering of the full resolution refined matches"""
+    if not refined:
+        return []
+    h, w = template.shape[:2]
+    threshold = adaptive_threshold(max(score for _, _, score in refined))
+    refined = [m for m in refined if m[2] >= threshold]
+    return filter_matches(refined, min(w, h) // 2)
+
+def regions_around(positions, margin):
+    """search regions of +-margin pixels around known top left positions (e.g. the previous frame)"""
+    return [(x - margin, y - margin, 2 * margin + 1, 2 * margin + 1) for x, y in positions]
+
+def subpixel_offsets(scores):
+    """
+    Sub-pixel offset of the peaks of 3x3 score neighbourhoods (parabola through the
+    peak and its two neighbours on each axis)
+
+    Param:
+    scores (np.array): (n x 3 x 3) scores centered on each integer peak
+
+    Return:
+    np.array: (n x 2) dx, dy in [-0.5, 0.5]
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    center = scores[:, 1, 1]
+    left, right = scores[:, 1, 0], scores[:, 1, 2]
+    up, down = scores[:, 0, 1], scores[:, 2, 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = (left - right) / (2 * (left - 2 * center + right))
+        dy = (up - down) / (2 * (up - 2 * center + down))
+    # 平坦或不是峰值時不修正
+    offsets = np.stack([dx, dy], axis=1)
+    return np.clip(np.nan_to_num(offsets, nan=0.0, posinf=0.0, neginf=0.0), -0.5, 0.5)
+
+def refine_subpixel(image, template, matches):
+    """
+    Sub-pixel positions of integer matches
+
+    the score is only computed at the 3x3 positions around every match (a window of
+    the template size + 2), matches at the image border keep their integer position
+
+    Return:
+    list: [(x, y, score), ...] with float x, y
+    """
+    if not matches:
+        return []
+    h, w = template.shape[:2]
+    neighbourhoods = np.zeros((len(matches), 3, 3))
+    inside = np.zeros(len(matches), bool)
+    with metrics.stage('match_subpixel'):
+        for i, (x, y, _) in enumerate(matches):
+            x, y = int(x), int(y)
+            if x < 1 or y < 1 or x + w + 1 > image.shape[1] or y + h + 1 > image.shape[0]:
+                continue
+            window = image[y - 1:y + h + 1, x - 1:x + w + 1]
+            neighbourhoods[i] = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+            inside[i] = True
+        offsets = np.where(inside[:, None], subpixel_offsets(neighbourhoods), 0.0)
+    return [(x + float(dx), y + float(dy), score) for (x, y, score), (dx, dy) in zip(matches, offsets)]
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+分析流程的 stage graph - 每個 stage 宣告自己的輸入，結果以輸入的 hash 記憶
+
+stage 的 key 由 stage 名稱和各個輸入的 key 組成 (參數的 key 是內容的 hash)，
+所以只改了裁切比例或門檻時，只有依賴它的 stage 會重新計算：
+- 改 color_crop 只重新計算 color (和依賴它的 delta_e_2000 / channels)
+- 改 band_options (分割門檻) 只在 crop='auto' 時影響 color / brightness
+- 同一幀的左右線段只採樣一次，色彩、亮度和色帶分析共用
+- stage 只計算數值；圖表 (report) 和診斷影像 (writer) 是副作用，由 run_analysis 在
+  graph 之外處理，記憶命中時也會送到這次呼叫的 report / writer
+
+使用方法：
+    from pipeline import run_analysis
+    results = run_analysis(image, corners, ['color', 'brightness'], color_crop='auto')
+    left_rgb, right_rgb, delta_e = results['color']
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+import metrics
+from image_processing import sample_corner_lines
+from color_analysis import color_profiles, segment_lines, band_deltas
+from brightness_analysis import brightness_profiles, calculate_brightness_delta
+from color_delta import calculate_color_delta, calculate_lab_delta_e
+from seam_analysis import seam_delta_profile
+from result_cache import ResultCache, array_digest
+from result_store import row_channels
+from visualization import visualize_sampling_lines, print_center_line, save_overlay
+
+# run_analysis 沒有指定的參數
+DEFAULT_PARAMS = {
+    'color_crop': None,
+    'brightness_crop': None,
+    'band_options': {},
+    'seam_block': 8,
+}
+
+ANALYSIS_TARGETS = ('color', 'brightness', 'delta_e_2000', 'channels')
+
+
+@dataclass
+class Stage:
+    name: str
+    func: object
+    inputs: tuple
+    optional: dict = field(default_factory=dict)
+
+
+def param_digest(value):
+    """content key of a run parameter"""
+    if isinstance(value, np.ndarray):
+        return array_digest(value)
+    return ResultCache.key(value)
+
+
+class StageGraph:
+    """
+    Small graph of analysis stages, every stage memoized by the key of its inputs
+
+    only the stages needed by the requested targets are computed; the memo keeps the
+    most recent max_entries stage results (the run parameters such as the image are
+    not kept, only their digests)
+    """
+
+    def __init__(self, max_entries=128):
+        self.stages = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.computed = []
+        self._memo = OrderedDict()
+
+    def add(self, name, func, inputs=(), optional=None):
+        """
+        Param:
+        name (str): stage name
+        func: called with the values of inputs, must not have side effects (a memoized
+              stage is not called again)
+        inputs (tuple): names of other stages or of run parameters
+        optional (dict): {input: predicate(params)}, the input is None and not part of
+                         the key when the predicate is false (e.g. the band pairs with a fixed crop)
+        """
+        if name in self.stages:
+            raise ValueError(f"stage {name} already exists")
+        self.stages[name] = Stage(name, func, tuple(inputs), dict(optional or {}))
+        return self
+
+    def clear(self):
+        self._memo.clear()
+
+    def run(self, targets, params, digests=None):
+        """
+        Compute the target stages and the stages they depend on
+
+        Param:
+        targets (list): stage names
+        params (dict): run parameters (image, corners, crop, ...)
+        digests (dict): known digests of parameters (e.g. the file digest of the image),
+                        the others are hashed from their value
+
+        Return:
+        dict: {target: value}
+        """
+        keys = dict(digests or {})
+        values = {}
+        self.computed = []
+
+        def used_inputs(stage):
+            return [name if name not in stage.optional or stage.optional[name](params) else None
+                    for name in stage.inputs]
+
+        def key_of(name):
+            if name not in keys:
+                if name in self.stages:
+                    stage = self.stages[name]
+                    keys[name] = ResultCache.key(name, [key_of(i) if i else None for i in used_inputs(stage)])
+                elif name in params:
+                    keys[name] = param_digest(params[name])
+                else:
+                    raise KeyError(f"unknown stage or parameter: {name}")
+            return keys[name]
+
+        def value_of(name):
+            if name not in self.stages:
+                return params[name]
+            if name in values:
+                return values[name]
+            key = key_of(name)
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                value = self._memo[key]
+            else:
+                stage = self.stages[name]
+                args = [value_of(i) if i else None for i in used_inputs(stage)]
+                value = stage.func(*args)
+                self.computed.append(name)
+                self._memo[key] = value
+                while len(self._memo) > self.max_entries:
+                    self._memo.popitem(last=False)
+            values[name] = value
+            return value
+
+        with metrics.stage('pipeline'):
+            return {target: value_of(target) for target in targets}
+
+
+def _color(profiles):
+    left_rgb, left_positions, right_rgb, right_positions = profiles
+    return left_rgb, right_rgb, calculate_color_delta(left_rgb, left_positions, right_rgb, right_positions)
+
+
+def _brightness(profiles):
+    left_rgb, _, right_rgb, _ = profiles
+    return left_rgb, right_rgb, calculate_brightness_delta(left_rgb, right_rgb)
+
+
+def _delta_e_2000(color):
+    left_rgb, right_rgb, _ = color
+    return calculate_lab_delta_e(left_rgb, right_rgb)
+
+
+def _channels(color, brightness):
+    return row_channels(color[0], color[1], brightness[0], brightness[1])
+
+
+def _image_path(name, writer):
+    return writer.path(name) if writer is not None else name
+
+
+def _sampling_lines(image, corners, writer=None):
+    visualize_sampling_lines(image, corners, writer)
+    return _image_path('assets/sampling_lines.png', writer)
+
+
+def _center_line(image, corners, writer=None):
+    print_center_line(image, corners, writer)
+    return _image_path('assets/center_line.png', writer)
+
+
+# run_analysis 在 graph 之外產生的診斷影像：{target: func(image, corners, writer, matches) -> path}
+DIAGNOSTIC_IMAGES = {
+    'overlay': lambda image, corners, writer, matches: save_overlay(image, corners, writer, matches=matches),
+    'sampling_lines': lambda image, corners, writer, matches: _sampling_lines(image, corners, writer),
+    'center_line': lambda image, corners, writer, matches: _center_line(image, corners, writer),
+}
+
+# 有 report 時送出圖表的 target：{target: (圖表資料的 stage, submit)}
+CHARTS = {
+    'color': ('color_profiles', lambda report, profiles: report.submit('color', *profiles)),
+    'brightness': ('brightness_profiles', lambda report, profiles: report.submit('brightness', *profiles)),
+    'seam': ('seam', lambda report, profile: report.submit_seam('seam', profile)),
+}
+
+
+def _auto(crop):
+    return lambda params: params.get(crop) == 'auto'
+
+
+def analysis_graph(max_entries=128):
+    """the stages of main.perform_color_analysis"""
+    graph = StageGraph(max_entries)
+    graph.add('lines', sample_corner_lines, ('image', 'corners'))
+    graph.add('band_pairs', lambda lines, options: segment_lines(lines, **options), ('lines', 'band_options'))
+    graph.add('bands', band_deltas, ('band_pairs',))
+    graph.add('color_profiles', color_profiles, ('corners', 'lines', 'color_crop', 'band_pairs'),
+              optional={'band_pairs': _auto('color_crop')})
+    graph.add('brightness_profiles', brightness_profiles, ('corners', 'lines', 'brightness_crop', 'band_pairs'),
+              optional={'band_pairs': _auto('brightness_crop')})
+    graph.add('color', _color, ('color_profiles',))
+    graph.add('brightness', _brightness, ('brightness_profiles',))
+    graph.add('delta_e_2000', _delta_e_2000, ('color',))
+    graph.add('channels', _channels, ('color', 'brightness'))
+    graph.add('seam', lambda image, corners, block: seam_delta_profile(image, corners, block=block),
+              ('image', 'corners', 'seam_block'))
+    return graph
+
+
+_analysis_graph = None
+
+
+def get_analysis_graph():
+    """process wide analysis graph, its memo is shared by every run_analysis call"""
+    global _analysis_graph
+    if _analysis_graph is None:
+        _analysis_graph = analysis_graph()
+    return _analysis_graph
+
+
+def run_analysis(image, corners, targets=ANALYSIS_TARGETS, graph=None, digests=None, report=None,
+                 writer=None, matches=None, **params):
+    """
+    Run the analysis stages of one frame, re-using every stage whose inputs did not change
+
+    the charts of color / brightness / seam are submitted to report and the diagnostic
+    images (DIAGNOSTIC_IMAGES) written with writer on every call, also when the values
+    come from the memo
+
+    Param:
+    image (np.array): BGR image
+    corners (list): the four correction points
+    targets (tuple): stages to compute (see analysis_graph) or DIAGNOSTIC_IMAGES
+    graph (StageGraph): default the process wide graph
+    digests (dict): known digests of the parameters, e.g. {'image': file digest}
+    report (ReportWriter): receives the charts of the targets, None for no charts
+    writer (ImageWriter): writes the diagnostic images, None to write them directly
+    matches (list): (x, y, w, h, score) template match boxes drawn on the overlay
+    params: color_crop, brightness_crop, band_options, seam_block (see DEFAULT_PARAMS)
+
+    Return:
+    dict: {target: value}, the path of the file for a diagnostic image
+    """
+    graph = graph or get_analysis_graph()
+    corners = [tuple(c) for c in corners]
+    params = dict(DEFAULT_PARAMS, image=image, corners=corners, **params)
+    stages = [t for t in targets if t not in DIAGNOSTIC_IMAGES]
+    charts = [t for t in stages if t in CHARTS] if report is not None else []
+    results = graph.run(stages + [CHARTS[t][0] for t in charts], params, digests)
+
+    for target in charts:
+        stage, submit = CHARTS[target]
+        submit(report, results[stage])
+    for target in targets:
+        if target in DIAGNOSTIC_IMAGES:
+            results[target] = DIAGNOSTIC_IMAGES[target](image, corners, writer, matches)
+    return {target: results[target] for target in targets}
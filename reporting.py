@@ -0,0 +1,138 @@
+"""
+Optional report rendering on a background thread
+
+The numeric analysis only hands its profiles to a ReportWriter; the charts are
+rendered by a worker thread from a bounded queue, so the analysis is never
+blocked by matplotlib.
+
+modes:
+- off: nothing is rendered
+- preview: low resolution charts (72 dpi)
+- full: the original 300 dpi charts
+"""
+
+import copy
+import os
+import queue
+import threading
+
+import numpy as np
+
+import metrics
+
+REPORT_MODES = {'off': None, 'preview': 72, 'full': 300}
+
+_STOP = object()
+
+
+class ReportWriter:
+    """render the RGB analysis charts of every analysis in the background"""
+
+    def __init__(self, mode='full', output_dir='assets', max_queue=8, drop_when_full=True):
+        """
+        Param:
+        mode (str): 'off', 'preview' or 'full'
+        output_dir (str): directory of the charts
+        max_queue (int): maximum number of reports waiting to be rendered
+        drop_when_full (bool): drop a report instead of waiting when the queue is full
+        """
+        if mode not in REPORT_MODES:
+            raise ValueError(f"unknown report mode: {mode}, expected one of {list(REPORT_MODES)}")
+        self.mode = mode
+        self.dpi = REPORT_MODES[mode]
+        self.output_dir = output_dir
+        self.drop_when_full = drop_when_full
+        self.written = []
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+
+        if self.enabled:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._thread = threading.Thread(target=self._run, name='report-writer', daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self):
+        return self.dpi is not None
+
+    def submit(self, name, left_rgb, left_pos, right_rgb, right_pos):
+        """
+        Queue the charts of one analysis, the files are named <name>_rgb_*.png
+
+        Return:
+        bool: False if the report was dropped (queue full) or reporting is off
+        """
+        if not self.enabled:
+            return False
+        # 複製資料，呼叫端之後修改陣列也不會影響圖表
+        job = ('rgb', name, (np.array(left_rgb), np.array(left_pos), np.array(right_rgb), np.array(right_pos)))
+        return self._put(job)
+
+    def submit_seam(self, name, profile):
+        """
+        Queue the delta E heatmap of a SeamProfile, the file is named <name>_delta_heatmap.png
+
+        Return:
+        bool: False if the report was dropped (queue full) or reporting is off
+        """
+        if not self.enabled:
+            return False
+        return self._put(('seam', name, (copy.deepcopy(profile),)))
+
+    def _put(self, job):
+        with metrics.stage('report_submit'):
+            try:
+                self._queue.put(job, block=not self.drop_when_full)
+            except queue.Full:
+                self.dropped += 1
+                metrics.count('reports_dropped')
+                return False
+        return True
+
+    def _run(self):
+        # 不使用 pyplot，圖表物件只建立一次並重複使用，記憶體不會隨著報告數量增加
+        from matplotlib.figure import Figure
+        from visualization import set_chart_font, draw_rgb_analysis, draw_rgb_comparison, draw_seam_heatmap
+
+        set_chart_font()
+        charts = {
+            'rgb': [(Figure(figsize=(15, 12)), draw_rgb_analysis, 'rgb_analysis_separated'),
+                    (Figure(figsize=(15, 10)), draw_rgb_comparison, 'rgb_comparison')],
+            'seam': [(Figure(figsize=(15, 8)), draw_seam_heatmap, 'delta_heatmap')],
+        }
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                kind, name, data = job
+                for fig, draw, suffix in charts[kind]:
+                    draw(fig, *data)
+                    path = os.path.join(self.output_dir, f'{name}_{suffix}.png')
+                    fig.savefig(path, dpi=self.dpi, bbox_inches='tight')
+                    self.written.append(path)
+            except Exception as e:
+                print(f"⚠ failed to render report {job[1]}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """wait until every queued report is written"""
+        if self.enabled:
+            self._queue.join()
+
+    def close(self):
+        """write the remaining reports and stop the worker thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
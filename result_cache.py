@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+結果快取 - 以檔案內容的 hash 保存解碼後的影像和中間結果
+
+重新分析同一批圖片時（例如只改了裁切比例或門檻），輸入沒有改變的階段
+直接從快取讀取：
+- 解碼後的影像保存為 .npy，讀取時使用記憶體映射
+- 檢測到的校正點保存為 .json
+- 採樣的左右線段保存為 .npz
+
+key 由圖片內容的 hash 加上該階段的參數組成，任何輸入改變都會得到新的 key。
+快取的總大小有上限，超過時刪除最久沒有使用的檔案 (LRU)。
+
+使用方法：
+    python batch.py assets/frames --rig RIG_A --cache assets/cache
+    python result_cache.py --info
+    python result_cache.py --clear
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+import metrics
+
+DEFAULT_CACHE_DIR = 'assets/cache'
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+# 刪除到上限的這個比例，避免每次寫入都要清理
+_EVICT_TARGET = 0.9
+
+
+def _hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def array_digest(array):
+    """content hash of a numpy array (shape and dtype included)"""
+    array = np.ascontiguousarray(array)
+    # 直接 hash 陣列的 buffer，不複製資料 (和 hash header + tobytes() 的結果相同)
+    digest = hashlib.blake2b(f'{array.dtype.str}{array.shape}'.encode(), digest_size=16)
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """content addressed cache of arrays and json results with size bounded LRU eviction"""
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Param:
+        root (str): cache directory, None disables the cache (every value is computed)
+        max_bytes (int): maximum total size of the cached files
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._total = None
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    @staticmethod
+    def key(*parts):
+        """key of a stage from its inputs (digests, parameters), parts must be json serializable"""
+        return _hash_bytes(json.dumps(parts, sort_keys=True, default=str).encode())
+
+    def file_digest(self, path, chunk_size=1 << 20):
+        """
+        Content hash of a file
+
+        the digest is remembered per (path, size, mtime), so an unchanged file is only read once
+        """
+        stat = os.stat(path)
+        stamp = self.key('file', os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if self.enabled:
+            digest = self._read_json('digest', stamp)
+            if digest is not None:
+                return digest
+
+        with metrics.stage('file_digest'):
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+        if self.enabled:
+            self._write('digest', stamp, '.json', lambda p: _dump_json(p, digest))
+        return digest
+
+    def array(self, key, compute, mmap=True):
+        """
+        Cached numpy array, compute() is only called on a miss
+
+        Param:
+        mmap (bool): memory map the cached .npy instead of reading it
+        """
+        if not self.enabled:
+            return compute()
+        path = self._path('array', key, '.npy')
+        if os.path.exists(path):
+            try:
+                value = np.load(path, mmap_mode='r' if mmap else None)
+                self._hit(path)
+                return value
+            except (OSError, ValueError):
+                pass
+        value = compute()
+        if value is not None:
+            self._write('array', key, '.npy', lambda p: np.save(p, value))
+        return value
+
+    def arrays(self, key, compute):
+        """cached tuple of small arrays (stored together in one .npz)"""
+        if not self.enabled:
+            return compute()
+        path = self._path('arrays', key, '.npz')
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    value = tuple(data[f'arr_{i}'] for i in range(len(data.files)))
+                self._hit(path)
+                return value
+            except (OSError, ValueError):
+                pass
+        value = compute()
+        if value is not None:
+            self._write('arrays', key, '.npz', lambda p: np.savez(p, *value))
+        return value
+
+    def json(self, key, compute):
+        """cached json serializable value"""
+        if not self.enabled:
+            return compute()
+        value = self._read_json('json', key)
+        if value is not None:
+            return value
+        value = compute()
+        if value is not None:
+            self._write('json', key, '.json', lambda p: _dump_json(p, value))
+        return value
+
+    def _path(self, kind, key, ext):
+        return os.path.join(self.root, kind, key[:2], key + ext)
+
+    def _hit(self, path):
+        self.hits += 1
+        metrics.count('cache_hits')
+        try:
+            # mtime 就是 LRU 的使用時間
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _read_json(self, kind, key):
+        path = self._path(kind, key, '.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._hit(path)
+        return value
+
+    def _write(self, kind, key, ext, write):
+        self.misses += 1
+        metrics.count('cache_misses')
+        path = self._path(kind, key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先寫入暫存檔再取代，其他 process 不會讀到寫了一半的檔案
+        tmp_path = f'{path}.{os.getpid()}.tmp{ext}'
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠ cache write failed: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if self._total is None:
+            self._total = self.size()
+        else:
+            self._total += os.path.getsize(path)
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def _files(self):
+        files = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def size(self):
+        """total size of the cached files in bytes"""
+        return sum(size for _, size, _ in self._files()) if self.enabled else 0
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used files until the cache is below the limit
+
+        Return:
+        int: number of removed files
+        """
+        limit = (self.max_bytes if max_bytes is None else max_bytes) * _EVICT_TARGET
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in files:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._total = total
+        metrics.count('cache_evictions', removed)
+        return removed
+
+    def clear(self):
+        if self.enabled and os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+            os.makedirs(self.root, exist_ok=True)
+        self._total = 0
+
+
+def _dump_json(path, value):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(value, f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='inspect or clear the result cache')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--info', action='store_true', help='show the number of files and the size')
+    action.add_argument('--clear', action='store_true', help='remove every cached file')
+    action.add_argument('--evict', type=float, metavar='GB', help='remove the least recently used files above GB')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+        print(f"✓ cache {args.cache_dir} cleared")
+    elif args.evict is not None:
+        removed = cache.evict(int(args.evict * 1024**3))
+        print(f"✓ removed {removed} files, {cache.size() / 1024**2:.1f} MB left")
+    else:
+        files = cache._files()
+        print(f"{args.cache_dir}: {len(files)} files, {sum(s for _, s, _ in files) / 1024**2:.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+結果資料庫 - 保存每次分析的色差歷史 (SQLite)
+
+每次分析（一張圖片或一幀）寫入：
+- runs      一列：rig、來源、幀號、時間、狀態、耗時
+- seams     每個接縫一列：delta_e / delta_e_2000 / delta_brightness / 整條接縫最大色差
+- channels  每個接縫、每個區域 (color / gray / band<i>) 一列：左右 R, G, B 平均值
+- bands     自動分割的每個色帶的色差
+- timings   各階段耗時 (有收集 metrics 時)
+
+查詢用的表都帶有 rig、camera_pair (接縫兩側的相機) 和 timestamp，並以
+(rig, camera_pair, timestamp) 建立索引，例如「最近 10000 幀每個接縫的 ΔE」
+只需要掃描索引的一個範圍，不需要重新處理圖片。寫入先累積在記憶體中，
+每 batch_size 筆在一個 transaction 內寫入。只支援一個寫入的 process。
+
+使用方法：
+    python batch.py assets/frames --rig RIG_A --db assets/results.db
+    python result_store.py assets/results.db --rig RIG_A --last 10000
+    python result_store.py assets/results.db --rig RIG_A --pair 0-1 --metric delta_e_2000
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from color_delta import masked_channel_means
+
+DEFAULT_DB = 'assets/results.db'
+
+SEAM_METRICS = ('delta_e', 'delta_e_2000', 'delta_brightness', 'seam_delta_max')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    rig TEXT NOT NULL,
+    source TEXT,
+    frame INTEGER,
+    timestamp REAL NOT NULL,
+    status TEXT,
+    corners TEXT,
+    elapsed REAL
+);
+CREATE INDEX IF NOT EXISTS runs_rig_time ON runs (rig, timestamp);
+
+CREATE TABLE IF NOT EXISTS seams (
+    run_id INTEGER NOT NULL,
+    rig TEXT NOT NULL,
+    camera_pair TEXT NOT NULL,
+    seam INTEGER,
+    timestamp REAL NOT NULL,
+    delta_e REAL,
+    delta_e_2000 REAL,
+    delta_brightness REAL,
+    seam_delta_max REAL,
+    seam_delta_row REAL
+);
+CREATE INDEX IF NOT EXISTS seams_rig_pair_time ON seams (rig, camera_pair, timestamp);
+CREATE INDEX IF NOT EXISTS seams_rig_time ON seams (rig, timestamp);
+CREATE INDEX IF NOT EXISTS seams_run ON seams (run_id);
+
+CREATE TABLE IF NOT EXISTS channels (
+    run_id INTEGER NOT NULL,
+    rig TEXT NOT NULL,
+    camera_pair TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    region TEXT NOT NULL,
+    left_r REAL, left_g REAL, left_b REAL,
+    right_r REAL, right_g REAL, right_b REAL
+);
+CREATE INDEX IF NOT EXISTS channels_rig_pair_time ON channels (rig, camera_pair, region, timestamp);
+
+CREATE TABLE IF NOT EXISTS bands (
+    run_id INTEGER NOT NULL,
+    rig TEXT NOT NULL,
+    camera_pair TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    band INTEGER,
+    kind TEXT,
+    delta_e REAL,
+    delta_e_2000 REAL,
+    delta_brightness REAL,
+    left_start INTEGER,
+    left_end INTEGER,
+    right_start INTEGER,
+    right_end INTEGER
+);
+CREATE INDEX IF NOT EXISTS bands_rig_pair_time ON bands (rig, camera_pair, timestamp);
+
+CREATE TABLE IF NOT EXISTS timings (
+    run_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    wall REAL,
+    cpu REAL,
+    calls INTEGER
+);
+CREATE INDEX IF NOT EXISTS timings_run ON timings (run_id);
+"""
+
+
+def _float(value):
+    """CSV style values ('' when missing) to float or None"""
+    if value is None or value == '':
+        return None
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def camera_pair(column):
+    """name of the cameras on both sides of the seam in target column `column`"""
+    return f'{column}-{column + 1}'
+
+
+def seam_record(row, column=None):
+    """
+    Seam record of a result row (batch / stream / seam table row, values may be strings)
+
+    the optional keys 'channels' ({region: (left_rgb, right_rgb)}) and 'bands'
+    (color_analysis.band_deltas) of the row are kept
+    """
+    column = row.get('column', 0) if column is None else column
+    return {
+        'seam': int(row.get('seam', 0) or 0),
+        'camera_pair': row.get('camera_pair') or camera_pair(int(column or 0)),
+        'delta_e': _float(row.get('delta_e')),
+        'delta_e_2000': _float(row.get('delta_e_2000')),
+        'delta_brightness': _float(row.get('delta_brightness')),
+        'seam_delta_max': _float(row.get('seam_delta_max')),
+        'seam_delta_row': _float(row.get('seam_delta_row')),
+        'channels': row.get('channels') or {},
+        'bands': row.get('bands') or [],
+    }
+
+
+def row_channels(left_rgb, right_rgb, left_gray=None, right_gray=None):
+    """'channels' of a result row: left / right channel means of the color (and gray) region"""
+    channels = {'color': tuple(masked_channel_means([left_rgb, right_rgb]))}
+    if left_gray is not None:
+        channels['gray'] = tuple(masked_channel_means([left_gray, right_gray]))
+    return channels
+
+
+class ResultStore:
+    """append only SQLite store of the analysis results with batched writes"""
+
+    def __init__(self, path=DEFAULT_DB, batch_size=500):
+        """
+        Param:
+        path (str): database file, created if it does not exist
+        batch_size (int): records kept in memory before they are written in one transaction
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        # WAL: 查詢不會被寫入擋住
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+        self._next_id = (self.connection.execute('SELECT MAX(id) FROM runs').fetchone()[0] or 0) + 1
+        self._pending = {'runs': [], 'seams': [], 'channels': [], 'bands': [], 'timings': []}
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, rig, source, seams=(), timestamp=None, frame=None, status='ok', corners='',
+            elapsed=None, timings=None):
+        """
+        Queue the result of one image / frame
+
+        Param:
+        rig (str): rig ID
+        source (str): image path or stream source
+        seams (list): seam records (see seam_record)
+        timestamp (float): capture or analysis time (seconds since the epoch), default now
+        frame (int): frame index of a stream
+        timings (dict): {stage: {'wall', 'cpu', 'calls'}}, the 'stages' of metrics.StageMetrics.to_dict()
+
+        Return:
+        int: id of the run
+        """
+        run_id = self._next_id
+        self._next_id += 1
+        timestamp = time.time() if timestamp is None else float(timestamp)
+        rig = str(rig)
+        self._pending['runs'].append((run_id, rig, source, frame, timestamp, status, corners,
+                                      _float(elapsed)))
+        for seam in seams:
+            pair = seam['camera_pair']
+            self._pending['seams'].append((
+                run_id, rig, pair, seam['seam'], timestamp, seam['delta_e'], seam['delta_e_2000'],
+                seam['delta_brightness'], seam['seam_delta_max'], seam['seam_delta_row']))
+            for region, (left, right) in seam['channels'].items():
+                self._pending['channels'].append((run_id, rig, pair, timestamp, region,
+                                                  *map(_float, left), *map(_float, right)))
+            for index, band in enumerate(seam['bands']):
+                self._pending['bands'].append((
+                    run_id, rig, pair, timestamp, index, band['kind'], band['delta_e'],
+                    band['delta_e_2000'], band['delta_brightness'], *band['left'], *band['right']))
+                self._pending['channels'].append((run_id, rig, pair, timestamp, f'band{index}',
+                                                  *map(_float, band['left_rgb']),
+                                                  *map(_float, band['right_rgb'])))
+        for stage, values in (timings or {}).items():
+            self._pending['timings'].append((run_id, stage, values.get('wall'), values.get('cpu'),
+                                             values.get('calls')))
+
+        self._count += 1
+        if self._count >= self.batch_size:
+            self.flush()
+        return run_id
+
+    def add_row(self, rig, row, timestamp=None, frame=None):
+        """
+        Queue a result row of batch.analyze_image / stream.run_stream, the seams of a
+        multi-seam row ('seam_rows') are stored as separate seams
+
+        Return:
+        int: id of the run
+        """
+        if row.get('status') == 'ok':
+            seams = [seam_record(r) for r in row.get('seam_rows') or [row]]
+        else:
+            seams = []
+        timings = (row.get('metrics') or {}).get('stages')
+        return self.add(rig, row.get('image') or row.get('source'), seams, timestamp, frame,
+                        row.get('status', 'ok'), str(row.get('corners', '')), row.get('elapsed'), timings)
+
+    def flush(self):
+        """write the queued records in one transaction"""
+        if not self._count:
+            return
+        with self.connection:
+            for table, rows in self._pending.items():
+                if rows:
+                    marks = ', '.join('?' * len(rows[0]))
+                    self.connection.executemany(f'INSERT INTO {table} VALUES ({marks})', rows)
+                    rows.clear()
+        self._count = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    def _cutoff(self, rig, last):
+        """timestamp of the last-th most recent run of the rig (None: every run)"""
+        if not last:
+            return None
+        row = self.connection.execute(
+            'SELECT timestamp FROM runs WHERE rig = ? ORDER BY timestamp DESC LIMIT 1 OFFSET ?',
+            (str(rig), int(last) - 1)).fetchone()
+        return row[0] if row else None
+
+    def seam_summary(self, rig, last=10000, metric='delta_e'):
+        """
+        Statistics of one metric per seam over the last `last` runs of a rig
+
+        Return:
+        list: [(camera_pair, count, mean, min, max), ...]
+        """
+        if metric not in SEAM_METRICS:
+            raise ValueError(f"unknown metric: {metric}")
+        self.flush()
+        cutoff = self._cutoff(rig, last)
+        return self.connection.execute(
+            f'SELECT camera_pair, COUNT({metric}), AVG({metric}), MIN({metric}), MAX({metric}) '
+            f'FROM seams WHERE rig = ? AND timestamp >= ? GROUP BY camera_pair ORDER BY camera_pair',
+            (str(rig), cutoff if cutoff is not None else float('-inf'))).fetchall()
+
+    def seam_history(self, rig, pair, last=10000, metric='delta_e'):
+        """
+        One metric of one seam over the last `last` results, oldest first
+
+        Return:
+        np.array: timestamps
+        np.array: values (NaN where the metric was not computed)
+        """
+        if metric not in SEAM_METRICS:
+            raise ValueError(f"unknown metric: {metric}")
+        self.flush()
+        rows = self.connection.execute(
+            f'SELECT timestamp, {metric} FROM seams WHERE rig = ? AND camera_pair = ? '
+            f'ORDER BY timestamp DESC LIMIT ?', (str(rig), pair, int(last))).fetchall()
+        values = np.array(rows[::-1], dtype=np.float64).reshape(-1, 2)
+        return values[:, 0], values[:, 1]
+
+    def channel_history(self, rig, pair, region='color', last=10000):
+        """
+        Left / right channel means of one seam region over the last `last` results, oldest first
+
+        Return:
+        np.array: timestamps
+        np.array: left means (N x 3, R G B)
+        np.array: right means (N x 3)
+        """
+        self.flush()
+        rows = self.connection.execute(
+            'SELECT timestamp, left_r, left_g, left_b, right_r, right_g, right_b FROM channels '
+            'WHERE rig = ? AND camera_pair = ? AND region = ? ORDER BY timestamp DESC LIMIT ?',
+            (str(rig), pair, region, int(last))).fetchall()
+        values = np.array(rows[::-1], dtype=np.float64).reshape(-1, 7)
+        return values[:, 0], values[:, 1:4], values[:, 4:7]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='query the delta E history of a rig')
+    parser.add_argument('db', nargs='?', default=DEFAULT_DB, help='result database')
+    parser.add_argument('--rig', default='default')
+    parser.add_argument('--last', type=int, default=10000, help='number of most recent results')
+    parser.add_argument('--pair', help='history of one seam (camera pair, e.g. 0-1)')
+    parser.add_argument('--metric', choices=SEAM_METRICS, default='delta_e')
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.db)
+    try:
+        start = time.perf_counter()
+        if args.pair:
+            times, values = store.seam_history(args.rig, args.pair, args.last, args.metric)
+            elapsed = time.perf_counter() - start
+            print(f"{args.rig} {args.pair}: {len(values)} results")
+            if len(values):
+                print(f"{args.metric}: mean {np.nanmean(values):.4f}, min {np.nanmin(values):.4f}, "
+                      f"max {np.nanmax(values):.4f}, latest {values[-1]:.4f}")
+        else:
+            rows = store.seam_summary(args.rig, args.last, args.metric)
+            elapsed = time.perf_counter() - start
+            print(f"{'pair':>8} {'count':>7} {'mean':>9} {'min':>9} {'max':>9}")
+            for pair, count, *values in rows:
+                mean, low, high = (float('nan') if v is None else v for v in values)
+                print(f"{pair:>8} {count:>7} {mean:>9.4f} {low:>9.4f} {high:>9.4f}")
+        print(f"({elapsed * 1000:.1f} ms)")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
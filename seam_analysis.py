@@ -0,0 +1,158 @@
+"""
+Dense color difference along the whole seam
+
+Instead of one pixel column on each side, every row (or block of rows) between
+the targets is compared using the mean of a strip around the left and the right
+sampling line. The strip sums come from integral images, so a window mean
+costs four lookups whatever its size, and several strip widths can be computed
+from the same integral image (one row of the heatmap per width).
+"""
+
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+import metrics
+from color_delta import DELTA_E_METHODS, rgb_to_lab
+from utils import order_corners
+
+# 和 analyze_color_lines 一樣，超過 250 的值視為飽和，不列入平均
+SATURATION_LIMIT = 250
+
+DEFAULT_STRIP_WIDTHS = (1, 5, 9, 17)
+
+
+@dataclass
+class SeamProfile:
+    """per block left / right mean colors and delta E along the seam"""
+    rows: np.ndarray          # center row of every block (n_blocks,)
+    strip_widths: tuple
+    left_rgb: np.ndarray      # (n_widths x n_blocks x 3), NaN where every pixel is saturated
+    right_rgb: np.ndarray
+    delta_e: np.ndarray       # (n_widths x n_blocks)
+    method: str = 'rgb'
+
+    def worst(self, width_index=-1):
+        """
+        Return:
+        int: row of the largest delta E for one strip width (the widest by default)
+        float: the delta E at that row
+        """
+        profile = self.delta_e[width_index]
+        if np.all(np.isnan(profile)):
+            return None, float('nan')
+        index = int(np.nanargmax(profile))
+        return int(self.rows[index]), float(profile[index])
+
+
+def integral_image(values):
+    """
+    Zero padded 2D cumulative sum (cv2.integral), the sum of values[y0:y1, x0:x1] is
+    I[y1, x1] - I[y0, x1] - I[y1, x0] + I[y0, x0]
+    """
+    integral = cv2.integral(np.ascontiguousarray(values), sdepth=cv2.CV_64F)
+    if integral.ndim == 2 and np.ndim(values) == 3:
+        integral = integral[..., None]
+    return integral
+
+
+def _box_sums(integral, y0, y1, x0, x1):
+    """sums of many windows at once, the bounds are arrays of the same shape"""
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def strip_means(image, start, end, rows, block, strip_widths, saturation=SATURATION_LIMIT):
+    """
+    Mean RGB of strips centered on the line start-end, per block of rows
+
+    Param:
+    image (np.array): BGR image
+    start, end (tuple): the sampling line, (x, y)
+    rows (np.array): first row of every block
+    block (int): rows per block
+    strip_widths (tuple): strip widths in pixels, odd widths are centered exactly
+    saturation (int): values above it are skipped per channel
+
+    Return:
+    np.array: mean RGB (n_widths x n_blocks x 3), NaN where a window has no valid sample
+    """
+    height, width = image.shape[:2]
+    (x_start, y_start), (x_end, y_end) = start, end
+    # 斜線時每個 block 取中心列的 x
+    centers = rows + block / 2.0
+    t = np.clip((centers - y_start) / max(y_end - y_start, 1), 0.0, 1.0)
+    xs = np.rint(x_start + t * (x_end - x_start)).astype(np.int64)
+
+    # 只對包含所有 strip 的區域建立積分圖
+    half = max(strip_widths) // 2
+    x_min = int(np.clip(xs.min() - half, 0, width - 1))
+    x_max = int(np.clip(xs.max() + half + 1, x_min + 1, width))
+    y_min = int(np.clip(rows.min(), 0, height - 1))
+    y_max = int(np.clip(rows.max() + block, y_min + 1, height))
+
+    region = image[y_min:y_max, x_min:x_max]
+    valid = region <= saturation
+    sums = integral_image(np.where(valid, region, 0))
+    counts = integral_image(valid.view(np.uint8))
+
+    y0 = np.clip(rows - y_min, 0, y_max - y_min)
+    y1 = np.clip(rows + block - y_min, 0, y_max - y_min)
+    means = np.empty((len(strip_widths), len(rows), 3))
+    for i, strip_width in enumerate(strip_widths):
+        left = strip_width // 2
+        x0 = np.clip(xs - left - x_min, 0, x_max - x_min)
+        x1 = np.clip(xs - left + strip_width - x_min, 0, x_max - x_min)
+        total = _box_sums(sums, y0, y1, x0, x1)
+        n = _box_sums(counts, y0, y1, x0, x1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[i] = np.where(n > 0, total / n, np.nan)
+    # BGR -> RGB
+    return means[..., ::-1]
+
+
+def seam_delta_profile(image, corners, strip_widths=DEFAULT_STRIP_WIDTHS, block=1,
+                       method='rgb', start=0.0, stop=1.0):
+    """
+    Delta E between the left and right strips for every block of rows along the seam
+
+    the left strip follows the left_top-left_bottom line and the right strip the
+    right_top-right_bottom line, the same lines sampled by analyze_color_lines;
+    both sides are compared on the same image rows
+
+    Param:
+    image (np.array): BGR image
+    corners (list): the four correction points
+    strip_widths (tuple): strip widths in pixels, width 1 is the single pixel line
+    block (int): rows per block, 1 for a per row profile
+    method (str): 'rgb' (Euclidean distance of the RGB means, like calculate_color_delta),
+                  'cie76', 'cie94' or 'ciede2000'
+    start, stop (float): part of the seam to analyze, as a fraction of the height between the targets
+
+    Return:
+    SeamProfile
+    """
+    if len(corners) != 4:
+        raise ValueError(f"need 4 correction points, got {len(corners)}")
+    if method != 'rgb' and method not in DELTA_E_METHODS:
+        raise ValueError(f"unknown delta E method: {method}")
+
+    with metrics.stage('seam_profile'):
+        left_top, right_top, left_bottom, right_bottom = order_corners(corners)
+        # sub-pixel 校正點取在兩個 target 之間的整數列
+        top = int(np.ceil(max(left_top[1], right_top[1])))
+        bottom = int(np.floor(min(left_bottom[1], right_bottom[1])))
+        span = bottom - top
+        first, last = top + int(start * span), top + int(stop * span)
+        rows = np.arange(first, max(last, first + 1), block)
+        strip_widths = tuple(int(w) for w in strip_widths)
+
+        left = strip_means(image, left_top, left_bottom, rows, block, strip_widths)
+        right = strip_means(image, right_top, right_bottom, rows, block, strip_widths)
+        if method == 'rgb':
+            delta_e = np.linalg.norm(right - left, axis=-1)
+        else:
+            delta_e = DELTA_E_METHODS[method](rgb_to_lab(left), rgb_to_lab(right))
+        metrics.count('seam_blocks', len(rows))
+
+    return SeamProfile(rows + (block - 1) / 2.0, strip_widths, left, right, delta_e, method)
@@ -0,0 +1,195 @@
+"""
+Multi-seam panoramas
+
+A rig with N cameras has N - 1 (or N, for a 360 panorama) seams, each with a
+target above and below it on both sides. The matched target centers are
+organized into a grid (rows and columns of targets), every 2 x 2 cell of
+neighbouring targets is one seam, and the seams are analyzed on a thread pool
+from the same decoded image (OpenCV and NumPy release the GIL).
+"""
+
+import contextvars
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+from image_processing import sample_corner_lines
+from color_analysis import analyze_color_lines, analyze_color_bands, segment_lines
+from brightness_analysis import brightness_analysis
+from color_delta import calculate_lab_delta_e
+from seam_analysis import seam_delta_profile
+from result_store import row_channels
+
+SEAM_FIELDS = [
+    'seam', 'row', 'column', 'corners', 'delta_e', 'delta_e_2000', 'delta_brightness',
+    'seam_delta_max', 'seam_delta_row', 'status', 'error',
+]
+
+
+@dataclass
+class Seam:
+    """one seam between two columns of targets"""
+    index: int
+    row: int
+    column: int
+    corners: list  # left_top, right_top, left_bottom, right_bottom
+
+
+def cluster_positions(values, tolerance):
+    """
+    Group 1D positions, a new group starts where the gap to the previous value exceeds tolerance
+
+    Return:
+    np.array: group label of every value, labels are ordered by position
+    """
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(values)
+    gaps = np.diff(values[order]) > tolerance
+    labels = np.empty(len(values), np.intp)
+    labels[order] = np.concatenate([[0], np.cumsum(gaps)])
+    return labels
+
+
+def _default_tolerance(centers):
+    """half of the smallest distance between two targets"""
+    points = np.asarray(centers, dtype=np.float64)
+    distances = np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1))
+    np.fill_diagonal(distances, np.inf)
+    return max(1.0, float(distances.min()) / 2)
+
+
+def build_grid(centers, tolerance=None):
+    """
+    Organize target centers into rows and columns
+
+    Param:
+    centers (list): [(x, y), ...] target centers
+    tolerance (float): maximum spread of one row / column, default half the smallest target distance
+
+    Return:
+    list: grid[row][column] = (x, y) or None where no target was found
+    """
+    if len(centers) == 0:
+        return []
+    if tolerance is None:
+        tolerance = _default_tolerance(centers) if len(centers) > 1 else 1.0
+    rows = cluster_positions([y for _, y in centers], tolerance)
+    columns = cluster_positions([x for x, _ in centers], tolerance)
+    grid = [[None] * (columns.max() + 1) for _ in range(rows.max() + 1)]
+    for (x, y), r, c in zip(centers, rows, columns):
+        if grid[r][c] is not None:
+            print(f"⚠ two targets in grid cell ({r}, {c}), keeping the first one")
+            continue
+        grid[r][c] = (x, y)
+    return grid
+
+
+def group_seams(centers, tolerance=None, pairing='adjacent'):
+    """
+    Group the target centers into seams
+
+    Param:
+    centers (list): [(x, y), ...] target centers
+    tolerance (float): see build_grid
+    pairing (str): 'adjacent' every two neighbouring columns form a seam (targets shared
+                   between seams), 'pairs' columns (0, 1), (2, 3), ... form the seams
+
+    Return:
+    list: Seam objects ordered by row then column, seams with a missing target are skipped
+    """
+    if pairing not in ('adjacent', 'pairs'):
+        raise ValueError(f"unknown pairing: {pairing}")
+    grid = build_grid(centers, tolerance)
+    step = 1 if pairing == 'adjacent' else 2
+    seams = []
+    for r in range(len(grid) - 1):
+        top, bottom = grid[r], grid[r + 1]
+        for c in range(0, len(top) - 1, step):
+            corners = [top[c], top[c + 1], bottom[c], bottom[c + 1]]
+            if any(p is None for p in corners):
+                print(f"⚠ seam at row {r} column {c} is missing a target, skipped")
+                continue
+            seams.append(Seam(len(seams), r, c, corners))
+    return seams
+
+
+def analyze_seam(image, seam, report=None, name='seam', seam_block=None, crop=None):
+    """
+    Color, brightness and (optionally) dense seam analysis of one seam
+
+    crop is passed to analyze_color_lines / brightness_analysis ('auto' segments the bands)
+
+    Return:
+    dict: one row of the seam table (see SEAM_FIELDS)
+    """
+    row = {'seam': seam.index, 'row': seam.row, 'column': seam.column,
+           'corners': ';'.join(f'{x},{y}' for x, y in seam.corners), 'delta_e': '', 'delta_e_2000': '',
+           'delta_brightness': '', 'seam_delta_max': '', 'seam_delta_row': '', 'status': 'ok', 'error': ''}
+    try:
+        lines = sample_corner_lines(image, seam.corners)
+        pairs = segment_lines(lines) if crop == 'auto' else None
+        left_rgb, right_rgb, delta_e = analyze_color_lines(image, seam.corners, report,
+                                                           f'{name}_color', lines, crop, pairs)
+        left_gray, right_gray, delta_brightness = brightness_analysis(image, seam.corners, report,
+                                                                     f'{name}_brightness', lines, crop, pairs)
+        row['channels'] = row_channels(left_rgb, right_rgb, left_gray, right_gray)
+        if crop == 'auto':
+            row['bands'] = analyze_color_bands(image, seam.corners, lines, pairs)
+        row['delta_e'] = f'{delta_e:.4f}'
+        row['delta_e_2000'] = f'{calculate_lab_delta_e(left_rgb, right_rgb):.4f}'
+        row['delta_brightness'] = f'{delta_brightness:.4f}'
+        if seam_block:
+            profile = seam_delta_profile(image, seam.corners, block=seam_block)
+            worst_row, worst_delta = profile.worst()
+            row['seam_delta_max'] = f'{worst_delta:.4f}'
+            row['seam_delta_row'] = '' if worst_row is None else worst_row
+            if report is not None:
+                report.submit_seam(name, profile)
+    except Exception as e:
+        row['status'] = 'error'
+        row['error'] = str(e)
+    return row
+
+
+def analyze_seams(image, seams, workers=None, report=None, prefix='', seam_block=None, crop=None):
+    """
+    Analyze every seam of one decoded image on a thread pool
+
+    Param:
+    image (np.array): BGR image, shared (read only) by all threads
+    seams (list): Seam objects from group_seams
+    workers (int): number of threads, default one per seam (at most 8)
+    report (ReportWriter): charts named <prefix>seam<index>_*, None to skip them
+    seam_block (int): rows per block of the dense seam profile, None to skip it
+    crop: 'auto' band segmentation or the fixed crop fractions, see analyze_color_lines
+
+    Return:
+    list: seam table rows in seam order
+    """
+    if not seams:
+        return []
+    workers = workers or min(8, len(seams))
+    with ThreadPoolExecutor(workers, thread_name_prefix='seam') as executor:
+        # 每個執行緒帶著目前的 context，統計資料會記錄在同一個 collector
+        futures = [executor.submit(contextvars.copy_context().run, analyze_seam, image, seam, report,
+                                   f'{prefix}seam{seam.index:02d}', seam_block, crop)
+                   for seam in seams]
+        return [future.result() for future in futures]
+
+
+def print_seam_table(rows):
+    print(f"\n{'seam':>4} {'row':>4} {'col':>4} {'delta_e':>10} {'de2000':>10} {'brightness':>11} {'status':>8}")
+    print('-' * 58)
+    for row in rows:
+        print(f"{row['seam']:>4} {row['row']:>4} {row['column']:>4} {row['delta_e']:>10} "
+              f"{row['delta_e_2000']:>10} {row['delta_brightness']:>11} {row['status']:>8}")
+
+
+def write_seam_table(rows, path, extra_fields=()):
+    """write seam table rows as CSV, extra_fields (e.g. 'image') are written first"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(extra_fields) + SEAM_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
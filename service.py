@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+常駐分析服務 - 本機 HTTP / Unix socket
+
+啟動一次後保持 worker process、模板和 rig 設定在記憶體中，每個請求只需要
+計算時間，不需要重新啟動 Python、載入 OpenCV / matplotlib 和讀取模板。
+同時到達的請求會合併成一批分配到各個 worker。
+
+使用方法：
+    python service.py --rig RIG_A --workers 4                    # http://127.0.0.1:8765
+    python service.py --auto --socket /tmp/stitching.sock
+
+    curl -s localhost:8765/analyze -d '{"images": ["assets/frames/f1.png"]}'
+    curl -s localhost:8765/analyze?name=f1.png --data-binary @f1.png -H 'Content-Type: image/png'
+    curl -s --unix-socket /tmp/stitching.sock http://localhost/health
+
+POST /analyze 的 JSON：
+    images   圖片路徑，或 {"name": ..., "data": base64 編碼的圖片檔}
+    rig      使用模板庫中這個 rig 的模板 (預設為啟動時的模板)
+    crop     "auto" 自動分割色帶
+    seams    多接縫全景圖每個接縫分別分析
+    seam     整條接縫色差分析每個 block 的列數
+非 JSON 的 body 視為一張圖片檔，選項放在 query string。
+回傳 {"results": [batch.py 的結果列, ...], "elapsed": 秒}。
+"""
+
+import argparse
+import base64
+import json
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+import metrics
+from batch import RESULT_FIELDS, analyze_image, load_template, _init_worker, _worker_options
+from result_cache import DEFAULT_MAX_BYTES
+from template_store import DEFAULT_TEMPLATE_DIR
+from reporting import REPORT_MODES
+
+DEFAULT_PORT = 8765
+
+# 一個請求最多等待的秒數
+REQUEST_TIMEOUT = 300
+
+# worker process 內的服務設定，由 _init_service_worker 設定
+_service_options = {}
+
+
+def _init_service_worker(template_dir, *init_args):
+    """batch worker initializer, and remember the template library for the rig of each request"""
+    _init_worker(*init_args)
+    _service_options['template_dir'] = template_dir
+
+
+def _unreadable_row(name):
+    row = dict.fromkeys(RESULT_FIELDS, '')
+    row.update(image=name, status='unreadable')
+    return row
+
+
+def _analyze_job(job):
+    """
+    Analyze one image of a request in a worker process
+
+    Param:
+    job (dict): 'image' path (or name of the uploaded image), 'data' encoded image bytes,
+                'rig' template of the request, 'options' analyze_image options of the request
+    """
+    options = dict(_worker_options)
+    rig = job.get('rig')
+    if rig:
+        # 模板庫在每個 process 中保留已讀取的模板，同一個 rig 只讀一次
+        template, search_regions = load_template(None, rig, _service_options['template_dir'])
+        if template is None:
+            row = _unreadable_row(job['image'])
+            row.update(status='no_template', error=f'no template stored for {rig}')
+            return row
+        options.update(template=template, search_regions=search_regions)
+        if options.get('match_mode') == 'auto':
+            options['match_mode'] = 'full'
+    options.update(job.get('options') or {})
+
+    data = job.get('data')
+    if data is None:
+        return analyze_image(job['image'], **options)
+    with metrics.stage('decode'):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return _unreadable_row(job['image'])
+    return analyze_image(job['image'], image=image, **options)
+
+
+class BatchDispatcher:
+    """
+    Group the jobs of concurrent requests into batches for the worker pool
+
+    the jobs already queued when the pool is fed are sent together (one map_async,
+    several jobs per chunk), so concurrent requests share the IPC round trips;
+    window (seconds) additionally waits for more jobs, 0 adds no latency
+    """
+
+    def __init__(self, pool, workers, max_batch=64, window=0.0):
+        self.pool = pool
+        self.workers = workers
+        self.max_batch = max_batch
+        self.window = window
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='batch-dispatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, jobs):
+        """queue the jobs of one request, return one Future per job (the result row)"""
+        futures = []
+        for job in jobs:
+            future = Future()
+            self._queue.put((job, future))
+            futures.append(future)
+        return futures
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                timeout = deadline - time.perf_counter()
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._dispatch(self._collect(item))
+
+    def _dispatch(self, batch):
+        jobs = [job for job, _ in batch]
+        futures = [future for _, future in batch]
+        self.batches += 1
+        self.jobs += len(jobs)
+
+        def done(rows):
+            for future, row in zip(futures, rows):
+                future.set_result(row)
+
+        def failed(error):
+            for future in futures:
+                future.set_exception(error)
+
+        chunksize = max(1, len(jobs) // (self.workers * 4))
+        self.pool.map_async(_analyze_job, jobs, chunksize, callback=done, error_callback=failed)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _json_default(value):
+    """numpy values of the result rows (channel means, band colors)"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _request_options(params):
+    """analyze_image options of the request parameters"""
+    options = {}
+    if 'crop' in params:
+        options['crop'] = 'auto' if params['crop'] in ('auto', True, 'true', '1') else None
+    if 'seams' in params:
+        options['multi_seam'] = params['seams'] in (True, 'true', '1')
+    if params.get('seam'):
+        options['seam_block'] = int(params['seam'])
+    return options
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    """GET /health, POST /analyze"""
+
+    server_version = 'StitchingAnalysis/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix socket 的 client_address 是空字串
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, default=_json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/health':
+            self._reply(404, {'error': 'not found'})
+            return
+        dispatcher = self.server.dispatcher
+        self._reply(200, {'status': 'ok', 'workers': dispatcher.workers, 'pending': dispatcher.pending,
+                          'batches': dispatcher.batches, 'jobs': dispatcher.jobs,
+                          'uptime': time.time() - self.server.started})
+
+    def _jobs(self, url, body):
+        content_type = self.headers.get('Content-Type', '')
+        # curl -d 預設的 Content-Type 是 x-www-form-urlencoded，也當作 JSON
+        if not content_type.startswith(('application/json', 'application/x-www-form-urlencoded')):
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            return [{'image': params.get('name', 'upload'), 'data': body, 'rig': params.get('rig'),
+                     'options': _request_options(params)}]
+
+        params = json.loads(body or b'{}')
+        if not isinstance(params, dict):
+            raise ValueError('the body must be a JSON object')
+        images = params.get('images') or []
+        if isinstance(images, str):
+            images = [images]
+        if not isinstance(images, list):
+            raise ValueError("'images' must be a path or a list")
+        options = _request_options(params)
+        jobs = []
+        for item in images:
+            job = {'rig': params.get('rig'), 'options': options}
+            if isinstance(item, str):
+                job['image'] = item
+            elif not isinstance(item, dict):
+                raise ValueError(f'invalid image entry: {item!r}')
+            elif 'data' in item:
+                job.update(image=item.get('name', 'upload'), data=base64.b64decode(item['data'], validate=True))
+            else:
+                job['image'] = item['path']
+            jobs.append(job)
+        return jobs
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/analyze':
+            self._reply(404, {'error': 'not found'})
+            return
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            jobs = self._jobs(url, body)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': f'invalid request: {e}'})
+            return
+        if not jobs:
+            self._reply(400, {'error': 'no images'})
+            return
+
+        futures = self.server.dispatcher.submit(jobs)
+        try:
+            rows = [future.result(REQUEST_TIMEOUT) for future in futures]
+        except TimeoutError:
+            self._reply(504, {'error': 'analysis timed out'})
+            return
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {'results': rows, 'elapsed': time.perf_counter() - start})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class AnalysisHTTPServer(ThreadingHTTPServer):
+    # 同時到達的請求很多時，預設的 listen backlog (5) 會拒絕連線
+    request_queue_size = 128
+
+
+def make_server(dispatcher, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None, verbose=False):
+    """HTTP server on host:port, or on a Unix socket if socket_path is given"""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, AnalysisHandler)
+    else:
+        server = AnalysisHTTPServer((host, port), AnalysisHandler)
+    server.dispatcher = dispatcher
+    server.verbose = verbose
+    server.started = time.time()
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='resident stitching color analysis service')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--template', help='gray template of the octagon target')
+    source.add_argument('--rig', help='default rig ID of the template library (requests may name another)')
+    source.add_argument('--auto', action='store_true',
+                        help='detect the targets with synthesized octagon templates (no template needed)')
+    parser.add_argument('--template-dir', default=DEFAULT_TEMPLATE_DIR)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--max-batch', type=int, default=64, help='maximum jobs sent to the pool at once')
+    parser.add_argument('--batch-window', type=float, default=0.0, metavar='MS',
+                        help='wait this long for more requests before dispatching a batch')
+    parser.add_argument('--pyramid', action='store_true', help='coarse-to-fine template matching')
+    parser.add_argument('--auto-bands', action='store_true',
+                        help='segment the color and gray bands by default (requests may override crop)')
+    parser.add_argument('--report', choices=list(REPORT_MODES), default='off')
+    parser.add_argument('--report-dir', default='assets/reports')
+    parser.add_argument('--cache', nargs='?', const='assets/cache', metavar='DIR',
+                        help='reuse decoded images, corners and line samples of earlier requests')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_MAX_BYTES / 1024**3, metavar='GB')
+    parser.add_argument('--warmup', metavar='IMAGE', help='analyze this image once on every worker at startup')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    return parser.parse_args(argv)
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    template_source = (args.template, args.rig, args.template_dir)
+    if not args.auto and load_template(*template_source)[0] is None:
+        print(f"✗ 錯誤: 無法讀取模板 {args.template or args.rig}")
+        return 1
+
+    match_mode = 'auto' if args.auto else 'pyramid' if args.pyramid else 'full'
+    options = {'verbose': False, 'match_mode': match_mode, 'crop': 'auto' if args.auto_bands else None}
+    init_args = (args.template_dir, template_source, options, args.report, args.report_dir,
+                 args.cache, int(args.cache_size * 1024**3))
+    workers = max(1, args.workers or 1)
+
+    with Pool(workers, initializer=_init_service_worker, initargs=init_args) as pool:
+        dispatcher = BatchDispatcher(pool, workers, args.max_batch, args.batch_window / 1000)
+        if args.warmup:
+            start = time.perf_counter()
+            for future in dispatcher.submit([{'image': args.warmup}] * workers):
+                future.result()
+            print(f"✓ warmup {time.perf_counter() - start:.2f}s")
+
+        server = make_server(dispatcher, args.host, args.port, args.socket, args.verbose)
+        address = args.socket or f'http://{args.host}:{server.server_address[1]}'
+        print(f"✓ 分析服務已啟動: {address} ({workers} workers, {match_mode})")
+        signal.signal(signal.SIGTERM, _stop)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            dispatcher.close()
+            if args.socket and os.path.exists(args.socket):
+                os.unlink(args.socket)
+            # 正常關閉 worker，讓每個 process 寫完剩下的報告
+            pool.close()
+            pool.join()
+    print("✓ 分析服務已停止")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+串流統計製程管制 (SPC) - 監控每個接縫、每個通道的色差漂移
+
+每個接縫 (camera_pair) 的每個序列保存固定大小的狀態，每幀的更新是 O(1) 的時間和記憶體：
+- Welford 累積平均和變異數 (整個串流)
+- 基準線：前 warmup 個樣本的平均和標準差，之後固定不變 (漂移不會被吸收進基準線)
+- EWMA：z = λx + (1 - λ)z，超出 μ0 ± L·σ0·sqrt(λ / (2 - λ)) 時警報
+- 雙邊 CUSUM：S± = max(0, S± ± (x - μ0) / σ0 - k)，超過 h 時警報
+
+持續的偏移只警報一次：EWMA 回到管制界限內、CUSUM 歸零 (警報後限制在 h) 之後才會再次警報。
+
+監控的序列 (SERIES)：delta_e (calculate_color_delta)、delta_brightness
+(calculate_brightness_delta) 和色帶 / 灰帶每個通道的右 - 左平均值。
+狀態可以保存成 JSON，下次執行 (main.py 的每張圖片、batch / stream 的下一批) 繼續累積。
+
+使用方法：
+    python stream.py stitched.mp4 --rig RIG_A --spc assets/spc_state.json
+    python batch.py assets/frames --rig RIG_A --spc assets/spc_state.json
+    python spc.py assets/spc_state.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from result_store import seam_record
+
+# 灰帶的第一個通道 (r) 就是 delta_brightness，只監控另外兩個通道
+SERIES = ('delta_e', 'delta_brightness', 'color_r', 'color_g', 'color_b', 'gray_g', 'gray_b')
+
+DEFAULT_STATE = 'assets/spc_state.json'
+
+# 狀態中保留最近的警報數量
+MAX_RECENT_ALARMS = 100
+
+
+@dataclass
+class Alarm:
+    pair: str
+    series: str
+    kind: str        # 'ewma_high' / 'ewma_low' / 'cusum_high' / 'cusum_low'
+    index: int       # 序列中的樣本編號
+    value: float
+    statistic: float
+    baseline: float
+
+
+def row_series(record):
+    """
+    Values of SERIES for one seam record (result_store.seam_record), nan when missing
+
+    the channel series are right - left channel means of the color and gray regions
+    """
+    values = np.full(len(SERIES), np.nan)
+    values[0] = np.nan if record['delta_e'] is None else record['delta_e']
+    values[1] = np.nan if record['delta_brightness'] is None else record['delta_brightness']
+    channels = record['channels']
+    if 'color' in channels:
+        left, right = channels['color']
+        values[2:5] = np.asarray(right, dtype=np.float64) - np.asarray(left, dtype=np.float64)
+    if 'gray' in channels:
+        left, right = channels['gray']
+        values[5:7] = np.asarray(right[1:], dtype=np.float64) - np.asarray(left[1:], dtype=np.float64)
+    return values
+
+
+class ProcessMonitor:
+    """
+    Welford / EWMA / CUSUM state of a fixed set of series, updated one sample vector at a time
+
+    all statistics are numpy vectors over the series, a missing value (nan) leaves its
+    series unchanged
+    """
+
+    def __init__(self, names=SERIES, warmup=100, ewma_lambda=0.2, ewma_limit=3.0,
+                 cusum_k=0.5, cusum_h=5.0):
+        """
+        Param:
+        names (tuple): series names
+        warmup (int): samples of the baseline (μ0, σ0), no alarms before
+        ewma_lambda (float): EWMA weight of the new sample
+        ewma_limit (float): EWMA control limit in asymptotic standard deviations (L)
+        cusum_k (float): CUSUM allowance in σ0, half of the shift to detect
+        cusum_h (float): CUSUM decision interval in σ0
+        """
+        self.names = tuple(names)
+        self.warmup = max(2, int(warmup))
+        self.ewma_lambda = ewma_lambda
+        self.ewma_limit = ewma_limit
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        n = len(self.names)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.baseline = np.full(n, np.nan)
+        self.sigma = np.full(n, np.nan)
+        self.ewma = np.full(n, np.nan)
+        self.cusum_high = np.zeros(n)
+        self.cusum_low = np.zeros(n)
+        # 只在超出管制界限的那一個樣本警報 (EWMA 回到界限內 / CUSUM 歸零後才會再次警報)
+        self.ewma_out = np.zeros(n, dtype=bool)
+        self.cusum_out = np.zeros((2, n), dtype=bool)
+
+    @property
+    def std(self):
+        """running standard deviation of every series"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def ewma_band(self):
+        """half width of the EWMA control band"""
+        lam = self.ewma_lambda
+        return self.ewma_limit * self.sigma * np.sqrt(lam / (2.0 - lam))
+
+    def update(self, values):
+        """
+        Add one sample of every series
+
+        Param:
+        values (np.array): one value per series, nan when missing
+
+        Return:
+        list: [(series index, kind, statistic), ...] alarms raised by this sample
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+
+        # Welford
+        if valid.all():
+            x = values
+            self.count += 1
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (x - self.mean)
+        else:
+            x = np.where(valid, values, 0.0)
+            self.count += valid
+            delta = np.where(valid, x - self.mean, 0.0)
+            self.mean += delta / np.maximum(self.count, 1)
+            self.m2 += delta * np.where(valid, x - self.mean, 0.0)
+
+        # 樣本數剛好達到 warmup 時固定基準線
+        ready = valid & (self.count == self.warmup)
+        if ready.any():
+            sigma = self.std
+            # 沒有變化的序列以平均值的比例作為最小的標準差，避免除以 0
+            floor = np.maximum(np.abs(self.mean) * 1e-3, 1e-6)
+            self.baseline[ready] = self.mean[ready]
+            self.sigma[ready] = np.maximum(np.nan_to_num(sigma[ready]), floor[ready])
+            self.ewma[ready] = self.mean[ready]
+
+        active = valid & (self.count > self.warmup)
+        if not active.any():
+            return []
+        lam = self.ewma_lambda
+        if active.all():
+            # 一般情況：所有序列都有值且已經有基準線
+            self.ewma = lam * x + (1.0 - lam) * self.ewma
+            z = (x - self.baseline) / self.sigma
+            self.cusum_high = np.maximum(0.0, self.cusum_high + z - self.cusum_k)
+            self.cusum_low = np.maximum(0.0, self.cusum_low - z - self.cusum_k)
+        else:
+            self.ewma = np.where(active, lam * x + (1.0 - lam) * self.ewma, self.ewma)
+            z = np.where(active, (x - self.baseline) / np.where(active, self.sigma, 1.0), 0.0)
+            self.cusum_high = np.where(active, np.maximum(0.0, self.cusum_high + z - self.cusum_k),
+                                       self.cusum_high)
+            self.cusum_low = np.where(active, np.maximum(0.0, self.cusum_low - z - self.cusum_k),
+                                      self.cusum_low)
+
+        alarms = []
+        offset = self.ewma - self.baseline
+        out = active & (np.abs(offset) > self.ewma_band)
+        raised = out & ~self.ewma_out
+        if raised.any():
+            for i in np.flatnonzero(raised):
+                alarms.append((int(i), 'ewma_high' if offset[i] > 0 else 'ewma_low', float(self.ewma[i])))
+        self.ewma_out = np.where(active, out, self.ewma_out)
+        for side, (kind, statistic) in enumerate((('cusum_high', self.cusum_high), ('cusum_low', self.cusum_low))):
+            out = active & (statistic > self.cusum_h)
+            raised = out & ~self.cusum_out[side]
+            if raised.any():
+                for i in np.flatnonzero(raised):
+                    alarms.append((int(i), kind, float(statistic[i])))
+            self.cusum_out[side] = np.where(active, (self.cusum_out[side] | out) & (statistic > 0),
+                                            self.cusum_out[side])
+            np.minimum(statistic, self.cusum_h, out=statistic)
+        return alarms
+
+    _ARRAYS = ('count', 'mean', 'm2', 'baseline', 'sigma', 'ewma', 'cusum_high', 'cusum_low', 'ewma_out',
+               'cusum_out')
+    _OPTIONS = ('warmup', 'ewma_lambda', 'ewma_limit', 'cusum_k', 'cusum_h')
+
+    def to_dict(self):
+        state = {'names': list(self.names)}
+        state.update({name: getattr(self, name) for name in self._OPTIONS})
+        state.update({name: [None if isinstance(v, float) and np.isnan(v) else v
+                             for v in getattr(self, name).tolist()] for name in self._ARRAYS})
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        monitor = cls(state['names'], **{name: state[name] for name in cls._OPTIONS})
+        for name in cls._ARRAYS:
+            current = getattr(monitor, name)
+            values = [np.nan if v is None else v for v in state[name]]
+            setattr(monitor, name, np.asarray(values, dtype=current.dtype))
+        return monitor
+
+
+class SPCMonitor:
+    """
+    One ProcessMonitor per seam (camera_pair) of a rig, fed with the result rows of
+    batch / stream / main.py
+
+        monitor = SPCMonitor()
+        for row in rows:
+            for alarm in monitor.update_row(row):
+                print(alarm)
+    """
+
+    def __init__(self, **options):
+        """options: see ProcessMonitor (warmup, ewma_lambda, ewma_limit, cusum_k, cusum_h)"""
+        self.options = options
+        self.monitors = {}
+        self.alarm_count = 0
+        self.recent = deque(maxlen=MAX_RECENT_ALARMS)
+
+    def monitor(self, pair):
+        monitor = self.monitors.get(pair)
+        if monitor is None:
+            monitor = self.monitors[pair] = ProcessMonitor(SERIES, **self.options)
+        return monitor
+
+    def update(self, pair, values):
+        """
+        Add one sample vector (see row_series) of a seam
+
+        Return:
+        list: Alarm objects raised by this sample
+        """
+        monitor = self.monitor(pair)
+        alarms = []
+        for i, kind, statistic in monitor.update(values):
+            alarms.append(Alarm(pair, monitor.names[i], kind, int(monitor.count[i]), float(values[i]),
+                                statistic, float(monitor.baseline[i])))
+        self.alarm_count += len(alarms)
+        self.recent.extend(alarms)
+        return alarms
+
+    def update_row(self, row):
+        """
+        Add a result row (batch.analyze_image / stream.run_stream / seam table row), every
+        seam of a multi-seam row ('seam_rows') is monitored separately; rows that are not
+        'ok' are skipped
+
+        Return:
+        list: Alarm objects
+        """
+        if row.get('status', 'ok') != 'ok':
+            return []
+        alarms = []
+        for seam_row in row.get('seam_rows') or [row]:
+            if seam_row.get('status', 'ok') != 'ok':
+                continue
+            record = seam_record(seam_row)
+            alarms.extend(self.update(record['camera_pair'], row_series(record)))
+        return alarms
+
+    def summary(self):
+        """
+        Return:
+        list: one dict per seam and series (count, mean, std, baseline, sigma, ewma, cusum)
+        """
+        rows = []
+        for pair, monitor in sorted(self.monitors.items()):
+            std = monitor.std
+            for i, name in enumerate(monitor.names):
+                if not monitor.count[i]:
+                    continue
+                rows.append({'pair': pair, 'series': name, 'count': int(monitor.count[i]),
+                             'mean': float(monitor.mean[i]), 'std': float(std[i]),
+                             'baseline': float(monitor.baseline[i]), 'sigma': float(monitor.sigma[i]),
+                             'ewma': float(monitor.ewma[i]), 'cusum_high': float(monitor.cusum_high[i]),
+                             'cusum_low': float(monitor.cusum_low[i])})
+        return rows
+
+    def to_dict(self):
+        return {'options': self.options, 'alarm_count': self.alarm_count,
+                'recent': [asdict(alarm) for alarm in self.recent],
+                'monitors': {pair: monitor.to_dict() for pair, monitor in self.monitors.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        spc = cls(**state.get('options', {}))
+        spc.alarm_count = state.get('alarm_count', 0)
+        spc.recent.extend(Alarm(**alarm) for alarm in state.get('recent', []))
+        spc.monitors = {pair: ProcessMonitor.from_dict(monitor)
+                        for pair, monitor in state.get('monitors', {}).items()}
+        return spc
+
+    def save(self, path):
+        """write the state to a JSON file (atomic replace)"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **options):
+        """the state saved in path, a new monitor with options if the file does not exist"""
+        if not os.path.exists(path):
+            return cls(**options)
+        with open(path, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+def format_alarm(alarm):
+    return (f"⚠ SPC {alarm.kind} {alarm.pair} {alarm.series}: sample {alarm.index}, "
+            f"value {alarm.value:.4f}, statistic {alarm.statistic:.4f} (baseline {alarm.baseline:.4f})")
+
+
+def print_summary(spc):
+    """table of the running statistics of every seam and series"""
+    print(f"\n{'pair':>6} {'series':>16} {'n':>8} {'mean':>9} {'std':>8} {'baseline':>9} "
+          f"{'ewma':>9} {'cusum+':>7} {'cusum-':>7}")
+    for row in spc.summary():
+        print(f"{row['pair']:>6} {row['series']:>16} {row['count']:>8} {row['mean']:>9.4f} "
+              f"{row['std']:>8.4f} {row['baseline']:>9.4f} {row['ewma']:>9.4f} "
+              f"{row['cusum_high']:>7.2f} {row['cusum_low']:>7.2f}")
+    print(f"alarms: {spc.alarm_count}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='show the SPC state of the seam delta E monitor')
+    parser.add_argument('state', nargs='?', default=DEFAULT_STATE, help='SPC state JSON file')
+    parser.add_argument('--alarms', type=int, default=10, help='number of recent alarms to show')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.state):
+        print(f"✗ 錯誤: 找不到 {args.state}")
+        return 1
+    spc = SPCMonitor.load(args.state)
+    print_summary(spc)
+    for alarm in list(spc.recent)[-args.alarms:] if args.alarms > 0 else []:
+        print(format_alarm(alarm))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
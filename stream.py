@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+串流色彩分析程序 - 影片 / 連續影像
+
+功能：
+- 讀取影片檔、影像序列 (例如 frames/%05d.png) 或圖片目錄
+- 只在 keyframe 或追蹤失敗時做完整的 target 檢測
+- 其他幀在上一幀位置附近的小視窗內追蹤四個 octagon 中心
+- 每一幀都計算色差和亮度差，並輸出累積的 delta_e
+
+使用方法：
+    python stream.py stitched.mp4 --rig RIG_A --output stream_results.csv
+    python stream.py "frames/%05d.png" --template assets/extracted_target.png --keyframe-interval 60
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+import cv2
+
+import metrics
+from image_processing import convert_to_gray, sample_corner_lines
+from pattern_matching import match_template_full, match_template_pyramid, refine_match
+from target_center import template_center
+from auto_detect import get_default_bank
+from color_analysis import analyze_color_lines, analyze_color_bands, segment_lines
+from brightness_analysis import brightness_analysis
+from color_delta import ColorDeltaAccumulator, calculate_lab_delta_e
+from batch import collect_images, load_template
+from template_store import DEFAULT_TEMPLATE_DIR, get_template_store
+from reporting import ReportWriter, REPORT_MODES
+from result_store import ResultStore, row_channels
+from spc import SPCMonitor, format_alarm, print_summary
+
+STREAM_FIELDS = [
+    'frame', 'source', 'status', 'keyframe', 'corners', 'delta_e', 'delta_e_2000', 'delta_brightness',
+    'running_delta_e', 'running_delta_brightness', 'elapsed', 'error',
+]
+
+
+def read_frames(source):
+    """
+    Yield (index, name, BGR frame) from a video, an image sequence pattern or an image directory / glob
+    """
+    if os.path.isdir(source) or any(c in source for c in '*?['):
+        for index, path in enumerate(collect_images([source])):
+            frame = cv2.imread(path)
+            if frame is not None:
+                yield index, path, frame
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        print(f"✗ 錯誤: 無法開啟 {source}")
+        return
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield index, source, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+class OctagonTracker:
+    """
+    Track the four octagon targets between keyframes
+
+    A full detection runs on keyframes and whenever tracking fails; the other
+    frames only match the template in a small window around the previous
+    position of every target. With match_mode='auto' the keyframes use the
+    synthesized template bank (no template needed) and the frames in between
+    track the bank template that matched best.
+    """
+
+    def __init__(self, template=None, center=None, keyframe_interval=30, search_margin=24,
+                 min_score=0.5, match_mode='pyramid'):
+        self.template = template
+        self.center = None
+        if template is not None:
+            self.center = center if center is not None else template_center(template)
+        self.keyframe_interval = keyframe_interval
+        self.search_margin = search_margin
+        self.min_score = min_score
+        self.match_mode = match_mode
+        self.positions = []
+        self.frames_since_keyframe = 0
+
+    def _detect(self, gray):
+        if self.match_mode == 'auto':
+            targets = get_default_bank(gray.shape).locate(gray, top_k=4)
+            if len(targets) != 4:
+                return []
+            self.template, self.center = targets[0].template, targets[0].center
+            cx, cy = self.center
+            return [(int(t.x) - cx, int(t.y) - cy) for t in targets]
+        if self.match_mode == 'pyramid':
+            matches = match_template_pyramid(gray, self.template)
+        else:
+            matches = match_template_full(gray, self.template)
+        if len(matches) != 4:
+            return []
+        return [(x, y) for x, y, _ in matches]
+
+    def _track(self, gray):
+        positions = []
+        for x, y in self.positions:
+            match = refine_match(gray, self.template, x, y, self.search_margin)
+            if match is None or match[2] < self.min_score:
+                return []
+            positions.append(match[:2])
+        return positions
+
+    def update(self, gray):
+        """
+        Locate the targets in a new gray frame
+
+        Return:
+        list: the four octagon centers, [] if the targets were not found
+        bool: whether a full detection was run on this frame
+        """
+        keyframe = not self.positions or self.frames_since_keyframe >= self.keyframe_interval
+        if not keyframe:
+            with metrics.stage('track'):
+                positions = self._track(gray)
+        if keyframe or not positions:
+            keyframe = True
+            with metrics.stage('detect'):
+                positions = self._detect(gray)
+
+        self.positions = positions
+        self.frames_since_keyframe = 0 if keyframe else self.frames_since_keyframe + 1
+        if not positions:
+            return [], keyframe
+        cx, cy = self.center
+        return [(x + cx, y + cy) for x, y in positions], keyframe
+
+
+def run_stream(source, tracker, output_path, verbose=False, report=None, metrics_dir=None, crop=None,
+               store=None, rig_id='default', spc=None):
+    """
+    Analyze every frame of a stream and write one CSV row per frame
+
+    the charts of a frame are dropped instead of slowing the stream down when
+    the report queue is full; with metrics_dir the stage metrics of every frame
+    are appended to <metrics_dir>/frames.jsonl and summarized in summary.json;
+    crop='auto' segments the color / gray bands of every frame (see analyze_color_lines);
+    with a ResultStore every frame is also appended to the result database of rig_id;
+    with an SPCMonitor every frame updates the drift statistics of the seam and the alarms
+    are printed as they are raised
+
+    Return:
+    ColorDeltaAccumulator: running statistics of the color band profiles
+    ColorDeltaAccumulator: running statistics of the gray band profiles
+    """
+    accumulator = ColorDeltaAccumulator()
+    brightness_accumulator = ColorDeltaAccumulator()
+    start = time.perf_counter()
+    count = 0
+    # 每幀的 metrics 寫到 frames.jsonl 後只累積到 summary，不保留在記憶體
+    frame_metrics = metrics.MetricsSummary()
+    metrics_file = None
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics_file = open(os.path.join(metrics_dir, 'frames.jsonl'), 'w', encoding='utf-8')
+
+    with open(output_path, 'w', newline='', encoding='utf-8') as f, \
+            metrics_file or contextlib.nullcontext():
+        writer = csv.DictWriter(f, fieldnames=STREAM_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+
+        for index, name, frame in read_frames(source):
+            frame_start = time.perf_counter()
+            row = {'frame': index, 'source': name, 'status': 'ok', 'keyframe': '',
+                   'corners': '', 'delta_e': '', 'delta_e_2000': '', 'delta_brightness': '',
+                   'running_delta_e': '', 'running_delta_brightness': '',
+                   'elapsed': '', 'error': ''}
+
+            log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+            collector = metrics.collect(index) if metrics_file else contextlib.nullcontext()
+            try:
+                with log, collector as current:
+                    corners, keyframe = tracker.update(convert_to_gray(frame))
+                    row['keyframe'] = int(keyframe)
+                    if len(corners) != 4:
+                        row['status'] = 'no_corners'
+                    else:
+                        row['corners'] = ';'.join(f'{x},{y}' for x, y in corners)
+                        lines = sample_corner_lines(frame, corners)
+                        pairs = segment_lines(lines) if crop == 'auto' else None
+                        left_rgb, right_rgb, delta_e = analyze_color_lines(
+                            None, corners, report, f'frame{index:06d}_color', lines, crop, pairs)
+                        left_gray, right_gray, delta_brightness = brightness_analysis(
+                            None, corners, report, f'frame{index:06d}_brightness', lines, crop, pairs)
+                        running_delta_e = accumulator.update(left_rgb, right_rgb)
+                        brightness_accumulator.update(left_gray, right_gray)
+                        row['channels'] = row_channels(left_rgb, right_rgb, left_gray, right_gray)
+                        if crop == 'auto':
+                            row['bands'] = analyze_color_bands(None, corners, lines, pairs)
+                        row['delta_e'] = f'{delta_e:.4f}'
+                        row['delta_e_2000'] = f'{calculate_lab_delta_e(left_rgb, right_rgb):.4f}'
+                        row['delta_brightness'] = f'{delta_brightness:.4f}'
+                        row['running_delta_e'] = f'{running_delta_e:.4f}'
+                        row['running_delta_brightness'] = f'{brightness_accumulator.delta_brightness:.4f}'
+            except Exception as e:
+                row['status'] = 'error'
+                row['error'] = str(e)
+
+            row['elapsed'] = f'{time.perf_counter() - frame_start:.4f}'
+            writer.writerow(row)
+            if metrics_file:
+                row['metrics'] = current.to_dict()
+                frame_metrics.add(row['metrics'])
+                metrics_file.write(json.dumps(row['metrics']) + '\n')
+            if store is not None:
+                store.add_row(rig_id, row, time.time(), index)
+            if spc is not None:
+                for alarm in spc.update_row(row):
+                    print(f"frame {index}: {format_alarm(alarm)}")
+            count += 1
+            if count % 100 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"frame {count}: {count / elapsed:.1f} fps, running delta_e {row['running_delta_e']}")
+
+    if metrics_dir:
+        with open(os.path.join(metrics_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(frame_metrics.to_dict(), f, indent=2)
+
+    elapsed = time.perf_counter() - start
+    if count:
+        print(f"✓ 完成 {count} 幀，耗時 {elapsed:.1f}s ({count / elapsed:.1f} fps)")
+    return accumulator, brightness_accumulator
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='stitching color analysis of a video or image sequence')
+    parser.add_argument('source', help='video file, image sequence pattern, image directory or glob')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--template', help='gray template of the octagon target')
+    source.add_argument('--rig', help='rig ID of a template in the template library')
+    source.add_argument('--auto', action='store_true',
+                        help='detect the targets with synthesized octagon templates (no template needed)')
+    parser.add_argument('--template-dir', default=DEFAULT_TEMPLATE_DIR)
+    parser.add_argument('--output', default='stream_results.csv', help='output CSV path')
+    parser.add_argument('--keyframe-interval', type=int, default=30,
+                        help='run a full detection every N frames')
+    parser.add_argument('--search-margin', type=int, default=24,
+                        help='tracking window radius in pixels')
+    parser.add_argument('--min-score', type=float, default=0.5,
+                        help='tracking score below which a full detection is run')
+    parser.add_argument('--full-match', action='store_true',
+                        help='full resolution matching on keyframes instead of the pyramid')
+    parser.add_argument('--report', choices=list(REPORT_MODES), default='off',
+                        help='charts of every frame: off, preview or full')
+    parser.add_argument('--report-dir', default='assets/reports', help='directory of the charts')
+    parser.add_argument('--metrics', metavar='DIR', help='write per frame stage timings and a summary to DIR')
+    parser.add_argument('--db', metavar='PATH',
+                        help='append every frame to a SQLite result store (see result_store.py)')
+    parser.add_argument('--auto-bands', action='store_true',
+                        help='segment the color and gray bands of every frame instead of the fixed crop fractions')
+    parser.add_argument('--spc', metavar='STATE',
+                        help='monitor the drift of every seam and channel (EWMA / CUSUM alarms), the '
+                             'statistics are loaded from and saved to this JSON file (see spc.py)')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    template, _ = load_template(args.template, args.rig, args.template_dir)
+    if template is None and not args.auto:
+        print(f"✗ 錯誤: 無法讀取模板 {args.template or args.rig}")
+        return 1
+
+    # 模板庫中已經計算好的中心點
+    center = get_template_store(args.template_dir).load(args.rig).center if args.rig else None
+    tracker = OctagonTracker(template, center,
+                             keyframe_interval=args.keyframe_interval,
+                             search_margin=args.search_margin,
+                             min_score=args.min_score,
+                             match_mode=('auto' if args.auto else 'full' if args.full_match else 'pyramid'))
+
+    print(f"=== 串流分析 {args.source} ===")
+    store = ResultStore(args.db) if args.db else None
+    spc = SPCMonitor.load(args.spc) if args.spc else None
+    with ReportWriter(args.report, args.report_dir) as report, store or contextlib.nullcontext():
+        accumulator, brightness_accumulator = run_stream(args.source, tracker, args.output,
+                                                         args.verbose, report, args.metrics,
+                                                         'auto' if args.auto_bands else None,
+                                                         store, args.rig or 'default', spc)
+    if report.dropped:
+        print(f"⚠ {report.dropped} reports were dropped to keep up with the stream")
+    if accumulator.frames:
+        print(f"✓ running delta_e: {accumulator.delta_e:.4f}, "
+              f"running delta_brightness: {brightness_accumulator.delta_brightness:.4f}")
+    if spc is not None:
+        spc.save(args.spc)
+        print_summary(spc)
+        print(f"✓ SPC 狀態已保存到 {args.spc}")
+    print(f"✓ 已保存到 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
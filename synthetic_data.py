@@ -0,0 +1,104 @@
+"""
+Synthetic stitched images with a known answer
+
+The generated image has four octagon targets at known positions around one
+vertical seam. Between the top and the bottom targets both sides have a color
+band followed by a gray band (the right bands start a bit lower, like a
+stitching misalignment), laid out so that the crop fractions of
+analyze_color_lines and brightness_analysis fall inside the bands. The right
+side has a known color / brightness offset, so the expected delta_e and
+delta_brightness are known exactly.
+"""
+
+import numpy as np
+import cv2
+
+# band boundaries as a fraction of the distance between the top and bottom targets,
+# analyze_color_lines uses 0.1-0.65 (left) / 0.2-0.75 (right),
+# brightness_analysis uses 0.65-0.8 (left) / 0.75-0.9 (right)
+LEFT_GRAY_START = 0.65
+RIGHT_GRAY_START = 0.75
+
+def make_octagon_template(size=121, background=230, foreground=30, line_width=3):
+    """
+    Gray octagon target with a crosshair, the center is (size // 2, size // 2)
+    """
+    template = np.full((size, size), background, np.uint8)
+    c = size // 2
+    r = size * 0.42
+    angles = np.pi / 8 + np.arange(8) * np.pi / 4
+    points = np.stack([c + r * np.cos(angles), c + r * np.sin(angles)], axis=1)
+    cv2.fillPoly(template, [np.round(points).astype(np.int32)], foreground)
+    cv2.line(template, (c, int(c - r)), (c, int(c + r)), background, line_width)
+    cv2.line(template, (int(c - r), c), (int(c + r), c), background, line_width)
+    return template
+
+def make_stitched_image(height=1200, width=2000, color=(200, 120, 40), color_offset=(5, 5, -5),
+                        gray=128, gray_offset=10, background=200, noise=2.0, saturation=0.02,
+                        template_size=None, seed=0):
+    """
+    Generate a stitched image with a known left/right color offset
+
+    Param:
+    height, width (int): image size
+    color (tuple): RGB of the left color band
+    color_offset (tuple): RGB offset of the right color band
+    gray (int): value of the left gray band
+    gray_offset (int): offset of the right gray band
+    background (int): value outside the bands
+    noise (float): standard deviation of the gaussian noise
+    saturation (float): fraction of rows with saturated (255) pixels
+    template_size (int): size of the octagon targets, default about 1/10 of the height
+    seed (int): random seed
+
+    Return:
+    np.array: BGR image
+    dict: the known truth (corners, template, template_center, delta_e, delta_brightness, ...)
+    """
+    rng = np.random.default_rng(seed)
+    if template_size is None:
+        template_size = max(61, (height // 10) | 1)
+    template = make_octagon_template(template_size)
+    half = template_size // 2
+
+    x_left, x_right = int(width * 0.3), int(width * 0.7)
+    y_top, y_bottom = int(height * 0.15), int(height * 0.85)
+    span = y_bottom - y_top
+
+    left_color = np.array(color, np.float64)
+    right_color = left_color + np.array(color_offset, np.float64)
+    left_gray = float(gray)
+    right_gray = float(gray + gray_offset)
+
+    image = np.full((height, width, 3), background, np.float64)
+    seam = width // 2
+    left_gray_row = y_top + int(round(LEFT_GRAY_START * span))
+    right_gray_row = y_top + int(round(RIGHT_GRAY_START * span))
+    image[y_top:left_gray_row, :seam] = left_color
+    image[left_gray_row:y_bottom, :seam] = left_gray
+    image[y_top:right_gray_row, seam:] = right_color
+    image[right_gray_row:y_bottom, seam:] = right_gray
+
+    if noise > 0:
+        image += rng.normal(0.0, noise, image.shape)
+    image = np.clip(np.rint(image), 0, 255).astype(np.uint8)[..., ::-1].copy()
+
+    if saturation > 0:
+        # 飽和的 pixel 會被色差計算排除，不影響預期的結果
+        rows = rng.choice(np.arange(y_top, y_bottom), int(saturation * span), replace=False)
+        image[rows, :] = 255
+
+    corners = [(x_left, y_top), (x_right, y_top), (x_left, y_bottom), (x_right, y_bottom)]
+    for x, y in corners:
+        image[y - half:y - half + template_size, x - half:x - half + template_size] = template[..., None]
+
+    truth = {
+        'corners': corners,
+        'template': template,
+        'template_center': (half, half),
+        'left_rgb': tuple(left_color),
+        'right_rgb': tuple(right_color),
+        'delta_e': float(np.linalg.norm(right_color - left_color)),
+        'delta_brightness': right_gray - left_gray,
+    }
+    return image, truth
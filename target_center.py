@@ -1,6 +1,11 @@
+import hashlib
+
 import cv2
 import numpy as np
 
+# template_center 的結果，key 為模板內容的 hash
+_center_cache = {}
+
 def visualize_center(target, center):
     """mark the center point on the image"""
     result = target.copy()
@@ -46,37 +51,27 @@ def find_center_by_hough_lines(target):
         print("no lines found")
         return None, target
     
-    horizontal_lines = []
-    vertical_lines = []
-    
-    # classify horizontal and vertical lines
-    for line in lines:
-        x1, y1, x2, y2 = line[0]
-        
-        # calculate the angle
-        angle = np.arctan2(y2 - y1, x2 - x1) * 180 / np.pi
-        
-        # horizontal line (angle near 0 or 180)
-        if abs(angle) < 10 or abs(angle) > 170:
-            horizontal_lines.append(line[0])
-        # vertical
-        elif abs(abs(angle) - 90) < 10:
-            vertical_lines.append(line[0])
-    
-    if not horizontal_lines or not vertical_lines:
+    # classify horizontal and vertical lines by the angle (all lines at once)
+    lines = lines[:, 0]
+    x1, y1, x2, y2 = lines.T
+    angle = np.abs(np.degrees(np.arctan2(y2 - y1, x2 - x1)))
+    horizontal_lines = lines[(angle < 10) | (angle > 170)]
+    vertical_lines = lines[np.abs(angle - 90) < 10]
+
+    if len(horizontal_lines) == 0 or len(vertical_lines) == 0:
         print("no enough horizontal or vertical lines")
         return None, target
-    
+
     # find the horizontal and vertical lines closest to the image center
     img_center_x, img_center_y = target.shape[1] // 2, target.shape[0] // 2
-    
-    best_h_line = min(horizontal_lines, key=lambda line: abs((line[1] + line[3]) / 2 - img_center_y))
-    best_v_line = min(vertical_lines, key=lambda line: abs((line[0] + line[2]) / 2 - img_center_x))
-    
+
+    h_centers = (horizontal_lines[:, 1] + horizontal_lines[:, 3]) / 2
+    v_centers = (vertical_lines[:, 0] + vertical_lines[:, 2]) / 2
+
     # calculate the intersection
-    h_y = (best_h_line[1] + best_h_line[3]) / 2
-    v_x = (best_v_line[0] + best_v_line[2]) / 2
-    
+    h_y = h_centers[np.argmin(np.abs(h_centers - img_center_y))]
+    v_x = v_centers[np.argmin(np.abs(v_centers - img_center_x))]
+
     center = (int(v_x), int(h_y))
     result = visualize_center(target, center)
     
@@ -106,3 +101,43 @@ def find_center_by_corners(target):
         cv2.circle(result, (int(x), int(y)), 3, (255, 0, 0), -1)
     
     return center, result
+
+def _binarize(target):
+    """dark target on a light background (or the opposite) as a 0 / 255 mask of the target"""
+    _, mask = cv2.threshold(target, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    # 目標應該比背景小，反了就取反
+    if np.count_nonzero(mask) > mask.size // 2:
+        mask = cv2.bitwise_not(mask)
+    return mask
+
+def template_center(target):
+    """
+    Center of the target in a template, computed once per template content
+
+    The crosshair intersection (hough lines) is tried first, the centroid of the
+    target contour and the mean of the corners are fallbacks that only run when
+    the previous method found nothing, the template center is the last resort.
+
+    Return:
+    tuple: (cx, cy) in template coordinates, never None
+    """
+    target = np.ascontiguousarray(target)
+    if target.ndim == 3:
+        target = cv2.cvtColor(target, cv2.COLOR_BGR2GRAY)
+    key = (target.shape, hashlib.blake2b(target.tobytes(), digest_size=16).hexdigest())
+    center = _center_cache.get(key)
+    if center is not None:
+        return center
+
+    center, _ = find_center_by_hough_lines(target)
+    if center is None:
+        center, _ = find_center_by_contours(_binarize(target))
+    if center is None:
+        center, _ = find_center_by_corners(target)
+    if center is None:
+        print("⚠ no center found, using the template center")
+        center = (target.shape[1] // 2, target.shape[0] // 2)
+
+    center = (int(center[0]), int(center[1]))
+    _center_cache[key] = center
+    return center
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+模板庫 - 依 rig / camera ID 保存 target 模板
+
+每個模板只需要框選一次：模板圖 (<rig_id>.png) 和它的中心點、尺寸等資訊
+(<rig_id>.json) 會保存在磁碟上，之後的執行直接讀取，並在同一個 process
+內保留在記憶體中。
+
+使用方法：
+    python template_store.py RIG_A --from-file assets/extracted_target.png
+    python template_store.py RIG_A --from-image assets/image.png   # 手動框選
+    python template_store.py RIG_A --from-file target.png --search-region 500,100,200,200
+
+rig profile 的 search_regions (x, y, w, h) 是 target 左上角預期出現的範圍，
+模板匹配只會在這些範圍內搜尋。
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+
+import cv2
+
+from target_center import template_center
+
+DEFAULT_TEMPLATE_DIR = 'assets/templates'
+
+
+@dataclass
+class TemplateEntry:
+    """one stored template with its precomputed information"""
+    rig_id: str
+    template: object
+    center: tuple = None
+    metadata: dict = field(default_factory=dict)
+
+
+class TemplateStore:
+    """templates keyed by rig / camera ID, stored on disk and kept warm in memory"""
+
+    def __init__(self, root=DEFAULT_TEMPLATE_DIR):
+        self.root = root
+        self._entries = {}
+
+    def _paths(self, rig_id):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', str(rig_id))
+        return (os.path.join(self.root, f'{name}.png'),
+                os.path.join(self.root, f'{name}.json'))
+
+    def __contains__(self, rig_id):
+        return rig_id in self._entries or os.path.exists(self._paths(rig_id)[0])
+
+    def ids(self):
+        """rig IDs of all templates on disk"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.root)
+                      if name.endswith('.png'))
+
+    def load(self, rig_id):
+        """return the TemplateEntry of rig_id, or None if it was never saved"""
+        entry = self._entries.get(rig_id)
+        if entry is not None:
+            return entry
+
+        image_path, info_path = self._paths(rig_id)
+        template = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if template is None:
+            return None
+
+        info = {}
+        if os.path.exists(info_path):
+            with open(info_path, encoding='utf-8') as f:
+                info = json.load(f)
+        center = info.pop('center', None)
+        # 舊的模板庫沒有保存中心點（或當時找不到），在這裡補上
+        center = tuple(center) if center else template_center(template)
+        entry = TemplateEntry(rig_id, template, center, info)
+        self._entries[rig_id] = entry
+        return entry
+
+    def save(self, rig_id, template, metadata=None):
+        """
+        Save a gray template with its center, overwriting the previous one
+
+        Param:
+        rig_id (str): rig or camera ID
+        template (np.array): gray template
+        metadata (dict): extra information stored in the json file
+
+        Return:
+        TemplateEntry: the saved entry
+        """
+        center = template_center(template)
+        info = dict(metadata or {})
+        info.update({
+            'rig_id': str(rig_id),
+            'size': [int(template.shape[1]), int(template.shape[0])],
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+
+        os.makedirs(self.root, exist_ok=True)
+        image_path, info_path = self._paths(rig_id)
+        cv2.imwrite(image_path, template)
+        # 先寫入暫存檔再取代，避免其他 process 讀到寫了一半的 json
+        tmp_path = info_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(info, center=[int(c) for c in center]), f, indent=2)
+        os.replace(tmp_path, info_path)
+
+        entry = TemplateEntry(rig_id, template, center, info)
+        self._entries[rig_id] = entry
+        print(f"✓ template of {rig_id} saved to {image_path}")
+        return entry
+
+
+_default_stores = {}
+
+
+def get_template_store(root=DEFAULT_TEMPLATE_DIR):
+    """process-wide store, so the templates stay in memory across frames"""
+    store = _default_stores.get(root)
+    if store is None:
+        store = _default_stores[root] = TemplateStore(root)
+    return store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='add a target template to the template library')
+    parser.add_argument('rig_id', help='rig or camera ID')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--from-file', help='existing template image')
+    source.add_argument('--from-image', help='stitched image to select the target from (GUI)')
+    parser.add_argument('--template-dir', default=DEFAULT_TEMPLATE_DIR)
+    parser.add_argument('--search-region', action='append', default=[], metavar='X,Y,W,H',
+                        help='expected top left region of a target, can be repeated')
+    args = parser.parse_args(argv)
+
+    if args.from_file:
+        template = cv2.imread(args.from_file, cv2.IMREAD_GRAYSCALE)
+        source_path = args.from_file
+    else:
+        from calibration import extract_target_manually
+        image = cv2.imread(args.from_image, cv2.IMREAD_GRAYSCALE)
+        template = extract_target_manually(image) if image is not None else None
+        source_path = args.from_image
+
+    if template is None:
+        print(f"✗ 錯誤: 無法取得模板 {source_path}")
+        return 1
+
+    metadata = {'source': source_path}
+    if args.search_region:
+        metadata['search_regions'] = [[int(v) for v in region.split(',')]
+                                      for region in args.search_region]
+    entry = TemplateStore(args.template_dir).save(args.rig_id, template, metadata)
+    print(f"✓ center: {entry.center}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
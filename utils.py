@@ -18,4 +18,17 @@ def save_results(image, corners, method_name):
     
     filename = f"assets/{method_name}_labeled.png"
     cv2.imwrite(filename, result_image)
-    return filename 
\ No newline at end of file
+    return filename 
+
+def order_corners(corners):
+    """
+    Sort the four correction points
+
+    Return:
+    tuple: left_top, right_top, left_bottom, right_bottom
+    """
+    # 按y座標排序，前兩個是上方的點，後兩個是下方的點
+    sorted_corners = sorted(corners, key=lambda p: p[1])
+    left_top, right_top = sorted(sorted_corners[:2], key=lambda p: p[0])
+    left_bottom, right_bottom = sorted(sorted_corners[2:], key=lambda p: p[0])
+    return left_top, right_top, left_bottom, right_bottom
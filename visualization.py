@@ -1,95 +1,172 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
+from utils import order_corners
+from seams import group_seams
 
-def plot_rgb_analysis(left_rgb, left_pos, right_rgb, right_pos):
-    """plot the RGB analysis chart"""
-    
-    # set the Chinese font (to handle Chinese display issues)
-    plt.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei', 'DejaVu Sans']
-    plt.rcParams['axes.unicode_minus'] = False
+# matplotlib 只在繪製圖表時才載入，只需要數值結果的 process (batch / stream worker) 不需要付出它的啟動時間
+
+def _pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+def set_chart_font():
+    """set the Chinese font (to handle Chinese display issues)"""
+    import matplotlib
+    matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei', 'DejaVu Sans']
+    matplotlib.rcParams['axes.unicode_minus'] = False
+
+def draw_rgb_analysis(fig, left_rgb, left_pos, right_rgb, right_pos):
+    """draw the separated RGB analysis chart on an existing figure"""
+    fig.clear()
     
     # create a 3x2 subplot layout: 3 rows (R, G, B), 2 columns (left line, right line)
-    fig, axes = plt.subplots(3, 2, figsize=(15, 12))
+    axes = fig.subplots(3, 2)
     fig.suptitle('RGB value analysis - display by channel', fontsize=16, fontweight='bold')
     
     colors = ['red', 'green', 'blue']
     channel_names = ['Red', 'Green', 'Blue']
     channel_names_ch = ['red channel', 'green channel', 'blue channel']
     
-    # plot the RGB value of the left line (first column)
-    for i in range(3):
-        axes[i, 0].plot(left_pos, left_rgb[:, i], color=colors[i], linewidth=2.5)
-        axes[i, 0].set_title(f'left line - {channel_names_ch[i]}', fontsize=12, fontweight='bold')
-        axes[i, 0].set_ylabel(f'{channel_names[i]} value (0-255)', fontsize=10)
-        axes[i, 0].grid(True, alpha=0.3)
-        axes[i, 0].set_ylim(0, 255)
-        axes[i, 0].fill_between(left_pos, left_rgb[:, i], alpha=0.3, color=colors[i])
-        
-        # only add the x-axis label on the bottommost figure
-        if i == 2:
-            axes[i, 0].set_xlabel('distance from the starting point', fontsize=10)
-    
-    # plot the RGB value of the right line (second column)
-    for i in range(3):
-        axes[i, 1].plot(right_pos, right_rgb[:, i], color=colors[i], linewidth=2.5)
-        axes[i, 1].set_title(f'right line - {channel_names_ch[i]}', fontsize=12, fontweight='bold')
-        axes[i, 1].set_ylabel(f'{channel_names[i]} value (0-255)', fontsize=10)
-        axes[i, 1].grid(True, alpha=0.3)
-        axes[i, 1].set_ylim(0, 255)
-        axes[i, 1].fill_between(right_pos, right_rgb[:, i], alpha=0.3, color=colors[i])
-        
-        # only add the x-axis label on the bottommost figure
-        if i == 2:
-            axes[i, 1].set_xlabel('distance from the starting point', fontsize=10)
-    
-    plt.tight_layout()
-    plt.savefig('assets/rgb_analysis_separated.png', dpi=300, bbox_inches='tight')
-    print("✓ separated RGB analysis chart saved to assets/rgb_analysis_separated.png")
+    # plot the RGB value of the left line (first column) and the right line (second column)
+    for col, (side, rgb, pos) in enumerate([('left', left_rgb, left_pos), ('right', right_rgb, right_pos)]):
+        for i in range(3):
+            axes[i, col].plot(pos, rgb[:, i], color=colors[i], linewidth=2.5)
+            axes[i, col].set_title(f'{side} line - {channel_names_ch[i]}', fontsize=12, fontweight='bold')
+            axes[i, col].set_ylabel(f'{channel_names[i]} value (0-255)', fontsize=10)
+            axes[i, col].grid(True, alpha=0.3)
+            axes[i, col].set_ylim(0, 255)
+            axes[i, col].fill_between(pos, rgb[:, i], alpha=0.3, color=colors[i])
+            
+            # only add the x-axis label on the bottommost figure
+            if i == 2:
+                axes[i, col].set_xlabel('distance from the starting point', fontsize=10)
+    
+    fig.tight_layout()
+
+def plot_rgb_analysis(left_rgb, left_pos, right_rgb, right_pos, prefix='', dpi=300):
+    """
+    plot the RGB analysis chart
+
+    the charts are saved as assets/<prefix>rgb_analysis_separated.png and
+    assets/<prefix>rgb_comparison.png, use ReportWriter to render them in the background
+    """
+    plt = _pyplot()
+    set_chart_font()
+    fig = plt.figure(figsize=(15, 12))
+    try:
+        draw_rgb_analysis(fig, left_rgb, left_pos, right_rgb, right_pos)
+        path = f'assets/{prefix}rgb_analysis_separated.png'
+        fig.savefig(path, dpi=dpi, bbox_inches='tight')
+        print(f"✓ separated RGB analysis chart saved to {path}")
+    finally:
+        plt.close(fig)
     
     # generate a comparison chart for easy comparison of the left and right lines
-    plot_rgb_comparison(left_rgb, left_pos, right_rgb, right_pos)
+    plot_rgb_comparison(left_rgb, left_pos, right_rgb, right_pos, prefix, dpi)
+
+def _pixel(point):
+    """integer pixel of a (sub-pixel) point for the OpenCV drawing functions"""
+    return int(round(point[0])), int(round(point[1]))
+
+def _seam_pixels(corners):
+    """integer (left_top, right_top, left_bottom, right_bottom) of every seam"""
+    if len(corners) == 4:
+        seam_corners = [order_corners(corners)]
+    else:
+        seam_corners = [seam.corners for seam in group_seams(corners)]
+    return [[_pixel(p) for p in points] for points in seam_corners]
+
+def to_bgr(image):
+    """new BGR copy of a gray or BGR image to draw on, the original is never modified"""
+    if len(image.shape) == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return image.copy()
+
+def save_image(canvas, name, writer=None):
+    """write a diagnostic image now, or queue it on an image_writer.ImageWriter"""
+    if writer is None:
+        cv2.imwrite(name, canvas)
+        return name
+    return writer.submit(name, canvas)
+
+def draw_sampling_lines(canvas, corners):
+    """draw the sampling lines and corners of every seam onto canvas (BGR, modified in place)"""
+    seam_corners = _seam_pixels(corners)
+    labels = ['left_top', 'right_top', 'left_bottom', 'right_bottom']
+    for index, (left_top, right_top, left_bottom, right_bottom) in enumerate(seam_corners):
+        # draw the two sampling lines
+        cv2.line(canvas, left_top, left_bottom, (255, 0, 0), 3)  # blue left line
+        cv2.line(canvas, right_top, right_bottom, (0, 255, 0), 3)  # green right line
+        
+        # mark the four corners
+        for i, point in enumerate([left_top, right_top, left_bottom, right_bottom]):
+            cv2.circle(canvas, point, 8, (0, 0, 255), -1)
+            if len(seam_corners) == 1:
+                cv2.putText(canvas, labels[i], (point[0]+10, point[1]-10),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
+        if len(seam_corners) > 1:
+            cv2.putText(canvas, f'seam {index}',
+                       ((left_top[0] + right_top[0]) // 2 - 30, (left_top[1] + left_bottom[1]) // 2),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+    return canvas
+
+def draw_center_lines(canvas, corners):
+    """draw the center line of every seam onto canvas (BGR, modified in place)"""
+    for left_top, right_top, left_bottom, right_bottom in _seam_pixels(corners):
+        mid_top = (left_top[0] + right_top[0]) // 2, (left_top[1] + right_top[1]) // 2
+        mid_bottom = (left_bottom[0] + right_bottom[0]) // 2, (left_bottom[1] + right_bottom[1]) // 2
+        cv2.line(canvas, mid_top, mid_bottom, (0, 0, 255), 3)
+    return canvas
 
-def visualize_sampling_lines(image, corners):
-    """visualize the sampling lines"""
-    if len(corners) != 4:
+def draw_matches(canvas, matches):
+    """
+    draw the template match boxes and their scores onto canvas (BGR, modified in place)
+
+    Param:
+    matches (list): [(x, y, w, h, score), ...] top left corner and size of every match
+    """
+    for i, (x, y, w, h, score) in enumerate(matches):
+        top_left, bottom_right = _pixel((x, y)), _pixel((x + w, y + h))
+        cv2.rectangle(canvas, top_left, bottom_right, (0, 255, 0), 2)
+        cv2.putText(canvas, f'Match{i+1}: {score:.2f}', (top_left[0], top_left[1] - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+    return canvas
+
+def compose_overlay(image, corners, matches=None):
+    """
+    All diagnostics of one analysis on a single BGR copy of the image: template matches
+    (see draw_matches), sampling lines, corners and center lines (one color conversion
+    instead of one per diagnostic image)
+    """
+    canvas = to_bgr(image)
+    if matches:
+        draw_matches(canvas, matches)
+    if len(corners) >= 4:
+        draw_sampling_lines(canvas, corners)
+        draw_center_lines(canvas, corners)
+    return canvas
+
+def save_overlay(image, corners, writer=None, name='assets/overlay.png', matches=None):
+    """compose the overlay of the analysis and write it (see compose_overlay)"""
+    path = save_image(compose_overlay(image, corners, matches), name, writer)
+    print(f"✓ overlay saved to {path}")
+    return path
+
+def visualize_sampling_lines(image, corners, writer=None):
+    """visualize the sampling lines, every seam is drawn when there are more than four corners"""
+    if len(corners) < 4:
         return
     
-    # create the result image
-    result_image = image.copy()
-    if len(result_image.shape) == 2:
-        result_image = cv2.cvtColor(result_image, cv2.COLOR_GRAY2BGR)
-    
-    # determine the position of the four points
-    sorted_corners = sorted(corners, key=lambda p: p[1])
-    top_points = sorted(sorted_corners[:2], key=lambda p: p[0])
-    bottom_points = sorted(sorted_corners[2:], key=lambda p: p[0])
-    
-    left_top = top_points[0]
-    right_top = top_points[1]
-    left_bottom = bottom_points[0]
-    right_bottom = bottom_points[1]
-    
-    # draw the two sampling lines
-    cv2.line(result_image, left_top, left_bottom, (255, 0, 0), 3)  # blue left line
-    cv2.line(result_image, right_top, right_bottom, (0, 255, 0), 3)  # green right line
-    
-    # mark the four corners
-    for i, point in enumerate([left_top, right_top, left_bottom, right_bottom]):
-        cv2.circle(result_image, point, 8, (0, 0, 255), -1)
-        labels = ['left_top', 'right_top', 'left_bottom', 'right_bottom']
-        cv2.putText(result_image, labels[i], (point[0]+10, point[1]-10),
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
-    
-    cv2.imwrite('assets/sampling_lines.png', result_image)
-    print("✓ sampling lines chart saved to assets/sampling_lines.png")
+    result_image = draw_sampling_lines(to_bgr(image), corners)
+    path = save_image(result_image, 'assets/sampling_lines.png', writer)
+    print(f"✓ sampling lines chart saved to {path}")
     
     return result_image
 
-def plot_rgb_comparison(left_rgb, left_pos, right_rgb, right_pos):
-    """plot the RGB comparison chart of the left and right lines"""
-    
-    fig, axes = plt.subplots(3, 1, figsize=(15, 10))
+def draw_rgb_comparison(fig, left_rgb, left_pos, right_rgb, right_pos):
+    """draw the RGB comparison chart of the left and right lines on an existing figure"""
+    fig.clear()
+    axes = fig.subplots(3, 1)
     fig.suptitle('RGB value comparison of the left and right lines', fontsize=16, fontweight='bold')
     
     colors = ['red', 'green', 'blue']
@@ -113,30 +190,66 @@ def plot_rgb_comparison(left_rgb, left_pos, right_rgb, right_pos):
         if i == 2:
             axes[i].set_xlabel('distance from the starting point', fontsize=10)
     
-    plt.tight_layout()
-    plt.savefig('assets/rgb_comparison.png', dpi=300, bbox_inches='tight')
-    plt.show()
-    print("✓ RGB comparison chart saved to assets/rgb_comparison.png") 
-
-def print_center_line(image, corners):
-    """print the center line"""
-    if len(corners) != 4:
-        return
-    
-    # determine the position of the four points
-    sorted_corners = sorted(corners, key=lambda p: p[1])
-    top_points = sorted(sorted_corners[:2], key=lambda p: p[0])
-    bottom_points = sorted(sorted_corners[2:], key=lambda p: p[0])
-    
-    left_top = top_points[0]
-    right_top = top_points[1]
-    mid_top = (left_top[0] + right_top[0]) // 2, (left_top[1] + right_top[1]) // 2
+    fig.tight_layout()
+
+def plot_rgb_comparison(left_rgb, left_pos, right_rgb, right_pos, prefix='', dpi=300):
+    """plot the RGB comparison chart of the left and right lines"""
+    plt = _pyplot()
+    set_chart_font()
+    fig = plt.figure(figsize=(15, 10))
+    try:
+        draw_rgb_comparison(fig, left_rgb, left_pos, right_rgb, right_pos)
+        path = f'assets/{prefix}rgb_comparison.png'
+        fig.savefig(path, dpi=dpi, bbox_inches='tight')
+        print(f"✓ RGB comparison chart saved to {path}")
+    finally:
+        plt.close(fig)
+
+def draw_seam_heatmap(fig, profile):
+    """draw the delta E heatmap (strip width x seam row) and the profile of the widest strip"""
+    fig.clear()
+    heat_ax, line_ax = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [1, 2]})
+    fig.suptitle(f'delta E along the seam ({profile.method})', fontsize=16, fontweight='bold')
 
-    left_bottom = bottom_points[0]
-    right_bottom = bottom_points[1]
-    mid_bottom = (left_bottom[0] + right_bottom[0]) // 2, (left_bottom[1] + right_bottom[1]) // 2
+    rows = profile.rows
+    step = rows[1] - rows[0] if len(rows) > 1 else 1
+    extent = [rows[0] - step / 2, rows[-1] + step / 2, -0.5, len(profile.strip_widths) - 0.5]
+    image = heat_ax.imshow(profile.delta_e, aspect='auto', origin='lower', extent=extent, cmap='inferno')
+    heat_ax.set_yticks(range(len(profile.strip_widths)))
+    heat_ax.set_yticklabels([f'{w}px' for w in profile.strip_widths])
+    heat_ax.set_ylabel('strip width', fontsize=10)
+    fig.colorbar(image, ax=heat_ax, label='delta E')
+
+    line_ax.plot(rows, profile.delta_e[-1], color='black', linewidth=1.5)
+    worst_row, worst_delta = profile.worst()
+    if worst_row is not None:
+        line_ax.axvline(worst_row, color='red', linestyle='--', alpha=0.7,
+                        label=f'max {worst_delta:.2f} at row {worst_row}')
+        line_ax.legend()
+    line_ax.set_xlabel('image row', fontsize=10)
+    line_ax.set_ylabel(f'delta E ({profile.strip_widths[-1]}px strip)', fontsize=10)
+    line_ax.grid(True, alpha=0.3)
+
+def plot_seam_heatmap(profile, prefix='', dpi=300):
+    """plot the seam delta E heatmap to assets/<prefix>seam_delta_heatmap.png"""
+    plt = _pyplot()
+    set_chart_font()
+    fig = plt.figure(figsize=(15, 8))
+    try:
+        draw_seam_heatmap(fig, profile)
+        path = f'assets/{prefix}seam_delta_heatmap.png'
+        fig.savefig(path, dpi=dpi, bbox_inches='tight')
+        print(f"✓ seam delta E heatmap saved to {path}")
+    finally:
+        plt.close(fig)
+    return path
+
+def print_center_line(image, corners, writer=None):
+    """print the center line of every seam on a copy of the image"""
+    if len(corners) < 4:
+        return
     
-    # draw the center line
-    cv2.line(image, mid_top, mid_bottom, (0, 0, 255), 3)
-    cv2.imwrite('assets/center_line.png', image)
-    print("✓ center line chart saved to assets/center_line.png")
\ No newline at end of file
+    result_image = draw_center_lines(to_bgr(image), corners)
+    path = save_image(result_image, 'assets/center_line.png', writer)
+    print(f"✓ center line chart saved to {path}")
+    return result_image